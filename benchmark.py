@@ -0,0 +1,410 @@
+#!/usr/bin/python
+"""
+Benchmarks for the scan pipeline, on synthetic trees made here.
+
+    python benchmark.py --files 100000 --output results.json
+
+makes (or reuses) a tree of JPEGs with assorted exif date combinations, MP4s,
+files ignored by name and files of no known type, spread over nested
+directories. Then each scenario is run in a process of its own, from a
+scratch directory so no real catalog is touched:
+
+    cold  - a full scan with no catalog
+    warm  - an incremental rescan of the unchanged tree
+    hash  - a full scan that hashes every file
+    default - a full scan with rummage's defaults: every file hashed and the
+             metadata cache on, starting empty, so its cost shows against hash
+    cached - a full scan with the metadata cache filled by the one before it, as
+             when a tree is moved or copied (see metadata_cache.py); hash_policy
+             partial, so files can be found by their content
+
+For each one it reports the wall time, files and MB per second, the peak RSS
+of the scanning process, and the time spent in each stage (see scan_stats.py).
+A stub exiftool is written to the scratch directory, so nothing outside it is
+needed and the numbers don't depend on the installed exiftool.
+
+    python benchmark.py --startup
+
+measures cold start instead: how long importing rummage takes, and how long
+"rummage.py rescan" of a small tree that hasn't changed takes, start to exit.
+That's what a cron job pays, and it should stay well under a second.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from metadata_cache import METADATA_CACHE
+
+BENCHMARK_FILES = 10000
+FILES_PER_DIRECTORY = 200
+DIRECTORY_FANOUT = 4
+PADDING_SIZE = 4 * 1024
+
+SCENARIOS = ["cold", "warm", "hash", "default", "cached"]
+
+# Files in the tree --startup rescans
+STARTUP_FILES = 100
+
+# The exif tags of each kind of JPEG in the tree, and how many of the JPEGs are that kind.
+# 0x0132 DateTime, 0x9003 DateTimeOriginal, 0x9004 DateTimeDigitized, 0x010F Make
+JPEG_KINDS = [
+    ("all_same", 50, {0x0132: "2014:06:24 10:00:00", 0x9003: "2014:06:24 10:00:00", 0x9004: "2014:06:24 10:00:00"}),
+    ("datetime_differs", 15, {0x0132: "2015:01:01 12:00:00", 0x9003: "2014:06:24 10:00:00",
+                              0x9004: "2014:06:24 10:00:00"}),
+    ("big_diff", 5, {0x9003: "2014:06:24 10:00:00", 0x9004: "2014:06:28 10:00:00"}),
+    ("datetime_only", 10, {0x0132: "2013:03:03 03:03:03"}),
+    ("no_dates", 10, {0x010F: "Benchmark"}),
+    ("invalid", 5, {0x9003: "0000:00:00 00:00:00", 0x9004: "0000:00:00 00:00:00"}),
+    ("no_exif", 5, {}),
+]
+
+# How many of the files are of each kind, out of 100
+FILE_MIX = [
+    ("jpeg", 60),
+    ("mp4", 12),
+    ("mp4_zero_date", 2),
+    ("mp4_no_moov", 6),
+    ("ignored", 10),
+    ("unknown", 10),
+]
+IGNORED_NAMES = ["notes%d.txt", ".hidden%d", "thumbs%d.db", "manual%d.pdf"]
+
+EXIFTOOL_STUB = '''#!%(python)s
+# Answers like exiftool -stay_open for the benchmark: MP4s get a MIMEType and a
+# MediaCreateDate, everything else nothing.
+import json, sys
+
+def answer(args):
+    entries = []
+    for arg in args:
+        if arg.startswith("-") or arg in ("True", "False"):
+            continue
+        entry = {"SourceFile": arg}
+        if arg.endswith(".mp4"):
+            entry["MIMEType"] = "video/mp4"
+            entry["MediaCreateDate"] = "2016:07:08 09:10:11"
+        entries.append(entry)
+    if entries:
+        sys.stdout.write(json.dumps(entries) + "\\n")
+
+args = []
+echo = None
+expect = None
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if expect == "-echo4":
+        echo = line
+    elif expect == "-stay_open":
+        if line == "False":
+            break
+    elif line in ("-echo4", "-stay_open"):
+        expect = line
+        continue
+    elif line.startswith("-execute"):
+        answer(args)
+        sys.stdout.write("{ready%%s}\\n" %% line[len("-execute"):])
+        sys.stdout.flush()
+        if echo is not None:
+            sys.stderr.write(echo + "\\n")
+            sys.stderr.flush()
+        args = []
+        echo = None
+    else:
+        args.append(line)
+    expect = None
+'''
+
+
+def jpeg_templates():
+    """
+    :return: dictionary of JPEG kind to the bytes of a small JPEG with its tags
+    """
+    from io import BytesIO
+    from PIL import Image
+    templates = {}
+    for kind, weight, tags in JPEG_KINDS:
+        image = Image.new("RGB", (16, 16), (200, 120, 40))
+        output = BytesIO()
+        if tags:
+            exif = Image.Exif()
+            exif_ifd = exif.get_ifd(0x8769)
+            for tag, value in tags.items():
+                if tag in (0x9003, 0x9004):
+                    exif_ifd[tag] = value
+                else:
+                    exif[tag] = value
+            image.save(output, "JPEG", exif=exif)
+        else:
+            image.save(output, "JPEG")
+        templates[kind] = output.getvalue()
+    return templates
+
+
+def box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def mp4_bytes(creation_time, padding, with_moov=True):
+    """
+    Just enough of an MP4 for the header reader: ftyp, mdat, and moov with mvhd and one track's mdhd.
+    """
+    data = box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2mp41") + box(b"mdat", padding)
+    if with_moov:
+        mvhd = box(b"mvhd", b"\x00\x00\x00\x00" + struct.pack(">II", creation_time, creation_time) + b"\x00" * 88)
+        mdhd = box(b"mdhd", b"\x00\x00\x00\x00" + struct.pack(">II", creation_time, creation_time) + b"\x00" * 12)
+        data += box(b"moov", mvhd + box(b"trak", box(b"mdia", mdhd)))
+    return data
+
+
+def directory_for(root, index, fanout):
+    """
+    Directory number index of a tree where every directory has fanout subdirectories.
+    """
+    parts = []
+    index += 1
+    while index:
+        index, digit = divmod(index - 1, fanout)
+        parts.append("d" + str(digit))
+    return os.path.join(root, *reversed(parts))
+
+
+def make_tree(root, files=BENCHMARK_FILES, per_directory=FILES_PER_DIRECTORY, fanout=DIRECTORY_FANOUT,
+              padding_size=PADDING_SIZE, seed=0):
+    """
+    Make the synthetic tree under root, unless one made with the same settings is there already.
+    :return: the number of files in it
+    """
+    settings = {"files": files, "per_directory": per_directory, "fanout": fanout,
+                "padding_size": padding_size, "seed": seed}
+    marker = root.rstrip(os.sep) + ".json"
+    if os.path.isdir(root) and os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == settings:
+                return files
+    if os.path.exists(root):
+        shutil.rmtree(root)
+
+    rng = random.Random(seed)
+    templates = jpeg_templates()
+    jpeg_kinds = [kind for kind, weight, tags in JPEG_KINDS for i in range(weight)]
+    file_kinds = [kind for kind, weight in FILE_MIX for i in range(weight)]
+    # Every file gets a slice of this, plus its number, so no two files are the same
+    noise = bytes(bytearray(rng.getrandbits(8) for i in range(padding_size * 2 + 1)))
+
+    for number in range(files):
+        directory = directory_for(root, number // per_directory, fanout)
+        if number % per_directory == 0:
+            os.makedirs(directory)
+        start = rng.randrange(padding_size + 1)
+        padding = struct.pack(">Q", number) + noise[start:start + rng.randrange(padding_size + 1)]
+        kind = rng.choice(file_kinds)
+        if kind == "jpeg":
+            jpeg_kind = rng.choice(jpeg_kinds)
+            # Anything after the end of image marker is ignored by readers
+            name, data = "img%d_%s.jpg" % (number, jpeg_kind), templates[jpeg_kind] + padding
+        elif kind == "mp4":
+            name, data = "vid%d.mp4" % number, mp4_bytes(rng.randrange(3300000000, 3700000000), padding)
+        elif kind == "mp4_zero_date":
+            name, data = "vid%d_zero.mp4" % number, mp4_bytes(0, padding)
+        elif kind == "mp4_no_moov":
+            name, data = "vid%d_nomoov.mp4" % number, mp4_bytes(0, padding, with_moov=False)
+        elif kind == "ignored":
+            name, data = rng.choice(IGNORED_NAMES) % number, padding
+        else:
+            name, data = "blob%d.bin" % number, b"\x00\x01BENCH" + padding
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(data)
+
+    with open(marker, "w") as f:
+        json.dump(settings, f)
+    return files
+
+
+def write_exiftool_stub(directory):
+    stub = os.path.join(directory, "exiftool_stub")
+    with open(stub, "w") as f:
+        f.write(EXIFTOOL_STUB % {"python": sys.executable})
+    os.chmod(stub, 0o755)
+    return stub
+
+
+def scenario_options(scenario, exiftool, args):
+    options = {"exiftool": exiftool, "workers": args.workers, "concurrency": args.concurrency,
+               "chunk_size": args.chunk_size, "header_reader": not args.no_header_reader,
+               "metadata_cache": None}
+    if scenario == "cold":
+        options.update(incremental=False, hash_policy="none")
+    elif scenario == "warm":
+        options.update(incremental=True, hash_policy="none")
+    elif scenario == "hash":
+        options.update(incremental=False, hash_policy="full")
+    elif scenario == "default":
+        options.update(incremental=False, hash_policy="full", metadata_cache=METADATA_CACHE)
+    elif scenario == "cached":
+        options.update(incremental=False, hash_policy="partial", metadata_cache=METADATA_CACHE)
+    return options
+
+
+def run_scan(tree, work_directory, options):
+    """
+    Run one scan in a child process from work_directory.
+    :return: the child's stats summary, with its wall time and peak RSS (in MB) added
+    """
+    stats_file = os.path.join(work_directory, "stats.json")
+    started = time.time()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-scan", tree, stats_file,
+                                json.dumps(options)], cwd=work_directory)
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - started
+    if process.returncode != 0:
+        raise RuntimeError("benchmark scan exited with " + str(process.returncode))
+    with open(stats_file) as f:
+        summary = json.load(f)
+    # Linux reports KB, macOS bytes
+    summary["peak_rss_mb"] = round(usage.ru_maxrss / (1024.0 * 1024 if sys.platform == "darwin" else 1024.0), 1)
+    summary["wall_seconds"] = round(wall, 3)
+    walked = summary["counters"].get("files_walked", 0)
+    summary["files_walked_per_second"] = round(walked / wall, 1) if wall > 0 else None
+    return summary
+
+
+def run_benchmarks(tree, scenarios, args):
+    results = {}
+    work_directory = tempfile.mkdtemp(prefix="rummage_benchmark_")
+    try:
+        exiftool = write_exiftool_stub(work_directory)
+        for scenario in scenarios:
+            options = scenario_options(scenario, exiftool, args)
+            if scenario == "warm":
+                # Something to be warm from
+                run_scan(tree, work_directory, scenario_options("cold", exiftool, args))
+            elif scenario == "cached":
+                # Fills the cache
+                run_scan(tree, work_directory, options)
+            runs = []
+            for i in range(args.repeat):
+                if scenario == "default":
+                    # Each run fills the cache from empty
+                    for suffix in ("", "-wal", "-shm"):
+                        metadata_cache = os.path.join(work_directory, METADATA_CACHE + suffix)
+                        if os.path.exists(metadata_cache):
+                            os.remove(metadata_cache)
+                runs.append(run_scan(tree, work_directory, options))
+            # The fastest run is the one least disturbed by everything else on the machine
+            results[scenario] = min(runs, key=lambda summary: summary["wall_seconds"])
+            results[scenario]["options"] = dict(options, exiftool="stub")
+    finally:
+        shutil.rmtree(work_directory)
+    return results
+
+
+def time_command(command, cwd):
+    started = time.time()
+    subprocess.check_call(command, cwd=cwd, stdout=subprocess.DEVNULL)
+    return time.time() - started
+
+
+def run_startup(args):
+    """
+    Time a fresh process importing rummage, and a no-change "rummage.py rescan" of a
+    tree of STARTUP_FILES files, each the fastest of args.repeat runs.
+    :return: dictionary of what was timed to its seconds
+    """
+    rummage_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rummage.py")
+    work_directory = tempfile.mkdtemp(prefix="rummage_benchmark_")
+    try:
+        tree = os.path.join(work_directory, "tree")
+        make_tree(tree, STARTUP_FILES, args.per_directory, args.fanout, args.padding_kb * 1024, args.seed)
+        exiftool = write_exiftool_stub(work_directory)
+        scan = [sys.executable, rummage_script, "-q", "--exiftool", exiftool, "--no-metadata-cache", tree]
+        time_command(scan, work_directory)
+        runs = {"import": [], "rescan": []}
+        for i in range(args.repeat):
+            runs["import"].append(time_command([sys.executable, "-c", "import rummage"],
+                                               os.path.dirname(rummage_script)))
+            runs["rescan"].append(time_command([sys.executable, rummage_script, "rescan", "-q", "--exiftool",
+                                                exiftool, "--no-metadata-cache", tree], work_directory))
+    finally:
+        shutil.rmtree(work_directory)
+    return dict((name, round(min(runs[name]), 3)) for name in runs)
+
+
+def print_results(results):
+    print("%-6s %10s %12s %12s %8s %10s" % ("", "seconds", "walked/s", "examined/s", "MB/s", "peak MB"))
+    for scenario in results:
+        summary = results[scenario]
+        print("%-6s %10.2f %12s %12s %8.1f %10.1f" % (
+            scenario, summary["wall_seconds"], summary["files_walked_per_second"], summary["files_per_second"],
+            (summary["bytes_per_second"] or 0) / 1e6, summary["peak_rss_mb"]))
+        stages = summary["stages"]
+        print("       " + ", ".join("%s %.2fs" % (stage, stages[stage]["seconds"]) for stage in stages
+                                    if stages[stage]["calls"]))
+
+
+def scan_in_this_process(tree, stats_file, options):
+    from rummage import Rummage
+    logging.basicConfig(level=logging.WARNING)
+    Rummage(tree, stats_file=stats_file, **options)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmark rummage scans on a synthetic tree.")
+    parser.add_argument("--tree", default=os.path.join(tempfile.gettempdir(), "rummage_benchmark_tree"),
+                        help="where to make the tree; it's kept for the next run (default: %(default)s)")
+    parser.add_argument("--files", type=int, default=BENCHMARK_FILES, help="files in the tree (default: %(default)s)")
+    parser.add_argument("--per-directory", type=int, default=FILES_PER_DIRECTORY,
+                        help="files per directory (default: %(default)s)")
+    parser.add_argument("--fanout", type=int, default=DIRECTORY_FANOUT,
+                        help="subdirectories per directory (default: %(default)s)")
+    parser.add_argument("--padding-kb", type=int, default=PADDING_SIZE // 1024,
+                        help="files get up to this many KB of padding, for the hashing (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="run only this scenario. May be repeated (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario, the fastest counts")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--no-header-reader", action="store_true")
+    parser.add_argument("--startup", action="store_true",
+                        help="time importing rummage and a no-change rescan of %d files, not the scenarios" %
+                             STARTUP_FILES)
+    parser.add_argument("--output", metavar="FILE", help="write the results to FILE as JSON")
+    parser.add_argument("--run-scan", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scan:
+        tree, stats_file, options = args.run_scan
+        scan_in_this_process(tree, stats_file, json.loads(options))
+        sys.exit(0)
+
+    if args.startup:
+        results = run_startup(args)
+        print("import rummage %.3fs, no-change rescan of %d files %.3fs" % (results["import"], STARTUP_FILES,
+                                                                          results["rescan"]))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"startup": results, "files": STARTUP_FILES}, f, indent=2, sort_keys=True)
+                f.write("\n")
+        sys.exit(0)
+
+    tree = os.path.abspath(args.tree)
+    started = time.time()
+    make_tree(tree, args.files, args.per_directory, args.fanout, args.padding_kb * 1024, args.seed)
+    print("Tree of", args.files, "files at", tree, "ready in %.1fs" % (time.time() - started))
+    results = run_benchmarks(tree, args.scenario or SCENARIOS, args)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"tree": tree, "files": args.files, "results": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
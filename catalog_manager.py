@@ -0,0 +1,346 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sqlite3
+
+from catalog_store import (MANIFEST, read_manifest, add_to_manifest, write_manifest, directory_hash, path_to_db,
+                           path_from_db)
+
+log = logging.getLogger(__name__)
+
+# The cross-root index, next to the manifest and the catalogs
+INDEX = "rummage_index.db"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    directory TEXT PRIMARY KEY,
+    catalog TEXT NOT NULL,
+    catalog_mtime REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    category TEXT,
+    date TEXT,
+    taken TEXT,
+    size INTEGER,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_root ON files (root);
+CREATE INDEX IF NOT EXISTS files_taken ON files (taken);
+CREATE INDEX IF NOT EXISTS files_category ON files (category);
+"""
+
+# taken is the date a file was taken, as "YYYY-MM-DD HH:MM:SS", whether it came from the exif data
+# or the path ("Path date medium 2014-06-24 00:00:00"); NULL if it has neither.
+DATE_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]"
+TAKEN = ("CASE WHEN date GLOB '" + DATE_GLOB + "' THEN date "
+         "WHEN date LIKE 'Path date %' THEN substr(date, -19) END")
+
+# Sorts after any path that starts with the same prefix
+PREFIX_END = u"\U0010ffff"
+
+# Paths that start with a prefix. Those that aren't valid UTF-8 are BLOBs (see catalog_store.path_to_db()),
+# which sort after all TEXT, so they're matched by their bytes. See prefix_parameters().
+PREFIX_CONDITION = "((path >= ? AND path < ?) OR (typeof(path) = 'blob' AND substr(path, 1, ?) = ?))"
+
+IndexedFile = collections.namedtuple("IndexedFile", "path root category date")
+
+
+def is_inside(directory, root):
+    """
+    :return: True if directory is under root, but isn't root
+    """
+    directory, root = os.path.abspath(directory), os.path.abspath(root)
+    return directory != root and directory.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def prefix_parameters(prefix):
+    """
+    :return: the parameters of PREFIX_CONDITION for prefix
+    """
+    prefix_bytes = os.fsencode(prefix)
+    if isinstance(path_to_db(prefix), bytes):
+        # Only BLOBs can start with it. An empty range rather than NULLs, which NOT would keep NULL.
+        return [PREFIX_END, PREFIX_END, len(prefix_bytes), prefix_bytes]
+    return [prefix, prefix + PREFIX_END, len(prefix_bytes), prefix_bytes]
+
+
+def _scan_root(directory, skip_directories, options, log_level):
+    logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
+    # Imported here: everything else in this module works without Pillow
+    from rummage import Rummage
+    rummage = Rummage(directory, skip_directories=skip_directories, **options)
+    return rummage.scan_counts
+
+
+class CatalogManager:
+    """
+    Many roots, each rummaged into a catalog of its own, and one index over all
+    of them.
+
+    The roots are the directories in the manifest. register() adds one, and
+    scan() rummages them all, processes at a time. A root that's inside another
+    one is skipped by the other's scan, so every file is in exactly one catalog:
+    that of the deepest root it's under.
+
+    The index (index_file, an SQLite database) has the path, category and date of
+    every file in every catalog, and the date it was taken, so find() can look
+    through all of them at once by date range, path prefix or category. sync()
+    brings it up to date; only catalogs that changed since the last sync are read
+    again. scan() syncs when it's done. Paths and roots that aren't valid UTF-8 are
+    BLOBs in the index, as in the catalogs (see catalog_store.path_to_db()).
+    """
+    def __init__(self, manifest=MANIFEST, index_file=INDEX):
+        self.manifest = manifest
+        self.index_file = index_file
+        self.connection = sqlite3.connect(index_file)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(INDEX_SCHEMA)
+
+    def roots(self):
+        """
+        :return: list of (root directory, catalog file), in the order they were registered.
+                 A root is as it was given to Rummage, its catalog is named after that.
+        """
+        roots = collections.OrderedDict()
+        for directory, catalog_file in read_manifest(self.manifest) or []:
+            # Older versions listed pickles. The next scan of the root imports it.
+            if catalog_file.endswith(".pickle"):
+                catalog_file = catalog_file[:-len(".pickle")] + ".db"
+            roots[directory] = catalog_file
+        return list(roots.items())
+
+    def register(self, directory):
+        """
+        Add a root. Nothing is scanned until scan().
+        :return: the root's catalog file
+        """
+        directory = os.path.abspath(directory)
+        if not os.path.isdir(directory):
+            raise NotADirectoryError(directory)
+        for root, catalog_file in self.roots():
+            if os.path.abspath(root) == directory:
+                return catalog_file
+            if is_inside(directory, root):
+                log.info("%s is inside %s, which won't be scanned there any more", directory, root)
+            elif is_inside(root, directory):
+                log.info("%s is inside %s, it won't be scanned again there", root, directory)
+        catalog_file = directory_hash(directory) + ".db"
+        add_to_manifest(directory, catalog_file, self.manifest)
+        return catalog_file
+
+    def unregister(self, directory):
+        """
+        Drop a root, and its files from the index. Its catalog is left alone.
+        """
+        directory = os.path.abspath(directory)
+        roots = self.roots()
+        write_manifest([(root, catalog_file) for root, catalog_file in roots
+                        if os.path.abspath(root) != directory], self.manifest)
+        with self.connection:
+            for root, catalog_file in roots:
+                if os.path.abspath(root) == directory:
+                    self.connection.execute("DELETE FROM files WHERE root = ?", (path_to_db(root),))
+                    self.connection.execute("DELETE FROM roots WHERE directory = ?", (path_to_db(root),))
+
+    def nested_roots(self, directory):
+        """
+        :return: the roots inside directory, that its scan skips
+        """
+        return [root for root, catalog_file in self.roots() if is_inside(root, directory)]
+
+    def scan(self, directories=None, processes=None, **options):
+        """
+        Rummage the roots (default: all of them), each in a process of its own,
+        processes at a time (default: one per CPU), then sync the index.
+        options are passed on to each Rummage, eg. exiftool or hash_policy.
+        :return: dictionary of root to its Rummage's scan_counts, or the exception
+                 its scan raised
+        """
+        roots = [root for root, catalog_file in self.roots()]
+        if directories is not None:
+            directories = [os.path.abspath(directory) for directory in directories]
+            roots = [root for root in roots if os.path.abspath(root) in directories]
+        results = {}
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context) as executor:
+            futures = dict((executor.submit(_scan_root, root, self.nested_roots(root), options,
+                                            log.getEffectiveLevel()), root) for root in roots)
+            for future in concurrent.futures.as_completed(futures):
+                root = futures[future]
+                try:
+                    results[root] = future.result()
+                    log.info("scanned %s: %s", root, results[root])
+                except Exception as e:
+                    log.error("scan of %s failed: %s", root, e)
+                    results[root] = e
+        self.sync()
+        return results
+
+    def _catalog_mtime(self, catalog_file):
+        mtimes = [os.path.getmtime(name) for name in (catalog_file, catalog_file + "-wal")
+                  if os.path.exists(name)]
+        return max(mtimes) if mtimes else None
+
+    def sync(self, force=False):
+        """
+        Bring the index up to date with the catalogs.
+        :return: the roots whose files were read again
+        """
+        synced = dict((path_from_db(row[0]), row[1]) for row in
+                      self.connection.execute("SELECT directory, catalog_mtime FROM roots"))
+        roots = self.roots()
+        registered = set(root for root, catalog_file in roots)
+        with self.connection:
+            for root in synced:
+                if root not in registered:
+                    self.connection.execute("DELETE FROM files WHERE root = ?", (path_to_db(root),))
+                    self.connection.execute("DELETE FROM roots WHERE directory = ?", (path_to_db(root),))
+        updated = []
+        # Shallow roots first, so the deepest root a file is under ends up owning it
+        for root, catalog_file in sorted(roots, key=lambda entry: os.path.abspath(entry[0]).count(os.sep)):
+            catalog_mtime = self._catalog_mtime(catalog_file)
+            if catalog_mtime is None:
+                continue
+            if not force and synced.get(root) == catalog_mtime:
+                continue
+            self._sync_root(root, catalog_file, catalog_mtime)
+            updated.append(root)
+        return updated
+
+    def _sync_root(self, root, catalog_file, catalog_mtime):
+        where = ""
+        parameters = [path_to_db(root)]
+        # The files of a nested root are its, even if this root's catalog has them from before
+        for nested in self.nested_roots(root):
+            where += " AND NOT " + PREFIX_CONDITION
+            parameters += prefix_parameters(os.path.abspath(nested).rstrip(os.sep) + os.sep)
+        self.connection.execute("ATTACH DATABASE ? AS catalog", (catalog_file,))
+        try:
+            with self.connection:
+                self.connection.execute("DELETE FROM files WHERE root = ?", (path_to_db(root),))
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO files (path, root, category, date, taken, size, hash) "
+                    "SELECT path, ?, category, date, " + TAKEN + ", size, hash FROM catalog.files "
+                    "WHERE 1" + where, parameters)
+                self.connection.execute("INSERT OR REPLACE INTO roots (directory, catalog, catalog_mtime) "
+                                        "VALUES (?, ?, ?)", (path_to_db(root), catalog_file, catalog_mtime))
+        finally:
+            self.connection.execute("DETACH DATABASE catalog")
+
+    def find(self, start=None, end=None, prefix=None, category=None, limit=None):
+        """
+        Files in any root, eg. find("2014-06", "2014-07") for everything taken in June 2014.
+        :param start: the earliest date taken, eg. "2014" or "2014-06-24"
+        :param end: dates taken before this
+        :param prefix: paths that start with this
+        :param category: eg. "exif_date"
+        :return: list of IndexedFile, by date taken
+        """
+        conditions = []
+        parameters = []
+        if start is not None:
+            conditions.append("taken >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("taken < ?")
+            parameters.append(end)
+        if prefix is not None:
+            conditions.append(PREFIX_CONDITION)
+            parameters += prefix_parameters(prefix)
+        if category is not None:
+            conditions.append("category = ?")
+            parameters.append(category)
+        sql = "SELECT path, root, category, date FROM files"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY taken, path"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return [IndexedFile(path_from_db(path), path_from_db(root), category, date)
+                for path, root, category, date in self.connection.execute(sql, parameters)]
+
+    def counts(self):
+        """
+        :return: dictionary of root to a dictionary of category to the number of files in it
+        """
+        counts = collections.defaultdict(dict)
+        for root, category, count in self.connection.execute(
+                "SELECT root, category, COUNT(*) FROM files GROUP BY root, category"):
+            counts[path_from_db(root)][category] = count
+        return dict(counts)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Keep many rummaged directories, and search them all at once.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    commands = parser.add_subparsers(dest="command")
+    add = commands.add_parser("add", help="add directories to rummage")
+    add.add_argument("directories", nargs="+")
+    remove = commands.add_parser("remove", help="stop rummaging directories")
+    remove.add_argument("directories", nargs="+")
+    commands.add_parser("list", help="list the directories, and how many files of each category they have")
+    scan = commands.add_parser("scan", help="rummage the directories, and update the index")
+    scan.add_argument("directories", nargs="*", help="which ones (default: all)")
+    scan.add_argument("--processes", type=int, help="directories scanned at once (default: one per CPU)")
+    scan.add_argument("--exiftool", help="exiftool executable")
+    scan.add_argument("--hash", dest="hash_policy", help="how much of each file to hash")
+    scan.add_argument("--full", action="store_true",
+                      help="ignore the results of the last run and examine every file again")
+    find = commands.add_parser("find", help="search all the directories")
+    find.add_argument("--from", dest="start", help="taken on or after, eg. 2014-06")
+    find.add_argument("--to", dest="end", help="taken before, eg. 2014-07")
+    find.add_argument("--prefix", help="paths starting with this")
+    find.add_argument("--category", help="eg. exif_date")
+    find.add_argument("--limit", type=int)
+    commands.add_parser("sync", help="update the index from the catalogs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(levelname)s: %(message)s")
+
+    with CatalogManager() as manager:
+        if args.command == "add":
+            for directory in args.directories:
+                manager.register(directory)
+        elif args.command == "remove":
+            for directory in args.directories:
+                manager.unregister(directory)
+        elif args.command == "list":
+            counts = manager.counts()
+            for root, catalog_file in manager.roots():
+                nested = manager.nested_roots(root)
+                print(root, catalog_file, "(skips " + ", ".join(nested) + ")" if nested else "")
+                for category, count in sorted(counts.get(root, {}).items()):
+                    print("   ", category, count)
+        elif args.command == "scan":
+            options = {"incremental": not args.full}
+            if args.exiftool:
+                options["exiftool"] = args.exiftool
+            if args.hash_policy:
+                options["hash_policy"] = args.hash_policy
+            manager.scan(args.directories or None, args.processes, **options)
+        elif args.command == "find":
+            for found in manager.find(args.start, args.end, args.prefix, args.category, args.limit):
+                print(found.date, found.category, found.path)
+        elif args.command == "sync":
+            manager.sync()
+        else:
+            parser.print_help()
@@ -0,0 +1,451 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+from file_record import FileRecord
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Each line is "<directory> <BREAK> <catalog file>", one for every directory rummaged from here
+MANIFEST = "rummage_pickle_manifest"
+MANIFEST_BREAK = " <BREAK> "
+
+# Rows are written this many at a time, each batch in one transaction
+CATALOG_BATCH_SIZE = 1000
+
+# How many writes may wait for CatalogWriter's thread before the caller has to wait
+WRITER_QUEUE_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    inode INTEGER,
+    device INTEGER,
+    mode INTEGER,
+    date TEXT,
+    hash TEXT,
+    partial_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_category ON files (category);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+CREATE INDEX IF NOT EXISTS files_date ON files (date);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS date_tags (
+    path TEXT PRIMARY KEY,
+    date_time TEXT,
+    date_time_digitized TEXT,
+    date_time_original TEXT,
+    media_create_date TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+FILE_COLUMNS = "path, category, mtime, size, inode, device, mode, date, hash, partial_hash, mtime_ns"
+
+# The date tags of a file, as they were read, in the order of rummage.DATE_TAGS
+DATE_TAG_COLUMNS = "date_time, date_time_digitized, date_time_original, media_create_date"
+
+# Columns added since the first version of the schema, with their types
+ADDED_COLUMNS = [("partial_hash", "TEXT"), ("mtime_ns", "INTEGER")]
+
+
+def path_to_db(path):
+    """
+    :return: path as it's kept in a catalog. os.scandir() gives names that aren't valid
+             UTF-8 with surrogate escapes, which SQLite can't take as TEXT; those are kept
+             as their bytes, in a BLOB. Everything else stays TEXT.
+    """
+    try:
+        path.encode("utf-8")
+    except UnicodeEncodeError:
+        return os.fsencode(path)
+    return path
+
+
+def path_from_db(value):
+    """
+    :return: a path as path_to_db() kept it, back as os.scandir() gave it
+    """
+    if isinstance(value, bytes):
+        return os.fsdecode(value)
+    return value
+
+
+def directory_hash(directory):
+    """
+    :return: what a directory's catalog (and pickle and checkpoint) files are named after
+    """
+    dir_hash = hashlib.sha1()
+    dir_hash.update(directory.encode('utf-8', 'surrogateescape'))
+    return dir_hash.hexdigest()
+
+
+def read_manifest(manifest=MANIFEST):
+    """
+    :return: list of (directory, catalog file) pairs, or None if there's no manifest.
+             Older versions listed pickle files rather than catalogs.
+    """
+    if not os.path.exists(manifest):
+        return None
+    entries = []
+    with open(manifest, errors="surrogateescape") as manifest_file:
+        for line in manifest_file:
+            if MANIFEST_BREAK in line:
+                directory, catalog_file = line.rstrip("\n").split(MANIFEST_BREAK, 1)
+                entries.append((directory, catalog_file.rstrip()))
+    return entries
+
+
+def add_to_manifest(directory, catalog_file, manifest=MANIFEST):
+    with open(manifest, "a", errors="surrogateescape") as manifest_file:
+        manifest_file.write(directory + MANIFEST_BREAK + catalog_file + "\n")
+
+
+def write_manifest(entries, manifest=MANIFEST):
+    """
+    Replace the manifest with entries, a list of (directory, catalog file) pairs.
+    """
+    with open(manifest + ".tmp", "w", errors="surrogateescape") as manifest_file:
+        for directory, catalog_file in entries:
+            manifest_file.write(directory + MANIFEST_BREAK + catalog_file + "\n")
+    os.replace(manifest + ".tmp", manifest)
+
+
+class CatalogStore:
+    """
+    The results of a Rummage, kept in an SQLite database.
+
+    There's one row per file in the files table, with the category
+    (eg. "exif_date") it was put in. Writes are staged and sent in batches of
+    batch_size, each in one transaction, so a rescan only touches the rows that
+    changed. The database is in WAL mode, so it can be queried while a scan is
+    writing to it. Any report is a plain SQL query, see query().
+
+    The directories table has the mtime of every directory as of the last
+    complete scan, so unchanged directories can be skipped.
+
+    The date_tags table has the date tags each file with exif data had, as they
+    were read, so the files can be classified again without reading them (see
+    reclassify.py). Files without exif data, and files from before it was kept,
+    have no row there.
+
+    Paths are TEXT, except those that aren't valid UTF-8, see path_to_db(). The
+    methods here take and give them as os.scandir() does; query() gives them as
+    they're kept.
+    """
+    def __init__(self, filename, batch_size=CATALOG_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self._add_columns()
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_partial_hash ON files (partial_hash)")
+        self._upserts = []
+        self._tag_upserts = []
+        self._tag_deletes = []
+        self._deletes = []
+        self._hash_updates = []
+
+    def _add_columns(self):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        with self.connection:
+            for column, column_type in ADDED_COLUMNS:
+                if column not in columns:
+                    self.connection.execute("ALTER TABLE files ADD COLUMN " + column + " " + column_type)
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def check_hash_settings(self, hash_algorithm, partial_hash_size):
+        """
+        Hashes made with another algorithm, or partial hashes of another size, can't be compared
+        with new ones, so they're dropped.
+        :return: False if stored hashes were dropped
+        """
+        settings = (("hash_algorithm", str(hash_algorithm)), ("partial_hash_size", str(partial_hash_size)))
+        unchanged = True
+        for key, value in settings:
+            stored = self.get_meta(key)
+            if stored is not None and stored != value:
+                unchanged = False
+        if not unchanged:
+            with self.connection:
+                self.connection.execute("UPDATE files SET hash = NULL, partial_hash = NULL")
+        for key, value in settings:
+            self.set_meta(key, value)
+        return unchanged
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def load(self):
+        """
+        Yield (output_name, file_name, file_info_list) for every stored file.
+        file_info_list is the same FileRecord a Rummage keeps (see file_record.py).
+        """
+        cursor = self.connection.execute("SELECT " + FILE_COLUMNS + " FROM files")
+        for path, category, mtime, size, inode, device, mode, date, file_hash, partial_hash, mtime_ns in cursor:
+            yield category, path_from_db(path), FileRecord.from_row(category, mtime, mtime_ns, size, inode, device,
+                                                                    mode, date, file_hash, partial_hash)
+
+    def upsert(self, output_name, file_name, file_info_list):
+        """
+        :param file_info_list: a FileRecord, or the [stat, date string, hash, partial hash] list
+                               older versions pickled
+        """
+        if not isinstance(file_info_list, FileRecord):
+            file_info_list = FileRecord.from_list(file_info_list)
+        mtime_ns, size, inode, device, mode = file_info_list.stat_fields()
+        file_name = path_to_db(file_name)
+        self._upserts.append((file_name, output_name, file_info_list.mtime, size, inode, device, mode,
+                              file_info_list.date, file_info_list.hash, file_info_list.partial_hash, mtime_ns))
+        if file_info_list.tags is None:
+            self._tag_deletes.append((file_name,))
+        else:
+            self._tag_upserts.append((file_name,) + tuple(file_info_list.tags))
+        if len(self._upserts) >= self.batch_size:
+            self.flush()
+
+    def delete(self, file_name):
+        self._deletes.append((path_to_db(file_name),))
+        if len(self._deletes) >= self.batch_size:
+            self.flush()
+
+    def update_hashes(self, file_name, file_hash, partial_hash):
+        """
+        Fill in the hashes of a file that's already stored. None leaves a hash as it is.
+        """
+        self._hash_updates.append((file_hash, partial_hash, path_to_db(file_name)))
+        if len(self._hash_updates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write whatever is staged, in one transaction.
+        """
+        if not self._upserts and not self._deletes and not self._hash_updates:
+            return
+        with self.connection:
+            if self._upserts:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO files (" + FILE_COLUMNS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._upserts)
+            if self._tag_deletes:
+                self.connection.executemany("DELETE FROM date_tags WHERE path = ?", self._tag_deletes)
+            if self._tag_upserts:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO date_tags (path, " + DATE_TAG_COLUMNS + ") VALUES (?, ?, ?, ?, ?)",
+                    self._tag_upserts)
+            if self._deletes:
+                self.connection.executemany("DELETE FROM files WHERE path = ?", self._deletes)
+                self.connection.executemany("DELETE FROM date_tags WHERE path = ?", self._deletes)
+            if self._hash_updates:
+                self.connection.executemany(
+                    "UPDATE files SET hash = COALESCE(?, hash), partial_hash = COALESCE(?, partial_hash) "
+                    "WHERE path = ?", self._hash_updates)
+        self._upserts = []
+        self._tag_upserts = []
+        self._tag_deletes = []
+        self._deletes = []
+        self._hash_updates = []
+
+    def load_directories(self):
+        """
+        :return: dictionary of directory to its mtime at the last complete scan
+        """
+        return dict((path_from_db(path), mtime) for path, mtime in
+                    self.query("SELECT path, mtime FROM directories"))
+
+    def replace_directories(self, directory_mtimes):
+        self.flush()
+        with self.connection:
+            self.connection.execute("DELETE FROM directories")
+            self.connection.executemany("INSERT INTO directories (path, mtime) VALUES (?, ?)",
+                                        [(path_to_db(path), mtime) for path, mtime in directory_mtimes.items()])
+
+    def clear(self):
+        self._upserts = []
+        self._tag_upserts = []
+        self._tag_deletes = []
+        self._deletes = []
+        self._hash_updates = []
+        with self.connection:
+            self.connection.execute("DELETE FROM files")
+            self.connection.execute("DELETE FROM date_tags")
+            self.connection.execute("DELETE FROM directories")
+
+    def import_pickle(self, pickle_file):
+        """
+        Copy the results of an older, pickle based, run into the catalog.
+        :return: the number of files imported
+        """
+        with open(pickle_file, "rb") as f:
+            exif_dates_dict = pickle.load(f)
+        count = 0
+        for output_name in exif_dates_dict:
+            file_dict = exif_dates_dict[output_name]
+            for file_name in file_dict:
+                self.upsert(output_name, file_name, file_dict[file_name])
+                count += 1
+        self.flush()
+        return count
+
+    def partial_hash_collisions(self, partial_hashes=None):
+        """
+        Files without a full hash whose partial hash is the same as some other file's.
+        With partial_hashes, only the collisions of those partial hashes.
+        """
+        if partial_hashes is None:
+            return [(path_from_db(row[0]),) for row in
+                    self.query("SELECT path FROM files WHERE hash IS NULL AND partial_hash IN "
+                               "(SELECT partial_hash FROM files WHERE partial_hash IS NOT NULL "
+                               "GROUP BY partial_hash HAVING COUNT(*) > 1)")]
+        partial_hashes = list(set(partial_hashes))
+        collisions = []
+        # SQLite allows 999 parameters in older versions
+        for start in range(0, len(partial_hashes), 500):
+            batch = partial_hashes[start:start + 500]
+            collisions.extend(self.query("SELECT path FROM files WHERE hash IS NULL AND partial_hash IN "
+                                         "(SELECT partial_hash FROM files WHERE partial_hash IN (" +
+                                         ", ".join("?" * len(batch)) + ") "
+                                         "GROUP BY partial_hash HAVING COUNT(*) > 1)", batch))
+        return [(path_from_db(row[0]),) for row in collisions]
+
+    def load_date_tags(self):
+        """
+        :return: list of (path, category, date) + the date tags, for every file that has them
+        """
+        return [(path_from_db(row[0]),) + row[1:] for row in
+                self.query("SELECT files.path, category, date, " + DATE_TAG_COLUMNS +
+                           " FROM files JOIN date_tags ON date_tags.path = files.path")]
+
+    def update_dates(self, updates):
+        """
+        Move files to another category, with another date, in one transaction.
+        :param updates: (output_name, date, file_name) for each file
+        """
+        self.flush()
+        with self.connection:
+            self.connection.executemany("UPDATE files SET category = ?, date = ? WHERE path = ?",
+                                        [(output_name, date, path_to_db(file_name))
+                                         for output_name, date, file_name in updates])
+
+    def count_by_category(self):
+        return dict(self.query("SELECT category, COUNT(*) FROM files GROUP BY category"))
+
+    def query(self, sql, parameters=()):
+        """
+        Run a read-only query, eg.
+        store.query("SELECT path, date FROM files WHERE category = ? AND date LIKE ?", ("exif_date", "2014-%"))
+        """
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.flush()
+        self.connection.close()
+        self.connection = None
+
+
+class CatalogWriter:
+    """
+    Writes to a catalog from a thread of its own, so a scan doesn't wait on SQLite.
+
+    upsert(), delete(), update_hashes(), replace_directories() and flush() are the same
+    as CatalogStore's.
+    They're queued, and the thread applies them through a CatalogStore of its own
+    (an SQLite connection can't be shared between threads). When queue_size writes
+    are waiting, the caller waits too. flush() returns once everything before it
+    is committed. An error in the thread is raised by the next flush() or close().
+    """
+    def __init__(self, filename, batch_size=CATALOG_BATCH_SIZE, queue_size=WRITER_QUEUE_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="catalog writer " + filename)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        store = CatalogStore(self.filename, self.batch_size)
+        try:
+            while True:
+                operation, args = self._queue.get()
+                if operation is None:
+                    break
+                if self._error is not None:
+                    # Keep draining the queue so nobody waits forever
+                    if operation == "flush":
+                        args[0].set()
+                    continue
+                try:
+                    if operation == "flush":
+                        store.flush()
+                        args[0].set()
+                    else:
+                        getattr(store, operation)(*args)
+                except Exception as e:
+                    self._error = e
+                    if operation == "flush":
+                        args[0].set()
+        finally:
+            try:
+                store.close()
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def upsert(self, output_name, file_name, file_info_list):
+        self._queue.put(("upsert", (output_name, file_name, file_info_list.copy())))
+
+    def delete(self, file_name):
+        self._queue.put(("delete", (file_name,)))
+
+    def update_hashes(self, file_name, file_hash, partial_hash):
+        self._queue.put(("update_hashes", (file_name, file_hash, partial_hash)))
+
+    def replace_directories(self, directory_mtimes):
+        self._queue.put(("replace_directories", (dict(directory_mtimes),)))
+
+    def flush(self):
+        done = threading.Event()
+        self._queue.put(("flush", (done,)))
+        done.wait()
+        self._check()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put((None, None))
+        self._thread.join()
+        self._thread = None
+        self._check()
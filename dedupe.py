@@ -0,0 +1,196 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import collections
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+
+from catalog_store import CatalogStore, read_manifest, path_from_db
+from hashing import hash_file, partial_hash_file, HASH_ALGORITHM, PARTIAL_HASH_SIZE
+
+log = logging.getLogger(__name__)
+
+DuplicateFile = collections.namedtuple("DuplicateFile", "path date category catalog")
+DuplicateSet = collections.namedtuple("DuplicateSet", "size hash files")
+
+# Positions in the rows read from the catalogs
+ROW_SIZE = 0
+ROW_PATH = 1
+ROW_CATEGORY = 2
+ROW_DATE = 3
+ROW_PARTIAL_HASH = 4
+ROW_HASH = 5
+ROW_CATALOG = 6
+
+
+class DuplicateFinder:
+    """
+    Finds files with the same contents in one or more rummage catalogs.
+
+    Files are bucketed by size first, then by partial hash, then by full hash,
+    so only files that could still be duplicates are read. Hashes already in a
+    catalog are used when they were made with the same hash_algorithm (and
+    partial_hash_size); the ones worked out here are written back, so the next
+    run doesn't read the files again.
+
+    The catalogs are read in order of size and merged, so only one size bucket
+    is held in memory at a time.
+    """
+    def __init__(self, catalog_files, hash_algorithm=HASH_ALGORITHM, partial_hash_size=PARTIAL_HASH_SIZE,
+                 min_size=1, update_catalogs=True):
+        self.catalog_files = list(catalog_files)
+        self.hash_algorithm = hash_algorithm
+        self.partial_hash_size = partial_hash_size
+        self.min_size = min_size
+        self.update_catalogs = update_catalogs
+        self._stores = []
+        self._usable_hashes = []
+        for catalog_file in self.catalog_files:
+            store = CatalogStore(catalog_file)
+            # Catalogs from before hashes were configurable have sha1 hashes
+            stored_algorithm = store.get_meta("hash_algorithm") or "sha1"
+            stored_partial_size = store.get_meta("partial_hash_size") or str(PARTIAL_HASH_SIZE)
+            same_algorithm = stored_algorithm == hash_algorithm
+            self._usable_hashes.append((same_algorithm,
+                                        same_algorithm and stored_partial_size == str(partial_hash_size)))
+            self._stores.append(store)
+
+    def close(self):
+        for store in self._stores:
+            store.close()
+        self._stores = []
+
+    def _rows(self, catalog_index):
+        # A connection of its own, so hashes can be written back while this is being read.
+        connection = sqlite3.connect(self.catalog_files[catalog_index])
+        try:
+            cursor = connection.execute("SELECT size, path, category, date, partial_hash, hash FROM files "
+                                        "WHERE size >= ? ORDER BY size", (self.min_size,))
+            full_hash_usable, partial_hash_usable = self._usable_hashes[catalog_index]
+            for size, path, category, date, partial_hash, file_hash in cursor:
+                yield [size, path_from_db(path), category, date, partial_hash if partial_hash_usable else None,
+                       file_hash if full_hash_usable else None, catalog_index]
+        finally:
+            connection.close()
+
+    def size_buckets(self):
+        """
+        Yield (size, rows) for every size that more than one file has.
+        A file that's in more than one catalog only counts once.
+        """
+        rows = heapq.merge(*[self._rows(index) for index in range(len(self.catalog_files))],
+                           key=lambda row: row[ROW_SIZE])
+        for size, bucket in itertools.groupby(rows, key=lambda row: row[ROW_SIZE]):
+            by_path = collections.OrderedDict()
+            for row in bucket:
+                if row[ROW_PATH] not in by_path:
+                    by_path[row[ROW_PATH]] = row
+            if len(by_path) > 1:
+                yield size, list(by_path.values())
+
+    def _partial_hash(self, row):
+        if row[ROW_PARTIAL_HASH] is None:
+            row[ROW_PARTIAL_HASH], full_hash = partial_hash_file(row[ROW_PATH], row[ROW_SIZE],
+                                                                 self.hash_algorithm, self.partial_hash_size)
+            if full_hash is not None:
+                row[ROW_HASH] = full_hash
+            self._write_back(row)
+        return row[ROW_PARTIAL_HASH]
+
+    def _full_hash(self, row):
+        if row[ROW_HASH] is None:
+            row[ROW_HASH] = hash_file(row[ROW_PATH], self.hash_algorithm)
+            self._write_back(row)
+        return row[ROW_HASH]
+
+    def _write_back(self, row):
+        if not self.update_catalogs:
+            return
+        full_hash_usable, partial_hash_usable = self._usable_hashes[row[ROW_CATALOG]]
+        self._stores[row[ROW_CATALOG]].update_hashes(row[ROW_PATH],
+                                                     row[ROW_HASH] if full_hash_usable else None,
+                                                     row[ROW_PARTIAL_HASH] if partial_hash_usable else None)
+
+    def _group(self, rows, get_key):
+        groups = collections.OrderedDict()
+        for row in rows:
+            try:
+                key = get_key(row)
+            except (IOError, OSError) as e:
+                log.error("can't hash %s %s", row[ROW_PATH], e)
+                continue
+            groups.setdefault(key, []).append(row)
+        return [(key, group) for key, group in groups.items() if len(group) > 1]
+
+    def duplicates(self):
+        """
+        Yield a DuplicateSet for each set of files with the same contents.
+        """
+        for size, bucket in self.size_buckets():
+            for partial_hash, partial_group in self._group(bucket, self._partial_hash):
+                for file_hash, group in self._group(partial_group, self._full_hash):
+                    files = [DuplicateFile(row[ROW_PATH], row[ROW_DATE], row[ROW_CATEGORY],
+                                           self.catalog_files[row[ROW_CATALOG]]) for row in group]
+                    yield DuplicateSet(size, file_hash, files)
+        for store in self._stores:
+            store.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def manifest_catalogs():
+    """
+    The catalogs listed in the manifest that are still there.
+    """
+    catalog_files = []
+    for directory, catalog_file in read_manifest() or []:
+        if not os.path.exists(catalog_file):
+            log.warning("%s in manifest, but not on system.", catalog_file)
+        elif not catalog_file.endswith(".db"):
+            log.warning("%s is a pickle, rummage %s again to convert it.", catalog_file, directory)
+        else:
+            catalog_files.append(catalog_file)
+    return catalog_files
+
+
+def print_duplicates(duplicate_sets):
+    """
+    :return: (number of sets, bytes taken by the extra copies)
+    """
+    count = 0
+    wasted = 0
+    for duplicate_set in duplicate_sets:
+        count += 1
+        wasted += duplicate_set.size * (len(duplicate_set.files) - 1)
+        print("DUPLICATES:", len(duplicate_set.files), "files of", duplicate_set.size, "bytes",
+              duplicate_set.hash)
+        for duplicate_file in duplicate_set.files:
+            print("   ", duplicate_file.date, duplicate_file.path)
+    return count, wasted
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Find duplicate files in rummage catalogs.")
+    parser.add_argument("catalogs", nargs="*", help="catalog files (default: everything in the manifest)")
+    parser.add_argument("--hash-algorithm", default=HASH_ALGORITHM,
+                        help="any algorithm hashlib knows, eg. blake2b (default: %(default)s)")
+    parser.add_argument("--partial-hash-kb", type=int, default=PARTIAL_HASH_SIZE // 1024,
+                        help="KB read from each end of a file for a partial hash (default: %(default)s)")
+    parser.add_argument("--min-size", type=int, default=1,
+                        help="ignore files smaller than this many bytes (default: %(default)s)")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    catalogs = args.catalogs or manifest_catalogs()
+    with DuplicateFinder(catalogs, hash_algorithm=args.hash_algorithm,
+                         partial_hash_size=args.partial_hash_kb * 1024, min_size=args.min_size) as finder:
+        count, wasted = print_duplicates(finder.duplicates())
+    print("SETS:", count, "EXTRA BYTES:", wasted)
@@ -0,0 +1,357 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import datetime
+import os
+import struct
+
+import file_types
+
+# The most we read from one file looking for dates
+HEADER_READ_LIMIT = 256 * 1024
+
+# The most boxes we look at in an MP4/MOV/HEIC file, at all levels
+MAX_BOXES = 512
+
+# Boxes bigger than this aren't read into memory (iinf, iloc)
+MAX_BOX_READ = 64 * 1024
+
+TAG_EXIF_IFD = 0x8769
+TAG_NAMES = {
+    0x0132: "DateTime",
+    0x9003: "DateTimeOriginal",
+    0x9004: "DateTimeDigitized",
+}
+TIFF_ASCII = 2
+
+JPEG_APP1 = 0xE1
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+EXIF_HEADER = b"Exif\x00\x00"
+
+# Seconds in MP4/MOV headers count from here
+QUICKTIME_EPOCH = datetime.datetime(1904, 1, 1)
+# What exiftool says for a creation time of 0, which do_exif counts as an unrecognized entry
+NO_QUICKTIME_DATE = "0000:00:00 00:00:00"
+
+
+class HeaderError(Exception):
+    """
+    The header isn't what we expected, or we'd have to read too much of it.
+    """
+    pass
+
+
+class LimitedReader:
+    """
+    A file that refuses to hand out more than limit bytes in total.
+    """
+    def __init__(self, fp, limit):
+        self.fp = fp
+        self.limit = limit
+        self.bytes_read = 0
+        self.size = os.fstat(fp.fileno()).st_size
+
+    def read_at(self, offset, length):
+        if offset < 0 or length < 0 or offset + length > self.size:
+            raise HeaderError("read past the end of the file")
+        if self.bytes_read + length > self.limit:
+            raise HeaderError("read limit reached")
+        self.fp.seek(offset)
+        data = self.fp.read(length)
+        self.bytes_read += len(data)
+        if len(data) < length:
+            raise HeaderError("short read")
+        return data
+
+
+class BytesRegion:
+    """
+    get(offset, length) on bytes we already have, eg. a JPEG APP1 segment.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, offset, length):
+        if offset < 0 or offset + length > len(self.data):
+            raise HeaderError("offset outside the segment")
+        return self.data[offset:offset + length]
+
+
+class FileRegion:
+    """
+    get(offset, length) relative to base in a file, eg. TIFF offsets in a raw file.
+    """
+    def __init__(self, reader, base):
+        self.reader = reader
+        self.base = base
+
+    def get(self, offset, length):
+        return self.reader.read_at(self.base + offset, length)
+
+
+def read_header_dates(filename, limit=HEADER_READ_LIMIT, file_type=None):
+    """
+    Find the date tags of a JPEG, TIFF (and the raw formats built on it), HEIC/HEIF
+    or MP4/MOV file by reading only its headers, at most limit bytes.
+    file_type is what file_types.sniff() said, if that's already known.
+
+    :return: a dictionary with the ones of "DateTime", "DateTimeOriginal",
+             "DateTimeDigitized" and "MediaCreateDate" that were found, as exif-style
+             "YYYY:MM:DD HH:MM:SS" strings. None if the file isn't one of these formats,
+             or nothing was found, or it would mean reading more than limit bytes;
+             then it's up to Pillow and exiftool.
+    """
+    try:
+        with open(filename, "rb") as fp:
+            reader = LimitedReader(fp, limit)
+            if file_type is None:
+                file_type = file_types.sniff_bytes(reader.read_at(0, min(file_types.SNIFF_SIZE, reader.size)))
+            if file_type == file_types.JPEG:
+                dates = jpeg_dates(reader)
+            elif file_type == file_types.TIFF:
+                dates = tiff_dates(FileRegion(reader, 0))
+            elif file_type in (file_types.HEIF, file_types.MP4, file_types.QUICKTIME, file_types.CR3):
+                dates = isobmff_dates(reader)
+            else:
+                return None
+    except (HeaderError, struct.error, IOError, OSError, ValueError, OverflowError):
+        return None
+    return dates or None
+
+
+def jpeg_dates(reader):
+    """
+    Walk the JPEG markers up to the image data, looking for an Exif APP1 segment.
+    """
+    offset = 2
+    while True:
+        marker = reader.read_at(offset, 2)
+        if marker[0] != 0xFF:
+            raise HeaderError("lost in the JPEG markers")
+        if marker[1] == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        offset += 2
+        if marker[1] in (JPEG_SOS, JPEG_EOI):
+            return None
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD8:
+            # markers without a length
+            continue
+        length = struct.unpack(">H", reader.read_at(offset, 2))[0]
+        if marker[1] == JPEG_APP1 and length >= 8 and reader.read_at(offset + 2, 6) == EXIF_HEADER:
+            return tiff_dates(BytesRegion(reader.read_at(offset + 8, length - 8)))
+        offset += length
+
+
+def tiff_dates(region):
+    """
+    The date tags in IFD0 and the Exif IFD of a TIFF structure. Later ones win, as in Pillow.
+    """
+    order = region.get(0, 2)
+    if order == b"II":
+        endian = "<"
+    elif order == b"MM":
+        endian = ">"
+    else:
+        raise HeaderError("not a TIFF header")
+    if struct.unpack(endian + "H", region.get(2, 2))[0] != 42:
+        raise HeaderError("not a TIFF header")
+    dates = {}
+    exif_ifd = read_ifd(region, endian, struct.unpack(endian + "I", region.get(4, 4))[0], dates)
+    if exif_ifd:
+        read_ifd(region, endian, exif_ifd, dates)
+    return dates
+
+
+def read_ifd(region, endian, offset, dates):
+    """
+    Add the date tags of one IFD to dates.
+    :return: the offset of the Exif IFD, if this IFD points to one
+    """
+    count = struct.unpack(endian + "H", region.get(offset, 2))[0]
+    entries = region.get(offset + 2, 12 * count)
+    exif_ifd = None
+    for i in range(count):
+        entry = entries[12 * i:12 * i + 12]
+        tag, tag_type, length = struct.unpack(endian + "HHI", entry[:8])
+        if tag == TAG_EXIF_IFD:
+            exif_ifd = struct.unpack(endian + "I", entry[8:12])[0]
+        elif tag in TAG_NAMES and tag_type == TIFF_ASCII:
+            if length <= 4:
+                value = entry[8:8 + length]
+            else:
+                value = region.get(struct.unpack(endian + "I", entry[8:12])[0], length)
+            dates[TAG_NAMES[tag]] = value.rstrip(b"\x00").decode("ascii", "replace")
+    return exif_ifd
+
+
+def boxes(reader, start, end, budget):
+    """
+    Yield (type, payload start, box end) for the ISO base media boxes between start and end.
+    budget is a one element list counting down the boxes we're still willing to look at.
+    """
+    offset = start
+    while offset + 8 <= end:
+        budget[0] -= 1
+        if budget[0] < 0:
+            raise HeaderError("too many boxes")
+        size, box_type = struct.unpack(">I4s", reader.read_at(offset, 8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", reader.read_at(offset + 8, 8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise HeaderError("bad box size")
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def quicktime_date(seconds):
+    if seconds == 0:
+        return NO_QUICKTIME_DATE
+    return (QUICKTIME_EPOCH + datetime.timedelta(seconds=seconds)).strftime("%Y:%m:%d %H:%M:%S")
+
+
+def header_creation_time(reader, start):
+    """
+    The creation time of an mvhd or mdhd box, whose payload starts at start.
+    """
+    version = reader.read_at(start, 1)[0]
+    if version == 1:
+        return struct.unpack(">Q", reader.read_at(start + 4, 8))[0]
+    return struct.unpack(">I", reader.read_at(start + 4, 4))[0]
+
+
+def isobmff_dates(reader):
+    """
+    MP4/MOV: MediaCreateDate from the first track's mdhd, as exiftool has it, or from
+    mvhd if there's no track. HEIC/HEIF: the Exif item in the top level meta box.
+    """
+    dates = {}
+    budget = [MAX_BOXES]
+    for box_type, start, end in boxes(reader, 0, reader.size, budget):
+        if box_type == b"moov":
+            movie_time = None
+            media_time = None
+            for child_type, child_start, child_end in boxes(reader, start, end, budget):
+                if child_type == b"mvhd":
+                    movie_time = header_creation_time(reader, child_start)
+                elif child_type == b"trak" and media_time is None:
+                    media_time = track_creation_time(reader, child_start, child_end, budget)
+            creation_time = media_time if media_time is not None else movie_time
+            if creation_time is not None:
+                dates["MediaCreateDate"] = quicktime_date(creation_time)
+        elif box_type == b"meta":
+            dates.update(heif_exif_dates(reader, start, end, budget))
+    return dates
+
+
+def track_creation_time(reader, start, end, budget):
+    for box_type, box_start, box_end in boxes(reader, start, end, budget):
+        if box_type == b"mdia":
+            for child_type, child_start, child_end in boxes(reader, box_start, box_end, budget):
+                if child_type == b"mdhd":
+                    return header_creation_time(reader, child_start)
+    return None
+
+
+def read_box(reader, start, end):
+    if end - start > MAX_BOX_READ:
+        raise HeaderError("box too big")
+    return reader.read_at(start, end - start)
+
+
+def heif_exif_dates(reader, start, end, budget):
+    """
+    Find the Exif item through iinf, find where it is through iloc, and read its TIFF dates.
+    """
+    exif_item = None
+    locations = {}
+    # meta is a full box: 4 bytes of version and flags before its children
+    for box_type, box_start, box_end in boxes(reader, start + 4, end, budget):
+        if box_type == b"iinf":
+            exif_item = heif_exif_item(reader, box_start, box_end, budget)
+        elif box_type == b"iloc":
+            locations = heif_item_locations(read_box(reader, box_start, box_end))
+    if exif_item is None or exif_item not in locations:
+        return {}
+    offset = locations[exif_item]
+    # The item starts with the offset of the TIFF header from the end of that field
+    tiff_offset = struct.unpack(">I", reader.read_at(offset, 4))[0]
+    return tiff_dates(FileRegion(reader, offset + 4 + tiff_offset))
+
+
+def heif_exif_item(reader, start, end, budget):
+    version = reader.read_at(start, 1)[0]
+    first_entry = start + (6 if version == 0 else 8)
+    for box_type, box_start, box_end in boxes(reader, first_entry, end, budget):
+        if box_type != b"infe":
+            continue
+        infe = read_box(reader, box_start, box_end)
+        infe_version = infe[0]
+        if infe_version == 2:
+            item_id, item_type = struct.unpack(">H2x4s", infe[4:12])
+        elif infe_version == 3:
+            item_id, item_type = struct.unpack(">I2x4s", infe[4:14])
+        else:
+            continue
+        if item_type == b"Exif":
+            return item_id
+    return None
+
+
+def heif_item_locations(iloc):
+    """
+    :return: dictionary of item id to the file offset of its first extent.
+             Items stored any other way than at a file offset are left out.
+    """
+    def number(position, size):
+        if size == 0:
+            return 0, position
+        if size == 4:
+            return struct.unpack(">I", iloc[position:position + 4])[0], position + 4
+        if size == 8:
+            return struct.unpack(">Q", iloc[position:position + 8])[0], position + 8
+        raise HeaderError("bad iloc field size")
+
+    version = iloc[0]
+    offset_size = iloc[4] >> 4
+    length_size = iloc[4] & 0x0F
+    base_offset_size = iloc[5] >> 4
+    index_size = iloc[5] & 0x0F if version in (1, 2) else 0
+    position = 6
+    if version < 2:
+        item_count = struct.unpack(">H", iloc[position:position + 2])[0]
+        position += 2
+    else:
+        item_count = struct.unpack(">I", iloc[position:position + 4])[0]
+        position += 4
+    locations = {}
+    for i in range(item_count):
+        if version < 2:
+            item_id = struct.unpack(">H", iloc[position:position + 2])[0]
+            position += 2
+        else:
+            item_id = struct.unpack(">I", iloc[position:position + 4])[0]
+            position += 4
+        construction_method = 0
+        if version in (1, 2):
+            construction_method = struct.unpack(">H", iloc[position:position + 2])[0] & 0x0F
+            position += 2
+        # data_reference_index
+        position += 2
+        base_offset, position = number(position, base_offset_size)
+        extent_count = struct.unpack(">H", iloc[position:position + 2])[0]
+        position += 2
+        for extent in range(extent_count):
+            if index_size:
+                extent_index, position = number(position, index_size)
+            extent_offset, position = number(position, offset_size)
+            extent_length, position = number(position, length_size)
+            if extent == 0 and construction_method == 0:
+                locations[item_id] = base_offset + extent_offset
+    return locations
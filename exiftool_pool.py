@@ -0,0 +1,344 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+EXIFTOOL = "/usr/bin/exiftool"
+
+# How long to wait for a worker to exit after asking it nicely
+SHUTDOWN_TIMEOUT = 5
+
+# Bytes read from a worker's pipes at a time
+READ_SIZE = 64 * 1024
+
+# What check_pool() runs the pool against. What it does for a file depends on its name.
+EXIFTOOL_STUB = '''#!%(python)s
+# Answers like exiftool -stay_open for exiftool_pool.py: a JSON entry for each file,
+# with the stub's pid, no newline before the sentinel. crash_once exits the first
+# time, hang never answers, chatty fills stderr, flood fills stdout.
+import json, os, sys, time
+
+args = []
+for line in sys.stdin.buffer:
+    line = line.rstrip(b"\\n")
+    if line == b"False":
+        break
+    if not line.startswith(b"-execute"):
+        args.append(line)
+        continue
+    ready = args[args.index(b"-echo4") + 1]
+    names = [arg for arg in args if not arg.startswith(b"-") and arg != ready]
+    args = []
+    for name in names:
+        base = os.path.basename(name)
+        if base == b"crash_once" and not os.path.exists(name):
+            open(name, "w").close()
+            sys.exit(3)
+        if base == b"hang":
+            time.sleep(600)
+        if base == b"chatty":
+            sys.stderr.buffer.write(b"Warning: can't read it\\n" * 100000)
+        if base == b"flood":
+            sys.stdout.buffer.write(b"x" * 100000)
+    entries = [{"SourceFile": os.fsdecode(name), "pid": os.getpid()} for name in names]
+    sys.stdout.buffer.write(json.dumps(entries).encode("utf-8") + ready + b"\\n")
+    sys.stdout.flush()
+    sys.stderr.buffer.write(ready + b"\\n")
+    sys.stderr.flush()
+'''
+
+
+class ExiftoolError(Exception):
+    """
+    Raised when an exiftool worker dies or its output can't be framed.
+    """
+    pass
+
+
+class ExiftoolLimitError(ExiftoolError):
+    """
+    Raised when an exiftool command takes longer than its timeout, or writes more than
+    its max_output. The worker is killed, and started again for the next command.
+    """
+    pass
+
+
+class ExiftoolArgumentError(ExiftoolError):
+    """
+    Raised, before anything is sent, for an argument with a line break in it. exiftool
+    reads its arguments one per line, so the rest would be taken as more arguments:
+    a file could be named to look like options (eg. "-all=").
+    """
+    pass
+
+
+def check_argument(arg):
+    """
+    :raises ExiftoolArgumentError: if arg can't be given to exiftool as one argument
+    """
+    if "\n" in arg or "\r" in arg:
+        raise ExiftoolArgumentError("exiftool can't be given a name with a line break in it: " + repr(arg))
+
+
+class ExiftoolWorker:
+    """
+    One long-lived exiftool process, started with "-stay_open True -@ -".
+
+    Arguments are written to its stdin one per line (see check_argument()) and
+    terminated by "-execute<n>". They're encoded as os.fsencode() would, so names
+    that aren't valid UTF-8 get to exiftool as they are on disk. exiftool writes
+    the normal output to stdout followed by a "{ready<n>}" line. We also pass
+    "-echo4 {ready<n>}" so that stderr carries the same sentinel once the
+    command is finished, which lets us read both
+    pipes without guessing. Both are read as output arrives; reading one to
+    the end before the other would deadlock once exiftool filled the other's
+    pipe buffer (eg. with warnings about a batch of unreadable files). It
+    also means a command can be given up on after timeout seconds, or once
+    it's written more than max_output bytes, without waiting on a worker
+    that's stuck.
+    """
+    def __init__(self, executable=EXIFTOOL):
+        self.executable = executable
+        self.process = None
+        self.sequence = 0
+
+    def start(self):
+        args = [self.executable, "-stay_open", "True", "-@", "-"]
+        self.process = subprocess.Popen(args=args, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, args, timeout=None, max_output=None):
+        """
+        Run one exiftool command in this worker.
+        :param args: list of exiftool arguments, eg. ["-j", "/some/file.jpg"]
+        :param timeout: seconds the command may take, None for no limit
+        :param max_output: bytes the command may write to each of stdout and stderr, None for no limit
+        :return: a (stdout, stderr) pair of strings
+        :raises ExiftoolLimitError: if it goes over either
+        :raises ExiftoolArgumentError: if one of args has a line break in it
+        """
+        for arg in args:
+            check_argument(arg)
+        if not self.running():
+            self.start()
+        self.sequence += 1
+        ready = "{ready" + str(self.sequence) + "}"
+        lines = list(args) + ["-echo4", ready, "-execute" + str(self.sequence)]
+        try:
+            self.process.stdin.write(("\n".join(lines) + "\n").encode("utf-8", "surrogateescape"))
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise ExiftoolError("exiftool worker went away: " + str(e))
+        output, error = self._read_until(ready, timeout, max_output)
+        return output, error
+
+    def _read_until(self, sentinel, timeout, max_output):
+        """
+        Read stdout and stderr until each has ended with a line ending in sentinel.
+        :return: what came before the sentinel on each, as strings
+        """
+        sentinel = sentinel.encode("utf-8")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        buffers = {self.process.stdout.fileno(): bytearray(), self.process.stderr.fileno(): bytearray()}
+        waiting = set(buffers)
+        while waiting:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    self.kill()
+                    raise ExiftoolLimitError("exiftool took more than " + str(timeout) + " seconds")
+            readable, writable, failed = select.select(list(waiting), [], [], wait)
+            for fd in readable:
+                data = os.read(fd, READ_SIZE)
+                if not data:
+                    raise ExiftoolError("exiftool worker closed its output")
+                buffer = buffers[fd]
+                buffer += data
+                if max_output is not None and len(buffer) > max_output + len(sentinel) + 2:
+                    self.kill()
+                    raise ExiftoolLimitError("exiftool wrote more than " + str(max_output) + " bytes")
+                # exiftool may not put a newline before the sentinel
+                if buffer.endswith(b"\n") and buffer.rstrip().endswith(sentinel):
+                    waiting.discard(fd)
+        return tuple(bytes(buffers[stream.fileno()].rstrip()[:-len(sentinel)]).decode("utf-8", "replace")
+                     for stream in (self.process.stdout, self.process.stderr))
+
+    def kill(self):
+        """
+        Stop the worker without waiting for it to finish what it's doing.
+        """
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        self.process = None
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(b"-stay_open\nFalse\n")
+                self.process.stdin.flush()
+                self.process.stdin.close()
+                self.process.wait(timeout=SHUTDOWN_TIMEOUT)
+            except (IOError, OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        self.process = None
+
+
+class ExiftoolPool:
+    """
+    A fixed number of ExiftoolWorker's shared between threads.
+
+    Workers are started the first time they're needed. A worker that crashes
+    while running a command is restarted and the command is tried once more
+    before the error is passed to the caller. A command that goes over its
+    timeout or max_output isn't tried again; it would only do the same.
+    """
+    def __init__(self, size=1, executable=EXIFTOOL):
+        if size < 1:
+            raise ValueError("exiftool pool needs at least one worker")
+        self.executable = executable
+        self.size = size
+        self._workers = [ExiftoolWorker(executable) for i in range(size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def execute(self, args, timeout=None, max_output=None):
+        if self._closed:
+            raise ExiftoolError("exiftool pool is shut down")
+        worker = self._idle.get()
+        try:
+            try:
+                return worker.execute(args, timeout, max_output)
+            except (ExiftoolLimitError, ExiftoolArgumentError):
+                raise
+            except ExiftoolError as e:
+                log.error("restarting exiftool worker: %s", e)
+                worker.stop()
+                return worker.execute(args, timeout, max_output)
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for worker in self._workers:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+def _raises(exception, function, *args, **kwargs):
+    try:
+        function(*args, **kwargs)
+    except exception:
+        return True
+    return False
+
+
+def check_pool(directory):
+    """
+    Run an ExiftoolPool against EXIFTOOL_STUB, written to directory, through each way a
+    command can go: output framed by {ready<n>}, a full stderr, a worker that crashes,
+    one that hangs or writes too much, an argument with a line break, and shutdown.
+    :return: list of (what was checked, True if it worked)
+    """
+    stub = os.path.join(directory, "exiftool_stub")
+    with open(stub, "w") as f:
+        f.write(EXIFTOOL_STUB % {"python": sys.executable})
+    os.chmod(stub, 0o755)
+
+    def source_files(output):
+        return [entry["SourceFile"] for entry in json.loads(output)]
+
+    def pid(pool):
+        return json.loads(pool.execute(["-j", "pid.jpg"])[0])[0]["pid"]
+
+    results = []
+    pool = ExiftoolPool(1, stub)
+    try:
+        first = pool.execute(["-j", "first.jpg"])
+        second = pool.execute(["-j", "second.jpg", "third.jpg"])
+        results.append(("framing", source_files(first[0]) == ["first.jpg"] and
+                        source_files(second[0]) == ["second.jpg", "third.jpg"] and first[1] == second[1] == ""))
+        started_pid = pid(pool)
+        output, error = pool.execute(["-j", os.path.join(directory, "chatty")])
+        results.append(("stderr read alongside stdout", error.count("Warning") == 100000))
+        crash_once = os.path.join(directory, "crash_once")
+        output, error = pool.execute(["-j", crash_once])
+        results.append(("restart after a crash", source_files(output) == [crash_once] and
+                        pid(pool) != started_pid))
+        started = time.time()
+        timed_out = _raises(ExiftoolLimitError, pool.execute, ["-j", "hang"], timeout=1)
+        results.append(("timeout kills the worker", timed_out and time.time() - started < SHUTDOWN_TIMEOUT and
+                        source_files(pool.execute(["-j", "after.jpg"])[0]) == ["after.jpg"]))
+        results.append(("max_output kills the worker",
+                        _raises(ExiftoolLimitError, pool.execute, ["-j", "flood"], max_output=1000) and
+                        source_files(pool.execute(["-j", "after.jpg"])[0]) == ["after.jpg"]))
+        before_pid = pid(pool)
+        results.append(("line break refused", _raises(ExiftoolArgumentError, pool.execute, ["-j", "a\n-all="]) and
+                        pid(pool) == before_pid))
+        processes = [worker.process for worker in pool._workers]
+    finally:
+        pool.shutdown()
+    results.append(("shutdown", all(process.poll() is not None for process in processes) and
+                    _raises(ExiftoolError, pool.execute, ["-j", "late.jpg"])))
+    return results
+
+
+if __name__=="__main__":
+    import argparse
+    import shutil
+    import tempfile
+    parser = argparse.ArgumentParser(description="Check the exiftool pool against a stub exiftool, "
+                                                 "so exiftool needn't be installed.")
+    parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    work_directory = tempfile.mkdtemp(prefix="exiftool_pool_check_")
+    try:
+        results = check_pool(work_directory)
+    finally:
+        shutil.rmtree(work_directory)
+    for check, passed in results:
+        print("%-32s %s" % (check, "ok" if passed else "FAILED"))
+    sys.exit(0 if all(passed for check, passed in results) else 1)
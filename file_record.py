@@ -0,0 +1,262 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import datetime
+import math
+import os
+import struct
+import sys
+
+# mtime_ns, size, inode, device, mode
+STAT_FIELDS = struct.Struct("<qqQQI")
+
+DATE_LENGTH = len("2014-06-24 10:00:00")
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Strings no longer than this that aren't dates ("Ignored", "None" and the like) are interned
+INTERN_LENGTH = 32
+
+
+def mtime_from_ns(mtime_ns):
+    """
+    :return: st_mtime as os.stat() works it out from st_mtime_ns, to the last bit
+    """
+    seconds, nanoseconds = divmod(mtime_ns, 1000000000)
+    return seconds + nanoseconds * 1e-9
+
+
+def mtime_ns_from_float(mtime):
+    """
+    Catalogs and pickles from older versions only have the float mtime. Find an mtime_ns that
+    mtime_from_ns() turns back into exactly that float, so the file still compares as unchanged.
+    """
+    seconds = int(math.floor(mtime))
+    nanoseconds = int(round((mtime - seconds) * 1e9))
+    for delta in range(512):
+        for candidate in (nanoseconds - delta, nanoseconds + delta):
+            if 0 <= candidate < 1000000000 and seconds + candidate * 1e-9 == mtime:
+                return seconds * 1000000000 + candidate
+    return seconds * 1000000000 + nanoseconds
+
+
+def pack_date(date):
+    """
+    :param date: the date string of a file, eg. "2014-06-24 10:00:00", or one of the notices
+                 (eg. "Ignored") that are kept instead
+    :return: seconds since 0001-01-01 for a date, otherwise the string (interned if it's short)
+    """
+    if (len(date) == DATE_LENGTH and date[4] == "-" and date[7] == "-" and date[10] == " " and
+            date[13] == ":" and date[16] == ":"):
+        try:
+            day = datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+            hour, minute, second = int(date[11:13]), int(date[14:16]), int(date[17:19])
+        except ValueError:
+            return date
+        if hour < 24 and minute < 60 and second < 60:
+            return ((day.toordinal() - 1) * SECONDS_PER_DAY + hour * 3600 + minute * 60 + second)
+    if len(date) <= INTERN_LENGTH:
+        return sys.intern(date)
+    return date
+
+
+def unpack_date(packed):
+    if not isinstance(packed, int):
+        return packed
+    days, seconds = divmod(packed, SECONDS_PER_DAY)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return "%s %02d:%02d:%02d" % (datetime.date.fromordinal(days + 1).isoformat(), hour, minute, second)
+
+
+def pack_hash(file_hash):
+    """
+    :return: a hex digest as raw bytes, None for no hash
+    """
+    if not file_hash:
+        return None
+    try:
+        return bytes.fromhex(file_hash)
+    except (TypeError, ValueError):
+        return file_hash
+
+
+def unpack_hash(packed):
+    if isinstance(packed, bytes):
+        return packed.hex()
+    return packed
+
+
+class FileRecord:
+    """
+    What a Rummage knows about one file, in a fraction of the memory of the
+    [stat, date string, hash, partial hash] list it used to keep.
+
+    Only the parts of the stat that are used (mtime_ns, size, inode, device and
+    mode) are kept, packed into one bytes object. A date is kept as seconds since
+    0001-01-01, and hashes as raw bytes. category is the output_name (eg.
+    "exif_date") the file is stored under.
+
+    It still works like the list: record[0] is an os.stat_result, record[1] the
+    date string, record[2] and record[3] the hex digests (or None), and each can
+    be assigned to. So exif_dates_dict looks the same as it always has.
+    """
+    __slots__ = ("category", "tags", "_stat", "_date", "_hash", "_partial_hash")
+
+    def __init__(self, file_stat, date="", file_hash=None, partial_hash=None, category=None):
+        self.category = category
+        self.tags = None
+        self.stat = file_stat
+        self.date = date
+        self._hash = pack_hash(file_hash)
+        self._partial_hash = pack_hash(partial_hash)
+
+    @classmethod
+    def from_list(cls, file_info_list, category=None):
+        """
+        :param file_info_list: [stat, date string, hash, partial hash]. Pickles from older versions
+                               don't have the partial hash.
+        """
+        if isinstance(file_info_list, cls):
+            if category is not None:
+                file_info_list.category = category
+            return file_info_list
+        partial_hash = file_info_list[3] if len(file_info_list) > 3 else None
+        return cls(file_info_list[0], file_info_list[1], file_info_list[2], partial_hash, category)
+
+    @classmethod
+    def from_row(cls, category, mtime, mtime_ns, size, inode, device, mode, date, file_hash, partial_hash):
+        """
+        A record from a catalog row. Rows from older versions don't have mtime_ns.
+        """
+        record = cls.__new__(cls)
+        record.category = sys.intern(category)
+        record.tags = None
+        if mtime_ns is None:
+            mtime_ns = mtime_ns_from_float(mtime)
+        record._stat = STAT_FIELDS.pack(mtime_ns, size, inode, device, mode)
+        record.date = date
+        record._hash = pack_hash(file_hash)
+        record._partial_hash = pack_hash(partial_hash)
+        return record
+
+    def copy(self):
+        record = FileRecord.__new__(FileRecord)
+        record.category = self.category
+        record.tags = self.tags
+        record._stat = self._stat
+        record._date = self._date
+        record._hash = self._hash
+        record._partial_hash = self._partial_hash
+        return record
+
+    def stat_fields(self):
+        """
+        :return: (mtime_ns, size, inode, device, mode)
+        """
+        return STAT_FIELDS.unpack(self._stat)
+
+    @property
+    def mtime_ns(self):
+        return STAT_FIELDS.unpack(self._stat)[0]
+
+    @property
+    def mtime(self):
+        return mtime_from_ns(self.mtime_ns)
+
+    @property
+    def size(self):
+        return STAT_FIELDS.unpack(self._stat)[1]
+
+    @property
+    def stat(self):
+        """
+        Enough of an os.stat_result for Rummage.compare_stats() and friends.
+        """
+        mtime_ns, size, inode, device, mode = STAT_FIELDS.unpack(self._stat)
+        mtime = mtime_from_ns(mtime_ns)
+        whole_mtime = int(mtime)
+        return os.stat_result((mode, inode, device, 0, 0, 0, size, whole_mtime, whole_mtime, whole_mtime),
+                              {"st_mtime": mtime, "st_mtime_ns": mtime_ns})
+
+    @stat.setter
+    def stat(self, file_stat):
+        mtime_ns = getattr(file_stat, "st_mtime_ns", None)
+        if mtime_ns is None:
+            mtime_ns = mtime_ns_from_float(file_stat.st_mtime)
+        self._stat = STAT_FIELDS.pack(mtime_ns, file_stat.st_size, file_stat.st_ino, file_stat.st_dev,
+                                      file_stat.st_mode)
+
+    @property
+    def date(self):
+        return unpack_date(self._date)
+
+    @date.setter
+    def date(self, date):
+        self._date = pack_date(date) if isinstance(date, str) else date
+
+    @property
+    def hash(self):
+        return unpack_hash(self._hash)
+
+    @hash.setter
+    def hash(self, file_hash):
+        self._hash = pack_hash(file_hash)
+
+    @property
+    def partial_hash(self):
+        return unpack_hash(self._partial_hash)
+
+    @partial_hash.setter
+    def partial_hash(self, partial_hash):
+        self._partial_hash = pack_hash(partial_hash)
+
+    # The list this used to be
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += 4
+        if index == 0:
+            return self.stat
+        if index == 1:
+            return self.date
+        if index == 2:
+            return self.hash
+        if index == 3:
+            return self.partial_hash
+        raise IndexError("FileRecord index out of range")
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += 4
+        if index == 0:
+            self.stat = value
+        elif index == 1:
+            self.date = value
+        elif index == 2:
+            self.hash = value
+        elif index == 3:
+            self.partial_hash = value
+        else:
+            raise IndexError("FileRecord assignment index out of range")
+
+    def __iter__(self):
+        return iter((self.stat, self.date, self.hash, self.partial_hash))
+
+    def __eq__(self, other):
+        if isinstance(other, (FileRecord, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
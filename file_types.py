@@ -0,0 +1,167 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import fnmatch
+
+# How much of a file is read to tell what it is: enough for three transport stream packets
+SNIFF_SIZE = 1024
+
+JPEG = "jpeg"
+PNG = "png"
+GIF = "gif"
+BMP = "bmp"
+WEBP = "webp"
+PSD = "psd"
+TIFF = "tiff"
+HEIF = "heif"
+MP4 = "mp4"
+QUICKTIME = "quicktime"
+CR3 = "cr3"
+AVI = "avi"
+MATROSKA = "matroska"
+MPEG = "mpeg"
+MPEG_TS = "mpegts"
+ASF = "asf"
+FLV = "flv"
+WAV = "wav"
+# Raw formats that aren't plain TIFF
+ORF = "orf"
+RW2 = "rw2"
+RAF = "raf"
+CRW = "crw"
+X3F = "x3f"
+MRW = "mrw"
+
+# (offset, bytes, type), checked in order
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", JPEG),
+    (0, b"\x89PNG\r\n\x1a\n", PNG),
+    (0, b"GIF87a", GIF),
+    (0, b"GIF89a", GIF),
+    (0, b"II*\x00", TIFF),
+    (0, b"MM\x00*", TIFF),
+    (0, b"IIRO", ORF),
+    (0, b"IIRS", ORF),
+    (0, b"MMOR", ORF),
+    (0, b"IIU\x00", RW2),
+    (0, b"FUJIFILMCCD-RAW", RAF),
+    (0, b"II\x1a\x00\x00\x00HEAPCCDR", CRW),
+    (0, b"FOVb", X3F),
+    (0, b"\x00MRM", MRW),
+    (0, b"8BPS", PSD),
+    (0, b"\x1a\x45\xdf\xa3", MATROSKA),
+    (0, b"\x00\x00\x01\xba", MPEG),
+    (0, b"\x00\x00\x01\xb3", MPEG),
+    (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11\xa6\xd9\x00\xaa\x00\x62\xce\x6c", ASF),
+    (0, b"FLV\x01", FLV),
+    (0, b"BM", BMP),
+]
+
+# RIFF files say what they are at offset 8
+RIFF_TYPES = {b"WEBP": WEBP, b"AVI ": AVI, b"WAVE": WAV}
+
+# MPEG transport streams have no signature, just a sync byte starting every packet.
+# AVCHD (.mts, .m2ts) puts a 4 byte timecode before each one.
+TS_SYNC = b"\x47"
+TS_PACKET_SIZE = 188
+M2TS_PACKET_SIZE = 192
+TS_PACKETS_CHECKED = 3
+
+# ISO base media files say what they are with the major brand of their ftyp box
+HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1", b"avif", b"avis")
+CR3_BRANDS = (b"crx ",)
+QUICKTIME_BRANDS = (b"qt  ",)
+# Old QuickTime files may start with any of these rather than ftyp
+QUICKTIME_TOP_BOXES = (b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot")
+
+# What exif_header.py can read the dates of
+HEADER_TYPES = (JPEG, TIFF, HEIF, MP4, QUICKTIME, CR3)
+# What Pillow's _getexif() works on
+PILLOW_TYPES = (JPEG, PNG, GIF, WEBP, BMP, PSD)
+
+# Files whose first bytes aren't recognized still go to exiftool if their names end
+# with one of these. It reads many more formats than are sniffed here.
+MEDIA_EXTENSIONS = (
+    ".3g2", ".3gp", ".asf", ".avi", ".dv", ".flv", ".m2t", ".m2ts", ".m4v", ".mkv", ".mod", ".mov", ".mp4",
+    ".mpeg", ".mpg", ".mts", ".ogv", ".tod", ".ts", ".vob", ".webm", ".wmv",
+    ".aac", ".aif", ".aiff", ".flac", ".m4a", ".mp3", ".ogg", ".wav", ".wma",
+    ".3fr", ".arw", ".cr2", ".cr3", ".crw", ".dcr", ".dng", ".erf", ".heic", ".iiq", ".jxl", ".kdc", ".mef",
+    ".mos", ".mrw", ".nef", ".nrw", ".orf", ".pef", ".raf", ".rw2", ".rwl", ".sr2", ".srf", ".srw", ".x3f",
+)
+
+INCLUDE = "include"
+EXCLUDE = "exclude"
+
+# Names that aren't worth looking into. (action, pattern) pairs, matched against the
+# file name with fnmatch; the first that matches decides.
+NAME_RULES = [
+    (EXCLUDE, ".*"),
+    (EXCLUDE, "*.txt*"),
+    (EXCLUDE, "*.db"),
+    (EXCLUDE, "*.info"),
+    (EXCLUDE, "*.docx"),
+    (EXCLUDE, "*.exe"),
+    (EXCLUDE, "*.pdf"),
+    (EXCLUDE, "*.url"),
+]
+
+
+def sniff_bytes(head):
+    """
+    :param head: the first SNIFF_SIZE bytes of a file
+    :return: one of the types above, or None if none of the signatures match
+    """
+    for offset, signature, file_type in SIGNATURES:
+        if head.startswith(signature, offset):
+            return file_type
+    if head.startswith(b"RIFF"):
+        return RIFF_TYPES.get(head[8:12])
+    if is_transport_stream(head, 0, TS_PACKET_SIZE) or is_transport_stream(head, 4, M2TS_PACKET_SIZE):
+        return MPEG_TS
+    box_type = head[4:8]
+    if box_type == b"ftyp":
+        brand = head[8:12]
+        if brand in HEIF_BRANDS:
+            return HEIF
+        if brand in CR3_BRANDS:
+            return CR3
+        if brand in QUICKTIME_BRANDS:
+            return QUICKTIME
+        return MP4
+    if box_type in QUICKTIME_TOP_BOXES:
+        return QUICKTIME
+    return None
+
+
+def is_transport_stream(head, offset, packet_size):
+    """
+    :return: True if head has the sync byte at offset in each of its first TS_PACKETS_CHECKED packets.
+             One byte alone would match any file starting with "G".
+    """
+    return all(head[position:position + 1] == TS_SYNC
+               for position in range(offset, offset + packet_size * TS_PACKETS_CHECKED, packet_size))
+
+
+def has_media_extension(name):
+    """
+    :return: True if name ends with one of MEDIA_EXTENSIONS, in any case
+    """
+    return name.lower().endswith(MEDIA_EXTENSIONS)
+
+
+def sniff(filename):
+    """
+    :return: the type of the file going by its first SNIFF_SIZE bytes, or None
+    """
+    with open(filename, "rb") as f:
+        return sniff_bytes(f.read(SNIFF_SIZE))
+
+
+def match_name_rules(name, rules=NAME_RULES):
+    """
+    :return: INCLUDE or EXCLUDE from the first rule whose pattern matches name, or None
+    """
+    for action, pattern in rules:
+        if fnmatch.fnmatchcase(name, pattern):
+            return action
+    return None
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import hashlib
+import os
+
+# Anything hashlib.new() takes, eg. "blake2b"
+HASH_ALGORITHM = "sha1"
+# Bytes read from each end of a file for a partial hash
+PARTIAL_HASH_SIZE = 64 * 1024
+
+BLOCKSIZE = 65536
+
+
+def hash_file(a_filename, algorithm=HASH_ALGORITHM):
+    the_hash = hashlib.new(algorithm)
+    with open(a_filename, "rb") as fp:
+        for block in iter(lambda: fp.read(BLOCKSIZE), b""):
+            the_hash.update(block)
+    return the_hash.hexdigest()
+
+
+def partial_hash_file(a_filename, size, algorithm=HASH_ALGORITHM, partial_size=PARTIAL_HASH_SIZE):
+    """
+    A quick fingerprint: the hash of the size and the first and last partial_size bytes.
+    :return: (fingerprint, full hash). The full hash is only there if the file is small enough
+             that the fingerprint read all of it anyway, otherwise it's None.
+    """
+    the_hash = hashlib.new(algorithm)
+    the_hash.update(str(size).encode("utf-8"))
+    with open(a_filename, "rb") as fp:
+        if size <= 2 * partial_size:
+            data = fp.read()
+            the_hash.update(data)
+            the_full_hash = hashlib.new(algorithm)
+            the_full_hash.update(data)
+            return the_hash.hexdigest(), the_full_hash.hexdigest()
+        the_hash.update(fp.read(partial_size))
+        fp.seek(-partial_size, os.SEEK_END)
+        the_hash.update(fp.read(partial_size))
+    return the_hash.hexdigest(), None
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import sqlite3
+import threading
+import time
+
+# Shared by every Rummage run from here, next to the catalogs and the manifest
+METADATA_CACHE = "rummage_metadata_cache.db"
+
+# Entries kept before the least recently used are evicted. Each file has up to two.
+METADATA_CACHE_SIZE = 500000
+
+# Writes are sent this many at a time, each batch in one transaction
+CACHE_BATCH_SIZE = 1000
+
+# Bumped whenever what's cached changes meaning; a cache from another version is emptied
+CACHE_VERSION = "1"
+
+# What was extracted from a file
+UNRECOGNIZED = 0    # not a media file
+TAGS = 1            # the date tags, some or all of which may be None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    kind INTEGER NOT NULL,
+    date_time TEXT,
+    date_time_digitized TEXT,
+    date_time_original TEXT,
+    media_create_date TEXT,
+    used REAL
+);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# In the order of rummage.DATE_TAGS
+DATE_TAGS = ("DateTime", "DateTimeDigitized", "DateTimeOriginal", "MediaCreateDate")
+
+
+def inode_key(file_stat):
+    """
+    :return: the key of a file by where it is on its filesystem. It survives renames and moves
+             within the filesystem, and changes as soon as the file is written to.
+    """
+    return "inode:%d:%d:%d:%d" % (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def content_key(hash_algorithm, partial_hash_size, fingerprint):
+    """
+    :param fingerprint: the file's partial hash (see hashing.partial_hash_file()), which covers its size
+    :return: the key of a file by its content, the same for a copy on another mount
+    """
+    return "content:%s:%d:%s" % (hash_algorithm, partial_hash_size, fingerprint)
+
+
+class MetadataCache:
+    """
+    What was extracted from each file Rummage has read, by its content rather than
+    its path, so a file that's been moved, renamed or copied elsewhere (another
+    root, another mount) isn't read by the header reader, Pillow or exiftool again.
+
+    An entry is the date tags a file had, or that it wasn't a media file. It's
+    classified from those by Rummage.store_exif() as usual, so what the path
+    says (see path_dates.py) is worked out for where the file is now. Failed
+    extractions aren't cached.
+
+    A file has an entry under its inode_key(), which costs nothing to look up,
+    and one under its content_key(), which costs reading the ends of the file, so
+    Rummage only uses that when its hash_policy reads them anyway.
+    The least recently used entries are evicted once there are more than
+    max_entries. Writes, and the times entries were used, are staged and sent in
+    batches of batch_size. The database is in WAL mode, so worker processes can
+    share it, each with a cache of its own; threads can share one.
+    """
+    def __init__(self, filename=METADATA_CACHE, max_entries=METADATA_CACHE_SIZE, batch_size=CACHE_BATCH_SIZE):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != CACHE_VERSION:
+            with self.connection:
+                self.connection.execute("DELETE FROM entries")
+                self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                                        (CACHE_VERSION,))
+        self._entries = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        # key: row, for what's not written yet
+        self._puts = {}
+        # key: time it was used
+        self._used = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: (True, exif) if the key is cached, where exif is what Rummage.store_exif() takes:
+                 0 for a file that isn't a media file, otherwise a dictionary of its date tags.
+                 (False, None) if it isn't.
+        """
+        with self.lock:
+            row = self._puts.get(key, None)
+            if row is None:
+                row = self.connection.execute("SELECT kind, date_time, date_time_digitized, date_time_original, "
+                                              "media_create_date FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return False, None
+                self._used[key] = time.time()
+                self._flush_if_due()
+            else:
+                row = row[1:6]
+            self.hits += 1
+        if row[0] == UNRECOGNIZED:
+            return True, 0
+        return True, dict((tag, value) for tag, value in zip(DATE_TAGS, row[1:]) if value is not None)
+
+    def put(self, keys, exif):
+        """
+        Cache what was extracted from a file under each of keys.
+        :param exif: 0 for a file that isn't a media file, or a dictionary with (at least) its date tags.
+                     Anything else (None for a failed extraction, or an error) isn't cached.
+        """
+        if not isinstance(exif, dict) and exif != 0:
+            return
+        if exif == 0:
+            values = (UNRECOGNIZED, None, None, None, None)
+        else:
+            values = (TAGS,) + tuple(None if exif.get(tag) is None else str(exif.get(tag)) for tag in DATE_TAGS)
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                self._puts[key] = (key,) + values + (now,)
+                self._used.pop(key, None)
+            self._flush_if_due()
+
+    def _flush_if_due(self):
+        if len(self._puts) + len(self._used) >= self.batch_size:
+            self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._puts and not self._used:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO entries (key, kind, date_time, date_time_digitized, "
+                                        "date_time_original, media_create_date, used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        list(self._puts.values()))
+            self.connection.executemany("UPDATE entries SET used = ? WHERE key = ?",
+                                        [(used, key) for key, used in self._used.items()])
+            self._entries += len(self._puts)
+            if self._entries > self.max_entries:
+                # Other processes may have written some of the same keys; count them properly before evicting
+                self._entries = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                if self._entries > self.max_entries:
+                    self.connection.execute("DELETE FROM entries WHERE key IN "
+                                            "(SELECT key FROM entries ORDER BY used LIMIT ?)",
+                                            (self._entries - self.max_entries,))
+                    self._entries = self.max_entries
+        self._puts = {}
+        self._used = {}
+
+    def __len__(self):
+        with self.lock:
+            self._flush()
+            return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            if self.connection is None:
+                return
+            try:
+                self._flush()
+            finally:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import datetime
+import os
+import re
+
+# How sure we are of a date taken from a path
+HIGH = "high"      # a date and time in the file name, eg. IMG_20140624_103000.jpg
+MEDIUM = "medium"  # a whole date in the file name or its directories, eg. 2014/06/24/x.jpg
+LOW = "low"        # only a year and month, or a year, eg. "2014-06 Trip/x.jpg"
+
+YEAR = r"(?:19|20|21)\d\d"
+MONTH = r"0[1-9]|1[0-2]"
+DAY = r"0[1-9]|[12]\d|3[01]"
+SEPARATOR = r"[-_. ]?"
+TIME_SEPARATOR = r"[-_.: ]?"
+
+# One pattern for everything a name can have, most precise first. At any position the first
+# alternative that matches wins, and the leftmost position wins overall.
+# Phones add milliseconds to the time, eg. PXL_20210101_123456789.
+DATE_PATTERN = re.compile(
+    r"(?<!\d)(?:"
+    r"(?P<year>" + YEAR + r")(?P<separator>" + SEPARATOR + r")(?P<month>" + MONTH + r")(?P=separator)"
+    r"(?P<day>" + DAY + r")[-_.T ]?(?P<hour>[01]\d|2[0-3])" + TIME_SEPARATOR +
+    r"(?P<minute>[0-5]\d)" + TIME_SEPARATOR + r"(?P<second>[0-5]\d)(?:\d{3})?(?!\d)"
+    r"|(?P<date_year>" + YEAR + r")(?P<date_separator>" + SEPARATOR + r")(?P<date_month>" + MONTH + r")"
+    r"(?P=date_separator)(?P<date_day>" + DAY + r")(?!\d)"
+    r"|(?P<month_year>" + YEAR + r")[-_. ](?P<month_month>" + MONTH + r")(?!\d)"
+    r")")
+
+# A directory named after a year, a month or a day, eg. 2014/06/24 or "2014/06 June/"
+YEAR_PATTERN = re.compile(r"^(" + YEAR + r")(?!\d)")
+MONTH_PATTERN = re.compile(r"^(" + MONTH + r")(?!\d)")
+DAY_PATTERN = re.compile(r"^(" + DAY + r")(?!\d)")
+
+
+class PathDate:
+    """
+    A date found in a path. month, day and the time are None when the path doesn't say.
+    """
+    __slots__ = ("year", "month", "day", "time", "confidence")
+
+    def __init__(self, year, month=None, day=None, time=None, confidence=LOW):
+        self.year = year
+        self.month = month
+        self.day = day
+        self.time = time
+        self.confidence = confidence
+
+    def __str__(self):
+        """
+        :return: like str(datetime), eg. "2014-06-24 10:30:00", with what's missing as 01 or 00:00:00
+        """
+        return "%04d-%02d-%02d %s" % (self.year, self.month or 1, self.day or 1,
+                                      "%02d:%02d:%02d" % self.time if self.time else "00:00:00")
+
+    def __repr__(self):
+        return "PathDate(" + str(self) + ", " + self.confidence + ")"
+
+
+def valid_date(year, month, day):
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        return False
+    return True
+
+
+def date_from_name(name):
+    """
+    :return: the first PathDate in a file or directory name, or None
+    """
+    for match in DATE_PATTERN.finditer(name):
+        if match.group("year"):
+            year, month, day = int(match.group("year")), int(match.group("month")), int(match.group("day"))
+            if valid_date(year, month, day):
+                return PathDate(year, month, day, (int(match.group("hour")), int(match.group("minute")),
+                                                   int(match.group("second"))), HIGH)
+        elif match.group("date_year"):
+            year, month, day = (int(match.group("date_year")), int(match.group("date_month")),
+                                int(match.group("date_day")))
+            if valid_date(year, month, day):
+                return PathDate(year, month, day, confidence=MEDIUM)
+        else:
+            return PathDate(int(match.group("month_year")), int(match.group("month_month")))
+    return None
+
+
+class PathDateFinder:
+    """
+    Finds the dates in file names and the names of their directories, for files
+    whose exif data doesn't give one.
+
+    A date and time in the file name is the best there is; then a whole date in
+    the file name; then one from the directories, the deepest first. A directory
+    can have a date of its own ("2014-06-24 Party") or build one with its parents
+    (2014/06/24). What each directory comes to is remembered, so the files in a
+    directory, and the directories under it, don't work it out again.
+    """
+    def __init__(self):
+        self._directories = {}
+
+    def directory_date(self, dirname):
+        """
+        :return: the PathDate of a directory, from its name and its parents', or None
+        """
+        try:
+            return self._directories[dirname]
+        except KeyError:
+            pass
+        parent, name = os.path.split(dirname)
+        inherited = self.directory_date(parent) if parent and parent != dirname else None
+        found = date_from_name(name)
+        if found is not None:
+            # A time in a directory name isn't about any one file
+            if found.time is not None:
+                found = PathDate(found.year, found.month, found.day, confidence=MEDIUM)
+        elif inherited is not None and inherited.month is None and MONTH_PATTERN.match(name):
+            found = PathDate(inherited.year, int(MONTH_PATTERN.match(name).group(1)))
+        elif (inherited is not None and inherited.month is not None and inherited.day is None and
+              DAY_PATTERN.match(name) and valid_date(inherited.year, inherited.month,
+                                                     int(DAY_PATTERN.match(name).group(1)))):
+            found = PathDate(inherited.year, inherited.month, int(DAY_PATTERN.match(name).group(1)),
+                             confidence=MEDIUM)
+        elif YEAR_PATTERN.match(name):
+            found = PathDate(int(YEAR_PATTERN.match(name).group(1)))
+        else:
+            found = inherited
+        self._directories[dirname] = found
+        return found
+
+    def find(self, file_path):
+        """
+        :return: the PathDate of a file, or None if neither its name nor its directories have one
+        """
+        dirname, name = os.path.split(file_path)
+        from_name = date_from_name(name)
+        if from_name is not None and from_name.day is not None:
+            return from_name
+        from_directory = self.directory_date(dirname)
+        if from_directory is None:
+            return from_name
+        if from_name is None:
+            return from_directory
+        # Both have a year and month at best; the file name is closer to the file
+        return from_name if from_directory.day is None else from_directory
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import logging
+
+from catalog_store import CatalogStore
+from dedupe import manifest_catalogs
+from path_dates import PathDateFinder
+from rummage import (DATE_TAGS, EXIF_DATE_FORMAT, EXIF_DATE_OK_DICT, EXIF_NO_DATES_DICT,
+                     EXIF_BIG_DIFF_ORIG_DIGITIZED_DICT, EXIF_UNRECOGNIZED_ENTRY_DICT, EXIF_PATH_DATE_DICT,
+                     NON_EXIF_BIG_DIFF, NON_EXIF_UNRECOGNIZED_VALUE, NON_EXIF_PATH_DATE, PATH_DATE_FALLBACK)
+
+log = logging.getLogger(__name__)
+
+# The thresholds store_exif() uses. DateTimeOriginal and DateTimeDigitized differ too much when,
+# as a timedelta, their difference has more than BIG_DIFF_DAYS days or more than BIG_DIFF_SECONDS seconds.
+# DateTime is taken instead of DateTimeOriginal or DateTimeDigitized when they're more than
+# FALLBACK_DAYS days after it.
+BIG_DIFF_DAYS = 1
+BIG_DIFF_SECONDS = 43200
+FALLBACK_DAYS = 1
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# What parse_exif_dates() says about each value
+MISSING = 0
+VALID = 1
+INVALID = 2
+
+# Positions in "YYYY:MM:DD HH:MM:SS"
+EXIF_DATE_LENGTH = 19
+DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+SEPARATORS = [(4, ":"), (7, ":"), (10, " "), (13, ":"), (16, ":")]
+
+HISTOGRAM_UNITS = {"year": "Y", "month": "M"}
+
+Change = collections.namedtuple("Change", "path old_category old_date category date catalog")
+
+
+def load_numpy():
+    """
+    NumPy is only needed here, so it's only imported when this is used.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("reclassifying and date reports need NumPy (pip install numpy)")
+    return numpy
+
+
+def parse_exif_dates(values):
+    """
+    Parse exif dates ("2014:06:24 10:00:00") the way datetime.strptime(value, EXIF_DATE_FORMAT) does,
+    all at once.
+    :param values: list of strings, or None where there's no value
+    :return: (seconds since 1970 as an int64 array, array of MISSING, VALID or INVALID)
+    """
+    numpy = load_numpy()
+    count = len(values)
+    present = numpy.fromiter((value is not None for value in values), bool, count)
+    text = numpy.array([value or "" for value in values], dtype=str)
+    fixed = numpy.char.str_len(text) == EXIF_DATE_LENGTH
+    codes = text.astype("U%d" % EXIF_DATE_LENGTH).view(numpy.uint32).reshape(count, EXIF_DATE_LENGTH)
+    digits = codes.astype(numpy.int64) - ord("0")
+    ok = fixed & ((digits[:, DIGIT_POSITIONS] >= 0) & (digits[:, DIGIT_POSITIONS] <= 9)).all(axis=1)
+    for position, separator in SEPARATORS:
+        ok &= codes[:, position] == ord(separator)
+
+    def number(start, length):
+        value = numpy.zeros(count, numpy.int64)
+        for position in range(start, start + length):
+            value = value * 10 + digits[:, position]
+        return value
+
+    year, month, day = number(0, 4), number(5, 2), number(8, 2)
+    hour, minute, second = number(11, 2), number(14, 2), number(17, 2)
+    ok &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    ok &= (hour < 24) & (minute < 60) & (second < 60)
+    # Garbage in the rows that aren't ok would only upset datetime64
+    year, month, day = numpy.where(ok, year, 1970), numpy.where(ok, month, 1), numpy.where(ok, day, 1)
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    # eg. February 30th
+    ok &= days.astype("datetime64[M]") == months
+    seconds = (days.astype("datetime64[s]").astype(numpy.int64) + hour * 3600 + minute * 60 + second)
+    seconds = numpy.where(ok, seconds, 0)
+    state = numpy.where(ok, VALID, numpy.where(present, INVALID, MISSING)).astype(numpy.int8)
+
+    # strptime takes a few things the fixed layout doesn't, eg. "2014:6:24 10:00:00"
+    epoch = datetime.datetime(1970, 1, 1)
+    for index in numpy.nonzero(state == INVALID)[0]:
+        try:
+            parsed = datetime.datetime.strptime(values[index], EXIF_DATE_FORMAT)
+        except (ValueError, TypeError):
+            continue
+        seconds[index] = (parsed - epoch) // datetime.timedelta(seconds=1)
+        state[index] = VALID
+    return seconds, state
+
+
+def format_dates(seconds):
+    """
+    :return: object array of str(datetime) of each of the seconds since 1970, eg. "2014-06-24 10:00:00"
+    """
+    numpy = load_numpy()
+    if len(seconds) == 0:
+        return numpy.array([], dtype=object)
+    text = numpy.datetime_as_string(seconds.astype("datetime64[s]"), unit="s")
+    return numpy.char.replace(text, "T", " ").astype(object)
+
+
+class Reclassifier:
+    """
+    Classifies files again from the date tags kept in their catalogs, without
+    reading them, all at once with NumPy. The rules are store_exif()'s, with
+    thresholds that can be changed:
+
+        big_diff_days, big_diff_seconds - DateTimeOriginal and DateTimeDigitized
+            differ too much (the file goes to "exif_big_diff_orig_digitized") if
+            their difference, as a timedelta, has more days or more seconds than this.
+        fallback_days - DateTime is the date when DateTimeOriginal (without
+            DateTimeDigitized), or DateTimeDigitized (without DateTimeOriginal),
+            is more than this many days after it.
+        media_create_date - store_exif() gives a file with only MediaCreateDate
+            (eg. a video) the date "None". With this it gets the MediaCreateDate.
+        path_dates - as Rummage's: files left without a date are dated by their
+            path, if it has one.
+
+    With the defaults nothing changes. Only files with exif data that were
+    examined since the date tags have been kept can be reclassified; rummage with
+    --full to get the rest.
+
+    changes() yields a Change for each file whose category or date would change,
+    apply() writes them to the catalogs.
+    """
+    def __init__(self, catalog_files, big_diff_days=BIG_DIFF_DAYS, big_diff_seconds=BIG_DIFF_SECONDS,
+                 fallback_days=FALLBACK_DAYS, media_create_date=False, path_dates=True):
+        self.catalog_files = list(catalog_files)
+        self.big_diff_days = big_diff_days
+        self.big_diff_seconds = big_diff_seconds
+        self.fallback_days = fallback_days
+        self.media_create_date = media_create_date
+        self.path_dates = path_dates
+        self._path_date_finder = PathDateFinder()
+
+    def classify(self, tags):
+        """
+        :param tags: list of lists of the date tags of each file, in the order of DATE_TAGS
+        :return: (list of output_names, list of dates) for the files
+        """
+        numpy = load_numpy()
+        count = len(tags)
+        categories = numpy.full(count, EXIF_DATE_OK_DICT, dtype=object)
+        dates = numpy.full(count, "None", dtype=object)
+        if count == 0:
+            return [], []
+        parsed = [parse_exif_dates([file_tags[column] for file_tags in tags]) for column in range(len(DATE_TAGS))]
+        (date_time, has_date_time), (digitized, has_digitized), (original, has_original), (media, has_media) = [
+            (seconds, state == VALID) for seconds, state in parsed]
+
+        # store_exif() stops at the first value it can't read, in the order of DATE_TAGS
+        invalid = numpy.zeros(count, bool)
+        for seconds, state in parsed:
+            invalid |= state == INVALID
+
+        def same(has_a, a, has_b, b):
+            return (~has_a & ~has_b) | (has_a & has_b & (a == b))
+
+        no_dates = ~has_date_time & ~has_digitized & ~has_original & ~has_media
+        agree = same(has_date_time, date_time, has_digitized, digitized) & same(has_digitized, digitized,
+                                                                                has_original, original)
+        if self.media_create_date:
+            agree &= has_date_time
+        rest = ~invalid & ~no_dates & ~agree
+        # The date taken, as seconds, for the files that come out OK
+        chosen = numpy.where(agree, date_time, 0)
+
+        # DateTimeOriginal first
+        by_original = rest & has_original
+        difference = original - digitized
+        difference_days = numpy.floor_divide(difference, SECONDS_PER_DAY)
+        big_diff = by_original & has_digitized & ((numpy.abs(difference_days) > self.big_diff_days) |
+                                                  (difference - difference_days * SECONDS_PER_DAY >
+                                                   self.big_diff_seconds))
+        after_date_time = numpy.floor_divide(original - date_time, SECONDS_PER_DAY) > self.fallback_days
+        chosen = numpy.where(by_original, numpy.where(~has_digitized & has_date_time & after_date_time,
+                                                      date_time, original), chosen)
+        # then DateTimeDigitized
+        by_digitized = rest & ~has_original & has_digitized
+        after_date_time = numpy.floor_divide(digitized - date_time, SECONDS_PER_DAY) > self.fallback_days
+        chosen = numpy.where(by_digitized, numpy.where(has_date_time & ~after_date_time, date_time, digitized),
+                             chosen)
+        # then DateTime, then MediaCreateDate
+        by_date_time = rest & ~has_original & ~has_digitized & has_date_time
+        chosen = numpy.where(by_date_time, date_time, chosen)
+        by_media = rest & ~has_original & ~has_digitized & ~has_date_time & has_media
+        chosen = numpy.where(by_media, media, chosen)
+
+        dated = (agree & has_date_time) | ((by_original & ~big_diff) | by_digitized | by_date_time | by_media)
+        dates[dated] = format_dates(chosen[dated])
+        categories[no_dates & ~invalid] = EXIF_NO_DATES_DICT
+        if big_diff.any():
+            categories[big_diff] = EXIF_BIG_DIFF_ORIG_DIGITIZED_DICT
+            dates[big_diff] = (NON_EXIF_BIG_DIFF + " DateTimeOriginal " + format_dates(original[big_diff]) +
+                               " DateTimeDigitized " + format_dates(digitized[big_diff]))
+        categories[invalid] = EXIF_UNRECOGNIZED_ENTRY_DICT
+        for index in numpy.nonzero(invalid)[0]:
+            dates[index] = self.unrecognized_value(tags[index], [(seconds[index], state[index])
+                                                                 for seconds, state in parsed])
+        return categories.tolist(), dates.tolist()
+
+    def unrecognized_value(self, file_tags, parsed):
+        """
+        The date store_exif() gives a file with a value it can't read: what it had read so far.
+        """
+        shown = []
+        for value, (seconds, state) in zip(file_tags, parsed):
+            if state == INVALID:
+                shown.append(value)
+                break
+            shown.append(None if state == MISSING else
+                         datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(seconds)))
+        shown += [None] * (len(DATE_TAGS) - len(shown))
+        return (NON_EXIF_UNRECOGNIZED_VALUE + " DateTime: " + str(shown[0]) +
+                " DateTimeDigitized: " + str(shown[1]) +
+                " DateTimeOriginal: " + str(shown[2]) +
+                " MediaCreateDate: " + str(shown[3]))
+
+    def changes(self):
+        """
+        Yield a Change for each file whose category or date the rules change, catalog by catalog.
+        """
+        for catalog_file in self.catalog_files:
+            store = CatalogStore(catalog_file)
+            try:
+                rows = store.load_date_tags()
+            finally:
+                store.close()
+            categories, dates = self.classify([row[3:] for row in rows])
+            for row, category, date in zip(rows, categories, dates):
+                if self.path_dates and category in PATH_DATE_FALLBACK:
+                    path_date = self._path_date_finder.find(row[0])
+                    if path_date is not None:
+                        category = EXIF_PATH_DATE_DICT
+                        date = NON_EXIF_PATH_DATE + " " + path_date.confidence + " " + str(path_date)
+                if category != row[1] or date != row[2]:
+                    yield Change(row[0], row[1], row[2], category, date, catalog_file)
+
+    def apply(self, changes=None):
+        """
+        Write changes (default: all of them) to the catalogs.
+        :return: the number of files changed
+        """
+        if changes is None:
+            changes = self.changes()
+        by_catalog = collections.OrderedDict()
+        for change in changes:
+            by_catalog.setdefault(change.catalog, []).append((change.category, change.date, change.path))
+        for catalog_file in by_catalog:
+            store = CatalogStore(catalog_file)
+            try:
+                store.update_dates(by_catalog[catalog_file])
+            finally:
+                store.close()
+        return sum(len(updates) for updates in by_catalog.values())
+
+
+def date_histogram(catalog_files, unit="year", category=EXIF_DATE_OK_DICT):
+    """
+    How many files in category have dates in each year or month.
+    :param unit: "year" or "month"
+    :return: list of (year or month, eg. "2014" or "2014-06", count), in order
+    """
+    numpy = load_numpy()
+    dates = []
+    for catalog_file in catalog_files:
+        store = CatalogStore(catalog_file)
+        try:
+            # Dates are str(datetime); anything else (eg. "None") isn't a date
+            dates += [row[0] for row in store.query(
+                "SELECT date FROM files WHERE category = ? AND date GLOB "
+                "'[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]'", (category,))]
+        finally:
+            store.close()
+    if not dates:
+        return []
+    periods = numpy.array(dates, dtype="datetime64[s]").astype("datetime64[" + HISTOGRAM_UNITS[unit] + "]")
+    periods, counts = numpy.unique(periods, return_counts=True)
+    return list(zip([str(period) for period in periods], counts.tolist()))
+
+
+def category_counts(catalog_files):
+    """
+    :return: dictionary of output_name to the number of files in it, over all the catalogs
+    """
+    counts = collections.Counter()
+    for catalog_file in catalog_files:
+        store = CatalogStore(catalog_file)
+        try:
+            counts.update(store.count_by_category())
+        finally:
+            store.close()
+    return dict(counts)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Classify the files in rummage catalogs again, by the date "
+                                                 "tags kept for them, and report on their dates.")
+    parser.add_argument("catalogs", nargs="*", help="catalog files (default: everything in the manifest)")
+    parser.add_argument("--big-diff-days", type=int, default=BIG_DIFF_DAYS,
+                        help="days DateTimeOriginal and DateTimeDigitized may differ by (default: %(default)s)")
+    parser.add_argument("--big-diff-seconds", type=int, default=BIG_DIFF_SECONDS,
+                        help="seconds, beyond whole days, they may differ by (default: %(default)s)")
+    parser.add_argument("--fallback-days", type=int, default=FALLBACK_DAYS,
+                        help="take DateTime when the other dates are more than this many days after it "
+                             "(default: %(default)s)")
+    parser.add_argument("--media-create-date", action="store_true",
+                        help="date files that only have MediaCreateDate (eg. videos) by it")
+    parser.add_argument("--no-path-dates", action="store_true",
+                        help="don't date files without exif dates by their names and directories")
+    parser.add_argument("--dry-run", action="store_true", help="list the changes, don't write them")
+    parser.add_argument("--histogram", choices=sorted(HISTOGRAM_UNITS),
+                        help="count the files in exif_date by year or month")
+    parser.add_argument("--counts", action="store_true", help="count the files in each category")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    catalogs = args.catalogs or manifest_catalogs()
+    reclassifier = Reclassifier(catalogs, big_diff_days=args.big_diff_days, big_diff_seconds=args.big_diff_seconds,
+                                fallback_days=args.fallback_days, media_create_date=args.media_create_date,
+                                path_dates=not args.no_path_dates)
+    changes = list(reclassifier.changes())
+    moves = collections.Counter((change.old_category, change.category) for change in changes)
+    for (old_category, category), count in sorted(moves.items()):
+        print("MOVED:", count, old_category, "->", category)
+    if args.dry_run:
+        for change in changes:
+            print("   ", change.category, change.date, change.path)
+    else:
+        reclassifier.apply(changes)
+    print("CHANGED:", len(changes))
+    if args.counts:
+        for category, count in sorted(category_counts(catalogs).items()):
+            print("CATEGORY:", category, count)
+    if args.histogram:
+        for period, count in date_histogram(catalogs, args.histogram):
+            print("DATES:", period, count)
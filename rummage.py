@@ -1,31 +1,42 @@
 #!/usr/bin/python
 from __future__ import print_function
 
-# This is really Pillow... This does not go as good of a job as exiftool.
-from PIL import Image, ExifTags
 import sys
+import argparse
 import os
 import warnings
+import time
 import datetime
 import hashlib
-import pickle
-import subprocess
 import json
+import logging
+import collections
+import threading
 from os import path, stat
-import re
-sys.path.insert(0, "/home/schwager/Projects/Pixalamode/debug_print")
-
-# Found via Settings -> Project Interpreter -> Show All -> Show paths button
-# (otherwise it's flagged as an error)
-from debug_print import Debug
-debug = Debug(True)
+from stat import S_ISDIR, S_ISREG
+from exiftool_pool import (ExiftoolPool, ExiftoolError, ExiftoolLimitError, ExiftoolArgumentError, check_argument,
+                           EXIFTOOL)
+from catalog_store import CatalogStore, CatalogWriter, read_manifest, add_to_manifest, directory_hash, path_from_db
+from hashing import hash_file, partial_hash_file, HASH_ALGORITHM, PARTIAL_HASH_SIZE
+from exif_header import read_header_dates, HEADER_READ_LIMIT
+import file_types
+from file_types import NAME_RULES, INCLUDE, EXCLUDE
+import scan_stats
+from scan_stats import ScanStats
+from path_dates import PathDateFinder
+from file_record import FileRecord
+from metadata_cache import MetadataCache, inode_key, content_key, METADATA_CACHE, METADATA_CACHE_SIZE
 
-MANIFEST="rummage_pickle_manifest"
+# This is really Pillow... This does not go as good of a job as exiftool.
+# It takes longer to import than everything else here put together, and a scan of a tree that
+# hasn't changed never needs it, so it's imported by load_pillow() when a file first does.
+# asyncio, concurrent.futures and multiprocessing are imported where they're used, for the same reason.
+Image = None
+ExifTags = None
 
-# Exif files don't contain these strings in their names
-NOT_STARTSWITH = ["."]
-NOT_CONTAINS = [".txt"]
-NOT_ENDSWITH = [".db", ".info", ".docx", ".exe", ".pdf", ".url"]
+# Not __name__, that's __main__ when this is run as a script
+log = logging.getLogger("rummage")
+LOG_FORMAT = "%(levelname)s: %(message)s"
 
 # These are the names in the top-level of the overall dict
 EXIF_UNRECOGNIZED_DICT = "exif_unrecognized"
@@ -36,6 +47,10 @@ EXIF_UNRECOGNIZED_ENTRY_DICT = "exif_unrecognized_entry"
 EXIF_BIG_DIFF_ORIG_DIGITIZED_DICT = "exif_big_diff_orig_digitized"
 EXIF_DATE_OK_DICT = "exif_date"
 # "exif_date" is when everything is OK- we have good exif data.
+EXIF_PATH_DATE_DICT = "path_date"
+# "path_date" is when the exif data has no date, but the file name or its directories do.
+EXIF_ERROR_DICT = "exif_error"
+# "exif_error" is for files too big, too slow or too strange to read, with the reason why.
 
 # These will be the prefixes to the strings in the file_info_list, if they're not dates
 NON_EXIF_IGNORED = "Ignored"
@@ -43,6 +58,8 @@ NON_EXIF_UNRECOGNIZED = "Unrecognized"
 NON_EXIF_NO_ATTRIBUTES = "No_attributes"
 NON_EXIF_UNRECOGNIZED_VALUE = "Unrecognized value"
 NON_EXIF_BIG_DIFF = "Diff"
+NON_EXIF_PATH_DATE = "Path date"
+NON_EXIF_ERROR = "Error"
 NO_ATTRIBUTES = "No attributes"
 
 # return codes from functions
@@ -53,8 +70,38 @@ EXIF_UNRECOGNIZED = 3
 EXIF_BIG_DIFF_ORIG_DIGITIZED = 4
 EXIF_UNRECOGNIZED_ENTRY = 5
 EXIF_NO_DATES = 6
+EXIF_QUEUED = 7
+EXIF_PATH_DATE = 8
+EXIF_ERROR = 9
 RETURN_CODE_MISSING = 99
 
+# How much hashing a Rummage does, see Rummage.hash_entry()
+HASH_NONE = "none"
+HASH_LAZY = "lazy"
+HASH_PARTIAL = "partial"
+HASH_FULL = "full"
+HASH_POLICIES = (HASH_NONE, HASH_LAZY, HASH_PARTIAL, HASH_FULL)
+
+# Rummage.scan() commits the catalog and writes a checkpoint after this many examined files,
+# or this many seconds, whichever comes first. None turns either off.
+CHECKPOINT_FILES = 10000
+CHECKPOINT_SECONDS = 60
+
+# With --watch (see watch.py), a path is examined once it's had no events for this long, so a
+# file that's still being copied in is only examined when it's done
+DEBOUNCE_SECONDS = 2.0
+# and where inotify can't be used, the tree is walked this often
+POLL_SECONDS = 30.0
+
+# What Rummage.scan() yields for each file it examines
+ScanRecord = collections.namedtuple("ScanRecord", "path output_name return_code date stat hash")
+
+# Keys of Rummage.scan_counts
+SCAN_SKIPPED = "skipped"
+SCAN_REPROCESSED = "reprocessed"
+SCAN_REMOVED = "removed"
+SCAN_NEW = "new"
+
 output_code_dict = {
     EXIF_IGNORE_BASED_ON_NAME_DICT: EXIF_IGNORE_BASED_ON_NAME,
     EXIF_DATE_OK_DICT: EXIF_OK,
@@ -62,15 +109,126 @@ output_code_dict = {
     EXIF_UNRECOGNIZED_DICT: EXIF_UNRECOGNIZED,
     EXIF_BIG_DIFF_ORIG_DIGITIZED_DICT: EXIF_BIG_DIFF_ORIG_DIGITIZED,
     EXIF_UNRECOGNIZED_ENTRY_DICT: EXIF_UNRECOGNIZED_ENTRY,
-    EXIF_NO_DATES_DICT: EXIF_NO_DATES
+    EXIF_NO_DATES_DICT: EXIF_NO_DATES,
+    EXIF_PATH_DATE_DICT: EXIF_PATH_DATE,
+    EXIF_ERROR_DICT: EXIF_ERROR
 }
 
-warnings.simplefilter('error', Image.DecompressionBombWarning)
+# Files that end up in these get a date from their path instead, if it has one (see path_dates.py)
+PATH_DATE_FALLBACK = (EXIF_NO_DATES_DICT, EXIF_NO_ATTRIBUTES_DICT, EXIF_UNRECOGNIZED_ENTRY_DICT)
+
+# The date tags store_exif() goes by, in the order it reads them. They're kept in the catalog
+# (see catalog_store.py), so the files can be classified again by reclassify.py.
+DATE_TAGS = ("DateTime", "DateTimeDigitized", "DateTimeOriginal", "MediaCreateDate")
+EXIF_DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+# What we ask exiftool for. -CreateDate may work well here, too.
+EXIFTOOL_ARGS = ["-n", "-S", "-j"]
+EXIFTOOL_TAGS = ["-MIMEType", "-MediaCreateDate", "-DateTime", "-DateTimeOriginal", "-DateTimeDigitized"]
+
+# Files Pillow can't read are sent to exiftool this many at a time. 1 means one call per file.
+EXIFTOOL_BATCH_SIZE = 100
+
+# Seconds exiftool may take over a call, and bytes of output it may write per file, before
+# it's killed and the file goes to "exif_error". A batch gets the same time as one file; if
+# it goes over, its files are sent again one at a time.
+EXIFTOOL_TIMEOUT = 30
+EXIFTOOL_MAX_OUTPUT = 1024 * 1024
+
+# Files are examined this many at a time, whether in this process or in a worker process.
+# Exiftool batches don't span chunks.
+SCAN_CHUNK_SIZE = 100
+
+def load_pillow():
+    """
+    Import Pillow, once.
+    :return: its (Image, ExifTags) modules
+    """
+    global Image, ExifTags
+    if Image is None:
+        from PIL import Image as image_module, ExifTags as exif_tags_module
+        warnings.simplefilter('error', image_module.DecompressionBombWarning)
+        ExifTags = exif_tags_module
+        Image = image_module
+    return Image, ExifTags
+
+
+class FileLimitError(Exception):
+    """
+    What an extractor returns, rather than exif data, for a file that's too much for it:
+    too big, too slow, made to blow up in memory, or named so it can't safely be given
+    to exiftool (see exiftool_pool.check_argument()). str() of it is the reason, and
+    store_exif() puts the file in "exif_error" with it. It's returned rather than raised
+    so it can come back from an exiftool batch along with everything else.
+    """
+    pass
+
+
+class PathIndex:
+    """
+    Every entry of a Rummage, found by path or by category in one dict probe.
+
+    by_path[path] is the file's FileRecord (see file_record.py), whose category is
+    the output_name it's stored under.
+    by_category[output_name][path] is the same FileRecord. This is what
+    Rummage.exif_dates_dict gives you, so it looks just like it always has.
+    """
+    def __init__(self, exif_dates_dict=None):
+        self.by_path = {}
+        self.by_category = {}
+        if exif_dates_dict is not None:
+            for output_name in exif_dates_dict:
+                file_dict = exif_dates_dict[output_name]
+                for file_name in file_dict:
+                    self.add(output_name, file_name, file_dict[file_name])
+
+    def __len__(self):
+        return len(self.by_path)
+
+    def __contains__(self, file_name):
+        return file_name in self.by_path
+
+    def get(self, file_name):
+        """
+        :return: (output_name, file_info_list), or None if the file isn't indexed.
+        """
+        record = self.by_path.get(file_name, None)
+        if record is None:
+            return None
+        return record.category, record
+
+    def add(self, output_name, file_name, file_info_list):
+        """
+        Store a file under output_name, replacing any entry it had before.
+        A file_info_list that's still a list is made into a FileRecord.
+        :return: the FileRecord
+        """
+        self.remove(file_name)
+        record = FileRecord.from_list(file_info_list, sys.intern(output_name))
+        self.by_path[file_name] = record
+        try:
+            file_dict = self.by_category[record.category]
+        except KeyError:
+            file_dict = {}
+            self.by_category[record.category] = file_dict
+        file_dict[file_name] = record
+        return record
+
+    def remove(self, file_name):
+        """
+        :return: the output_name the file was stored under, or None if it wasn't there.
+        """
+        record = self.by_path.pop(file_name, None)
+        if record is None:
+            return None
+        del self.by_category[record.category][file_name]
+        return record.category
+
 
 class Rummage:
     """
-    Class that represents a rummage through the local filesystem, populating a
-    pickle file and keeping a dictionary for you to reference.
+    Class that represents a rummage through the local filesystem, populating an
+    SQLite catalog (see catalog_store.py) and keeping a dictionary for you to reference.
 
     Results are stored in dictionaries. The top level dictionary is
     exif_dates_dict[]      it contains:
@@ -81,93 +239,833 @@ class Rummage:
         "exif_unrecognized_entry"
         "exif_big_diff_orig_digitized"
         "exif_date"
+        "path_date"
+        "exif_error"
     These are the entries inside the dictionary. They are themselves dictionaries.
 
     Good results are stored in exif_dates_dict[exif_date[]]
+
+    With path_dates (the default), a file that would go to "exif_no_dates",
+    "exif_no_attributes" or "exif_unrecognized_entry" goes to "path_date" instead
+    if its name or its directories have a date in them (see path_dates.py). Its
+    date is then eg. "Path date medium 2014-06-24 00:00:00", saying how sure that is.
+
+    name_rules is a list of (INCLUDE or EXCLUDE, fnmatch pattern) pairs matched
+    against file names, first match wins; the default is file_types.NAME_RULES.
+    EXCLUDE'd files go to "exif_ignore_based_on_name". INCLUDE'd ones are
+    examined even if sniffing doesn't recognize them.
+
+    With sniff (the default) each file's first bytes are checked against the
+    signatures in file_types.py, so it goes straight to the extractor that can
+    read it, or to "exif_unrecognized" if it's nothing we know. Unless its name
+    has one of file_types.MEDIA_EXTENSIONS: exiftool knows more than we do.
+
+    With header_reader (the default) the dates of JPEG, TIFF/raw, HEIC and MP4/MOV
+    files are read straight from their headers (see exif_header.py), at most
+    header_read_limit bytes of each. Pillow is only used for the rest.
+    Files that Pillow can't read either are handed to a pool of exiftool_workers
+    long-lived exiftool processes (see exiftool_pool.py), exiftool_batch_size
+    files per call.
+
+    No one file can hold up or sink a scan. exiftool is killed if it takes more
+    than exiftool_timeout seconds, or writes more than exiftool_max_output bytes,
+    for a file. Pillow's decompression bomb check is kept, and a file it trips is
+    left alone. Files bigger than max_file_size (None for no limit) that the
+    header reader can't date aren't given to Pillow or exiftool at all. Each of
+    these goes to "exif_error", its date string saying why, eg.
+    "Error exiftool took more than 30 seconds".
+
+    With workers > 1 the extract, classify and hash work is done in a pool of
+    that many processes, chunk_size files at a time. Only the merge into
+    exif_dates_dict and the catalog are done here. The workers are spawned, not
+    forked, so a script that uses them needs the usual if __name__ == "__main__".
+
+    With concurrency > 0 (and one worker) the files are examined by that many
+    threads at once, driven by an asyncio event loop, while the walk goes on in a
+    thread of its own. That's for network filesystems, where each file's latency
+    matters more than CPU. Exiftool is then called per file, exiftool_workers
+    calls at a time. The results are the same as without it. scan() can't be
+    iterated from inside a running event loop in this mode; use a thread.
+
+    With incremental (the default) the catalog from the last run is loaded first.
+    A pickle left by an older version is imported into it the first time.
+    Files whose mtime and size haven't changed are skipped, changed files are
+    examined again and files that have gone are dropped. How many of each is
+    kept in scan_counts.
+
+    hash_policy says how much hashing is done, with hashlib's hash_algorithm:
+        HASH_NONE    - no hashing
+        HASH_LAZY    - nothing during the scan; file_hash() hashes a file when asked
+        HASH_PARTIAL - a fingerprint of the size and the first and last partial_hash_size
+                       bytes. Files with the same fingerprint get a full hash.
+        HASH_FULL    - every byte of every file
+    Files ignored based on their name are only hashed with hash_ignored.
+
+    The constructor does the whole rummage unless autoscan is False. Then
+    nothing happens until you iterate over scan(), which yields a ScanRecord
+    per file as it's examined.
+
+    The tree is walked with os.scandir. Symbolic links are ignored unless
+    follow_symlinks is given; then a directory reached twice (eg. through a link
+    loop) is only walked once. With prune_directories, a directory whose mtime
+    hasn't changed since the last scan isn't even listed: nothing has been added
+    to, removed from or renamed in it, so its files are taken from the catalog.
+    A file that's rewritten in place doesn't change its directory's mtime,
+    though, so that goes unnoticed until a scan without prune_directories.
+    Directories in skip_directories, and everything under them, aren't walked;
+    that's how a CatalogManager (see catalog_manager.py) keeps a root nested in
+    another from being scanned twice.
+
+    What's extracted from each file is kept in a MetadataCache (see
+    metadata_cache.py) in the file metadata_cache, shared by every directory
+    rummaged from here, by the file's inode and, with hash_policy partial or full,
+    by its content. A file that's been renamed or moved within its file system
+    isn't read again, only classified; with those policies, nor is one that's been
+    copied or moved elsewhere. The cache keeps at most metadata_cache_size entries.
+    metadata_cache=None turns it off.
+
+    How long each stage took (walk, stat, name filter, sniff, cache, header, Pillow,
+    exiftool, classify, hash, persist) and how many files and bytes were examined
+    is kept in stats, a ScanStats (see scan_stats.py). With stats_file it's written
+    there as JSON at the end of a scan, and every progress_seconds a progress line
+    is logged. What happens to each file is logged at DEBUG level on the "rummage"
+    logger, so it costs next to nothing unless asked for.
+
+    Every checkpoint_files examined files or checkpoint_seconds seconds,
+    whichever comes first, the catalog is committed and a checkpoint is
+    written listing the directories that are done. If a scan dies, the next one
+    picks up from there: it skips those directories without looking at their
+    files, and skips everything else already in the catalog by its stat, as an
+    incremental scan does (even if this one isn't).
     """
-    def __init__(self, directory):
+    def __init__(self, directory, exiftool=EXIFTOOL, exiftool_workers=1,
+                 exiftool_batch_size=EXIFTOOL_BATCH_SIZE, workers=1, chunk_size=SCAN_CHUNK_SIZE,
+                 incremental=True, hash_policy=HASH_FULL, hash_algorithm=HASH_ALGORITHM,
+                 partial_hash_size=PARTIAL_HASH_SIZE, hash_ignored=False, autoscan=True,
+                 checkpoint_files=CHECKPOINT_FILES, checkpoint_seconds=CHECKPOINT_SECONDS,
+                 header_reader=True, header_read_limit=HEADER_READ_LIMIT, sniff=True, name_rules=None,
+                 follow_symlinks=False, prune_directories=False, concurrency=0, progress_seconds=0,
+                 stats_file=None, path_dates=True, skip_directories=None, metadata_cache=METADATA_CACHE,
+                 metadata_cache_size=METADATA_CACHE_SIZE, exiftool_timeout=EXIFTOOL_TIMEOUT,
+                 exiftool_max_output=EXIFTOOL_MAX_OUTPUT, max_file_size=None):
         if not os.path.exists(directory):
             raise (FileNotFoundError)
 
         if not os.path.isdir(directory):
             raise (NotADirectoryError)
 
-        dir_hash = hashlib.sha1()
-        dir_hash.update(directory.encode('utf-8'))
-        dir_hash = dir_hash.hexdigest()
-        self.opened_pickle = False
+        dir_hash = directory_hash(directory)
+        self.directory = directory
+        self.opened_catalog = False
 
+        # Older versions kept their results here. It's imported into the catalog.
         self.pickle_dump = dir_hash + ".pickle"
+        self.catalog_file = dir_hash + ".db"
+        # Only there while a scan is running, or if one was interrupted
+        self.checkpoint_file = dir_hash + ".checkpoint"
+
+        self.set_options(exiftool=exiftool, exiftool_workers=exiftool_workers,
+                         exiftool_batch_size=exiftool_batch_size, hash_policy=hash_policy,
+                         hash_algorithm=hash_algorithm, partial_hash_size=partial_hash_size,
+                         hash_ignored=hash_ignored, header_reader=header_reader,
+                         header_read_limit=header_read_limit, sniff=sniff,
+                         name_rules=NAME_RULES if name_rules is None else name_rules, path_dates=path_dates,
+                         metadata_cache=metadata_cache, metadata_cache_size=metadata_cache_size,
+                         exiftool_timeout=exiftool_timeout, exiftool_max_output=exiftool_max_output,
+                         max_file_size=max_file_size)
+        if workers > 1 and concurrency > 0:
+            raise ValueError("use workers or concurrency, not both")
+        self.workers = workers
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.incremental = incremental
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_seconds = checkpoint_seconds
+        self.follow_symlinks = follow_symlinks
+        self.skip_directories = set(os.path.abspath(skipped) for skipped in skip_directories or [])
+        self.progress_seconds = progress_seconds
+        self.stats_file = stats_file
+        self.stats = ScanStats()
+        self.prune_directories = prune_directories
+
+        # What happened to each file, compared to the last run
+        self.scan_counts = {SCAN_SKIPPED: 0, SCAN_REPROCESSED: 0, SCAN_REMOVED: 0, SCAN_NEW: 0}
+        self._seen = None
+        self._directory_mtimes = None
+        self._stored_directories = None
+        self._stored_subdirectories = None
+        self._catalog_files_by_directory = None
+
+        self._index = PathIndex()
+        self._store = None
+        self._writer = None
+
+        if autoscan:
+            for record in self.scan():
+                pass
 
-        self._exif_dates_dict = {}
-
-        for dirname, subdir_list, file_list in os.walk(directory):
-            # print (">>> =========", dirname, "=========================")
-            for file in file_list:
-                filename = dirname + "/" + file
-                filename = filename.rstrip()
-                # TODO: Add an option to include links. This means that we ignore all symbolic links.
-                if not os.path.islink(filename):
-                    if os.path.isfile(filename):
-                        return_code = self.do_exif(filename, self._exif_dates_dict)
-                        if return_code == RETURN_CODE_MISSING:
-                            raise RuntimeError("This should not happen: no return code from do_exif")
-
-        if self.opened_pickle:
-            to_delete = []
-            for output_name in self._exif_dates_dict:
-                file_dict = self._exif_dates_dict[output_name]
-                for file_entry in file_dict:
-                    file_entry_stat = file_dict[file_entry][0]
-                    try:
-                        file_stat = stat(file_entry)
-                    except FileNotFoundError:
-                        to_delete.append(file_entry)
-                for file_entry in to_delete:
-                    del file_dict[file_entry]
-                    print("Deleted Entry:", file_entry)
-
-        with open(self.pickle_dump, "wb") as f:
-            pickle.dump(self._exif_dates_dict, f)
+    def scan(self):
+        """
+        Rummage through the directory, yielding a ScanRecord for each file as soon as
+        it's been examined. Records come a chunk (chunk_size files) at a time, in the
+        order of the walk. Files that haven't changed since the last run aren't
+        examined, so there are no records for them; they're in exif_dates_dict.
 
-        manifest = None
-        if os.path.exists(MANIFEST):
-            manifest_file = open(MANIFEST)
-            manifest = [x.split(" <BREAK> ")[1].rstrip() for x in manifest_file]
-            manifest_file.close()
+        The catalog is written from a background thread while this runs.
+        Unless autoscan=False was given, the constructor has already done this.
+        """
+        self.scan_counts = {SCAN_SKIPPED: 0, SCAN_REPROCESSED: 0, SCAN_REMOVED: 0, SCAN_NEW: 0}
+        self.stats.reset()
+        self._seen = set()
+        self._index = PathIndex()
+        self.opened_catalog = False
+        checkpoint = self.read_checkpoint()
+        self._complete_directories = set()
+        self._chunk_directories = collections.deque()
+        self._store = CatalogStore(self.catalog_file)
+        try:
+            if checkpoint is not None:
+                log.info("Resuming the scan checkpointed at %s", time.ctime(checkpoint["updated"]))
+                self._complete_directories = set(checkpoint["complete_directories"])
+            elif not self.incremental:
+                self._store.clear()
+            if not self._store.check_hash_settings(self.hash_algorithm, self.partial_hash_size):
+                log.info("Hash settings changed, stored hashes are dropped")
+            if self.incremental or checkpoint is not None:
+                # Loads the catalog from the last run, if there is one.
+                self.exif_dates_dict = {}
+            self._directory_mtimes = {}
+            self._stored_directories = {}
+            if self.prune_directories and self.opened_catalog:
+                self.load_directories()
+            self._writer = CatalogWriter(self.catalog_file)
+            self.write_checkpoint()
+
+            examined_since_checkpoint = 0
+            last_checkpoint = time.time()
+            for chunk_dict in self.examine_chunks(self.walk_chunks(self.directory)):
+                for record in self.merge_chunk(chunk_dict):
+                    examined_since_checkpoint += 1
+                    yield record
+                # Everything from these directories has now been merged
+                self._complete_directories.update(self._chunk_directories.popleft())
+                if ((self.checkpoint_files and examined_since_checkpoint >= self.checkpoint_files) or
+                        (self.checkpoint_seconds and time.time() - last_checkpoint >= self.checkpoint_seconds)):
+                    with self.stats.timer(scan_stats.PERSIST):
+                        self._writer.flush()
+                        self.write_checkpoint()
+                    examined_since_checkpoint = 0
+                    last_checkpoint = time.time()
+                if self.stats.progress_due(self.progress_seconds):
+                    log.info("PROGRESS: %s", self.stats.progress_line())
+
+            if self.opened_catalog:
+                # Anything we didn't see in the walk is gone from the filesystem.
+                to_delete = [file_entry for file_entry in self._index.by_path if file_entry not in self._seen]
+                for file_entry in to_delete:
+                    self._index.remove(file_entry)
+                    self._writer.delete(file_entry)
+                    log.debug("Deleted Entry: %s", file_entry)
+                self.scan_counts[SCAN_REMOVED] = len(to_delete)
+            self.fill_hashes()
+            with self.stats.timer(scan_stats.PERSIST):
+                self._writer.replace_directories(self._directory_mtimes)
+                self._writer.flush()
+            os.remove(self.checkpoint_file)
+        finally:
+            self.close()
+        self._seen = None
+        self._complete_directories = None
+        self._directory_mtimes = None
+        self._stored_directories = None
+        self._stored_subdirectories = None
+        self._catalog_files_by_directory = None
+
+        log.info("SCAN: %s", ", ".join(name + " " + str(self.scan_counts[name]) for name in
+                                       (SCAN_SKIPPED, SCAN_REPROCESSED, SCAN_REMOVED, SCAN_NEW)))
+        log.info("DONE: %s", self.stats.progress_line())
+        if self.stats_file is not None:
+            self.stats.write_json(self.stats_file, {"directory": self.directory, "scan_counts": self.scan_counts})
+
+        manifest = read_manifest()
+        if manifest is not None:
+            manifest = [catalog_file for manifest_directory, catalog_file in manifest]
 
         if manifest is not None:
             for path in manifest:
                 if not os.path.exists(path):
-                    print ("WARNING:", path, "in manifest, but not on system.")
-        if manifest is None or self.pickle_dump not in manifest:
-            manifest_file = open(MANIFEST, "a")
-            manifest_file.write(directory + " <BREAK> " + self.pickle_dump)
-            manifest_file.write("\n")
-            manifest_file.close()
+                    log.warning("%s in manifest, but not on system.", path)
+        if manifest is None or self.catalog_file not in manifest:
+            add_to_manifest(self.directory, self.catalog_file)
+
+    def update(self, paths):
+        """
+        Bring exif_dates_dict and the catalog up to date for just these paths, without walking
+        the rest of the tree. It's for a caller that knows what has changed since scan() (see
+        watch.py): a file that's new or changed is examined, one that's gone is dropped, a
+        directory is walked, and whatever was under a directory that's gone is dropped.
+        Yields a ScanRecord for each file examined, examined here rather than by workers.
+
+        scan() has to have been run first. The catalog is flushed before this is done, but it,
+        exiftool and the metadata cache are kept open for the next call, until close().
+        The directory mtimes in the catalog aren't touched, so the directories that changed
+        aren't pruned by the next scan.
+        """
+        root = os.path.abspath(self.directory)
+        self.scan_counts = {SCAN_SKIPPED: 0, SCAN_REPROCESSED: 0, SCAN_REMOVED: 0, SCAN_NEW: 0}
+        self._directory_mtimes = {}
+        self._stored_directories = {}
+        if self._writer is None:
+            self._writer = CatalogWriter(self.catalog_file)
+        files = {}
+        # Directories that were walked or have gone; whatever the index has under them and
+        # wasn't found is dropped
+        directories = []
+        for file_path in paths:
+            file_path = os.path.abspath(file_path)
+            if not self.is_walked(file_path, root):
+                continue
+            try:
+                with self.stats.timer(scan_stats.STAT):
+                    file_stat = os.stat(file_path) if self.follow_symlinks else os.lstat(file_path)
+            except OSError:
+                file_stat = None
+            if file_stat is not None and S_ISDIR(file_stat.st_mode):
+                directories.append(file_path)
+                for dirname, entries in self.walk_directories(file_path):
+                    for entry in entries:
+                        try:
+                            with self.stats.timer(scan_stats.STAT):
+                                files[entry.path] = entry.stat(follow_symlinks=self.follow_symlinks)
+                        except OSError as e:
+                            log.error("can't stat %s %s", entry.path, e)
+            elif file_stat is not None and S_ISREG(file_stat.st_mode):
+                files[file_path] = file_stat
+            else:
+                # Gone, or not something a scan would have looked at
+                directories.append(file_path)
+                if file_path not in files and self._index.remove(file_path) is not None:
+                    self._writer.delete(file_path)
+                    self.scan_counts[SCAN_REMOVED] += 1
+        if directories:
+            prefixes = tuple(dirname + os.sep for dirname in directories)
+            to_delete = [file_name for file_name in self._index.by_path
+                         if file_name.startswith(prefixes) and file_name not in files]
+            for file_name in to_delete:
+                self._index.remove(file_name)
+                self._writer.delete(file_name)
+                log.debug("Deleted Entry: %s", file_name)
+            self.scan_counts[SCAN_REMOVED] += len(to_delete)
+
+        chunk = []
+        for file_path in files:
+            file_stat = files[file_path]
+            if self.check_existing_stats(self._index, file_path, file_stat) != RETURN_CODE_MISSING:
+                self.scan_counts[SCAN_SKIPPED] += 1
+                continue
+            if self._index.remove(file_path) is not None:
+                self.scan_counts[SCAN_REPROCESSED] += 1
+            else:
+                self.scan_counts[SCAN_NEW] += 1
+            chunk.append((file_path, file_stat))
+        partial_hashes = []
+        for start in range(0, len(chunk), self.chunk_size):
+            for record in self.merge_chunk(self.examine_chunk(chunk[start:start + self.chunk_size])):
+                if self._index.by_path[record.path][3]:
+                    partial_hashes.append(self._index.by_path[record.path][3])
+                yield record
+        with self.stats.timer(scan_stats.PERSIST):
+            self._writer.flush()
+        if self.hash_policy == HASH_PARTIAL and partial_hashes:
+            store = CatalogStore(self.catalog_file)
+            try:
+                collisions = store.partial_hash_collisions(partial_hashes)
+            finally:
+                store.close()
+            for (file_name,) in collisions:
+                if file_name in self._index:
+                    self.file_hash(file_name)
+            self._writer.flush()
+        self._directory_mtimes = None
+        self._stored_directories = None
+        log.info("UPDATE: %s", ", ".join(name + " " + str(self.scan_counts[name]) for name in
+                                         (SCAN_SKIPPED, SCAN_REPROCESSED, SCAN_REMOVED, SCAN_NEW)))
+
+    def is_walked(self, file_path, root):
+        """
+        :return: True if a scan of root would get to file_path, ie. it's under root and not
+                 under any of skip_directories
+        """
+        if file_path != root and not file_path.startswith(root + os.sep):
+            return False
+        for skipped in self.skip_directories:
+            if (file_path == skipped or file_path.startswith(skipped + os.sep)) and skipped != root:
+                return False
+        return True
+
+    def load_directories(self):
+        """
+        Get what prune_directories needs from the catalog: the directory mtimes of the
+        last scan, and the subdirectories and files of each directory.
+        """
+        self._stored_directories = self._store.load_directories()
+        self._stored_subdirectories = collections.defaultdict(list)
+        for dirname in self._stored_directories:
+            parent = os.path.dirname(dirname)
+            if parent != dirname:
+                self._stored_subdirectories[parent].append(dirname)
+        self._catalog_files_by_directory = collections.defaultdict(list)
+        for file_name in self._index.by_path:
+            self._catalog_files_by_directory[os.path.dirname(file_name)].append(file_name)
+
+    def set_options(self, **options):
+        """
+        Settings that the per-file work depends on. They're kept in self.options
+        as well, so a worker process can be set up the same way.
+        """
+        self.options = options
+        self.exiftool = options["exiftool"]
+        self.exiftool_workers = options["exiftool_workers"]
+        self.exiftool_batch_size = options["exiftool_batch_size"]
+        self.exiftool_timeout = options["exiftool_timeout"]
+        self.exiftool_max_output = options["exiftool_max_output"]
+        self.max_file_size = options["max_file_size"]
+        self.hash_policy = options["hash_policy"]
+        if self.hash_policy not in HASH_POLICIES:
+            raise ValueError("hash_policy must be one of " + ", ".join(HASH_POLICIES))
+        self.hash_algorithm = options["hash_algorithm"]
+        # Raises ValueError if hashlib doesn't know it
+        hashlib.new(self.hash_algorithm)
+        self.partial_hash_size = options["partial_hash_size"]
+        self.hash_ignored = options["hash_ignored"]
+        self.header_reader = options["header_reader"]
+        self.header_read_limit = options["header_read_limit"]
+        self.sniff = options["sniff"]
+        self.name_rules = [tuple(rule) for rule in options["name_rules"]]
+        for action, pattern in self.name_rules:
+            if action not in (INCLUDE, EXCLUDE):
+                raise ValueError("name rule action must be " + INCLUDE + " or " + EXCLUDE)
+        self.path_dates = options["path_dates"]
+        self._path_date_finder = PathDateFinder()
+        self.metadata_cache_file = options["metadata_cache"]
+        self.metadata_cache_size = options["metadata_cache_size"]
+        self._metadata_cache = None
+        self._exiftool_pool = None
+        self._exiftool_queue = []
+
+    @classmethod
+    def for_worker(cls, options):
+        """
+        A Rummage that doesn't walk anything, used to examine chunks of files in a worker process.
+        """
+        rummage = cls.__new__(cls)
+        rummage.set_options(**options)
+        rummage._store = None
+        rummage._writer = None
+        rummage.stats = ScanStats()
+        return rummage
+
+    def read_checkpoint(self):
+        """
+        :return: the checkpoint left by an interrupted scan, or None
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        try:
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+        except ValueError:
+            log.warning("ignoring unreadable checkpoint %s", self.checkpoint_file)
+            return None
+        if checkpoint.get("directory") != self.directory:
+            return None
+        return checkpoint
+
+    def write_checkpoint(self):
+        """
+        Write the checkpoint to a temporary file and rename it over the old one,
+        so there's always a whole checkpoint to resume from.
+        """
+        checkpoint = {
+            "directory": self.directory,
+            "catalog": self.catalog_file,
+            "updated": time.time(),
+            "scan_counts": self.scan_counts,
+            "complete_directories": sorted(self._complete_directories),
+        }
+        temporary_file = self.checkpoint_file + ".tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_file, self.checkpoint_file)
+
+    def walk_directories(self, directory):
+        """
+        Walk the tree with os.scandir, top down in the same order as os.walk.
+        Yield (dirname, entries), entries being the os.DirEntry's of the regular files
+        in dirname. Their stat is cached by the DirEntry, so walk_chunks() only pays for it once.
+
+        With follow_symlinks, links to files and directories are followed, and a
+        directory that's been walked already (a link loop) isn't walked again.
+        With prune_directories, a directory whose mtime is the same as at the end of
+        the last scan isn't listed at all; entries is None for it and its files and
+        subdirectories are taken from the catalog.
+        """
+        root = os.path.abspath(directory)
+        walked = set()
+        stack = [root]
+        while stack:
+            dirname = stack.pop()
+            if dirname in self.skip_directories and dirname != root:
+                continue
+            try:
+                with self.stats.timer(scan_stats.STAT):
+                    dir_stat = os.stat(dirname)
+            except OSError as e:
+                log.error("can't stat %s %s", dirname, e)
+                continue
+            if self.follow_symlinks:
+                dir_key = (dir_stat.st_dev, dir_stat.st_ino)
+                if dir_key in walked:
+                    log.warning("not walking %s again, it's linked from more than one place", dirname)
+                    continue
+                walked.add(dir_key)
+            if self._stored_directories.get(dirname) == dir_stat.st_mtime:
+                self._directory_mtimes[dirname] = dir_stat.st_mtime
+                stack.extend(reversed(self._stored_subdirectories.get(dirname, [])))
+                self.stats.count(scan_stats.DIRECTORIES_PRUNED)
+                yield dirname, None
+                continue
+            entries = []
+            subdirs = []
+            try:
+                with self.stats.timer(scan_stats.WALK), os.scandir(dirname) as scan:
+                    for entry in scan:
+                        try:
+                            if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                                subdirs.append(entry.path)
+                            elif entry.is_file(follow_symlinks=self.follow_symlinks):
+                                entries.append(entry)
+                        except OSError as e:
+                            log.error("can't stat %s %s", entry.path, e)
+            except OSError as e:
+                log.error("can't list %s %s", dirname, e)
+                continue
+            self.stats.count(scan_stats.DIRECTORIES)
+            # The mtime from before it was listed, so anything added since is noticed next time
+            self._directory_mtimes[dirname] = dir_stat.st_mtime
+            stack.extend(reversed(subdirs))
+            yield dirname, entries
+
+    def walk_chunks(self, directory):
+        """
+        Walk the directory, yielding lists of up to chunk_size (file name, stat) pairs that
+        need examining. Files that haven't changed since the last run are skipped, and the
+        old entries of files that have changed are dropped.
+
+        For each chunk, the directories whose files are all in it or in earlier chunks are
+        appended to self._chunk_directories. Directories that a checkpoint says are done
+        aren't looked at again.
+        """
+        chunk = []
+        finished_directories = []
+        for dirname, entries in self.walk_directories(directory):
+            if entries is None:
+                # Pruned, nothing in it has been added, removed or renamed
+                catalog_files = self._catalog_files_by_directory.get(dirname, [])
+                self._seen.update(catalog_files)
+                self.scan_counts[SCAN_SKIPPED] += len(catalog_files)
+                finished_directories.append(dirname)
+                continue
+            if dirname in self._complete_directories:
+                for entry in entries:
+                    self._seen.add(entry.path)
+                self.scan_counts[SCAN_SKIPPED] += len(entries)
+                # Its files weren't looked at, so it mustn't be pruned next time
+                del self._directory_mtimes[dirname]
+                continue
+            self.stats.count(scan_stats.FILES_WALKED, len(entries))
+            for entry in entries:
+                file_path = entry.path
+                try:
+                    with self.stats.timer(scan_stats.STAT):
+                        file_stat = entry.stat(follow_symlinks=self.follow_symlinks)
+                except OSError as e:
+                    log.error("can't stat %s %s", file_path, e)
+                    continue
+                self._seen.add(file_path)
+                if self.opened_catalog:
+                    code = self.check_existing_stats(self._index, file_path, file_stat)
+                    if code != RETURN_CODE_MISSING:
+                        self.scan_counts[SCAN_SKIPPED] += 1
+                        continue
+                    if self._index.remove(file_path) is not None:
+                        log.debug("File changed: %s", file_path)
+                        self.scan_counts[SCAN_REPROCESSED] += 1
+                    else:
+                        self.scan_counts[SCAN_NEW] += 1
+                else:
+                    self.scan_counts[SCAN_NEW] += 1
+                chunk.append((file_path, file_stat))
+                if len(chunk) >= self.chunk_size:
+                    self._chunk_directories.append(finished_directories)
+                    finished_directories = []
+                    yield chunk
+                    chunk = []
+            finished_directories.append(dirname)
+        if chunk:
+            self._chunk_directories.append(finished_directories)
+            yield chunk
+
+    def examine_chunk(self, files):
+        """
+        Run do_exif on each (file name, stat) pair into a dictionary of its own, which is returned.
+        Nothing here touches self.exif_dates_dict, so it can run in another process.
+        """
+        chunk_dict = {}
+        for filename, file_stat in files:
+            return_code = self.do_exif(filename, chunk_dict, file_stat)
+            if return_code == RETURN_CODE_MISSING:
+                raise RuntimeError("This should not happen: no return code from do_exif")
+        self.flush_exiftool_queue(chunk_dict)
+        return chunk_dict
+
+    def examine_chunks(self, chunks):
+        """
+        Yield examine_chunk's result for each chunk, in the same order as the chunks.
+        With more than one worker, the chunks are examined in a process pool with
+        at most two chunks per worker waiting to be merged.
+        """
+        if self.concurrency > 0:
+            for chunk_dict in self.examine_chunks_async(chunks):
+                yield chunk_dict
+            return
+        if self.workers <= 1:
+            for chunk in chunks:
+                yield self.examine_chunk(chunk)
+            return
+        import concurrent.futures
+        import multiprocessing
+        # Forking while the catalog writer thread holds a lock would leave the lock held in the child
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=_init_scan_worker,
+                                                    initargs=(self.options, log.getEffectiveLevel())) as executor:
+            in_flight = collections.deque()
+            for chunk in chunks:
+                in_flight.append(executor.submit(_examine_chunk_in_worker, chunk))
+                if len(in_flight) >= 2 * self.workers:
+                    yield self._worker_result(in_flight.popleft())
+            while in_flight:
+                yield self._worker_result(in_flight.popleft())
+
+    def _worker_result(self, future):
+        chunk_dict, worker_stats = future.result()
+        self.stats.merge(worker_stats)
+        return chunk_dict
+
+    def examine_chunks_async(self, chunks):
+        """
+        examine_chunks() with concurrency > 0. Each file is examined by examine_chunk()
+        in a thread pool, no more than concurrency at once. The walk, which lists
+        directories and stats files, runs in a thread of its own and stays at most two
+        chunks or twice concurrency files ahead of the chunk being merged. Chunks are
+        yielded in order, and only when the walk isn't running, so the index can be
+        read and merged into without locking.
+        """
+        import asyncio
+        import concurrent.futures
+        loop = asyncio.new_event_loop()
+        walker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        examiners = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        # Shares our exiftool pool, without the batching, which isn't thread safe
+        examiner = Rummage.for_worker(dict(self.options, exiftool_batch_size=1))
+        examiner._exiftool_pool = self.exiftool_pool
+        examiner._metadata_cache = self.metadata_cache
+        examiner.stats = self.stats
+        # (task, number of files) for each chunk being examined, oldest first
+        in_flight = collections.deque()
+        walking = True
+
+        async def make_semaphore():
+            return asyncio.Semaphore(self.concurrency)
+        semaphore = loop.run_until_complete(make_semaphore())
+
+        async def examine_file(file_name, file_stat):
+            async with semaphore:
+                return await loop.run_in_executor(examiners, examiner.examine_chunk, [(file_name, file_stat)])
+
+        async def examine_chunk(files):
+            chunk_dict = {}
+            for file_dict in await asyncio.gather(*[examine_file(file_name, file_stat)
+                                                    for file_name, file_stat in files]):
+                for output_name in file_dict:
+                    chunk_dict.setdefault(output_name, {}).update(file_dict[output_name])
+            return chunk_dict
+
+        async def next_chunk_dict():
+            nonlocal walking
+            while walking and (len(in_flight) < 2 or
+                                  sum(count for task, count in in_flight) < 2 * self.concurrency):
+                chunk = await loop.run_in_executor(walker, next, chunks, None)
+                if chunk is None:
+                    walking = False
+                else:
+                    in_flight.append((loop.create_task(examine_chunk(chunk)), len(chunk)))
+            if not in_flight:
+                return None
+            return await in_flight.popleft()[0]
+
+        try:
+            while True:
+                chunk_dict = loop.run_until_complete(next_chunk_dict())
+                if chunk_dict is None:
+                    break
+                yield chunk_dict
+        finally:
+            for task, count in in_flight:
+                task.cancel()
+            if in_flight:
+                loop.run_until_complete(asyncio.gather(*[task for task, count in in_flight],
+                                                       return_exceptions=True))
+            walker.shutdown(wait=True)
+            examiners.shutdown(wait=True)
+            loop.close()
+
+    def merge_chunk(self, chunk_dict):
+        """
+        Add the results of examine_chunk() to exif_dates_dict and the catalog, yielding a
+        ScanRecord for each file.
+        """
+        for output_name in chunk_dict:
+            file_dict = chunk_dict[output_name]
+            for file_name in file_dict:
+                file_info_list = file_dict[file_name]
+                with self.stats.timer(scan_stats.PERSIST):
+                    file_info_list = self._index.add(output_name, file_name, file_info_list)
+                    self._writer.upsert(output_name, file_name, file_info_list)
+                    # They're in the catalog now, that's where reclassify.py looks
+                    file_info_list.tags = None
+                yield ScanRecord(file_name, output_name, output_code_dict[output_name],
+                                 file_info_list[1], file_info_list[0], file_info_list[2])
+
+    @property
+    def exiftool_pool(self):
+        """
+        The exiftool workers are only started once a file actually needs them.
+        """
+        if self._exiftool_pool is None:
+            self._exiftool_pool = ExiftoolPool(self.exiftool_workers, self.exiftool)
+        return self._exiftool_pool
+
+    @property
+    def metadata_cache(self):
+        """
+        The MetadataCache, opened once a file needs it, or None if it's turned off.
+        """
+        if self._metadata_cache is None and self.metadata_cache_file is not None:
+            self._metadata_cache = MetadataCache(self.metadata_cache_file, self.metadata_cache_size)
+        return self._metadata_cache
+
+    def close(self):
+        if self._exiftool_pool is not None:
+            self._exiftool_pool.shutdown()
+            self._exiftool_pool = None
+        if self._metadata_cache is not None:
+            self._metadata_cache.close()
+            self._metadata_cache = None
+        try:
+            if self._writer is not None:
+                writer = self._writer
+                self._writer = None
+                writer.close()
+        finally:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
 
     @property
     def exif_dates_dict(self):
-        return self._exif_dates_dict
+        return self._index.by_category
 
     @exif_dates_dict.setter
     def exif_dates_dict(self, exif_dates_dict):
-        self._exif_dates_dict = exif_dates_dict
-        if os.path.exists(self.pickle_dump):
-            with open(self.pickle_dump, "rb") as f:
-                self._exif_dates_dict = pickle.load(f)
-            self.opened_pickle = True
-        else:
-            self._exif_dates_dict = {}
+        """
+        Assigning (re)loads the results of the last run from the catalog.
+        """
+        if len(self._store) == 0 and os.path.exists(self.pickle_dump):
+            log.info("Importing %s into %s", self.pickle_dump, self.catalog_file)
+            self._store.import_pickle(self.pickle_dump)
+        self._index = PathIndex()
+        for output_name, file_name, file_info_list in self._store.load():
+            self._index.add(output_name, file_name, file_info_list)
+        self.opened_catalog = len(self._index) > 0
 
 
     def get_hash(self, a_filename):
-        blocksize = 65536
-        the_hash = hashlib.sha1()
-        with open(a_filename, "rb") as fp:
-            for block in iter(lambda: fp.read(blocksize), b""):
-                the_hash.update(block)
-        return the_hash.hexdigest()
+        return hash_file(a_filename, self.hash_algorithm)
+
+    def get_partial_hash(self, a_filename, size):
+        """
+        :return: (fingerprint, full hash or None), see hashing.partial_hash_file()
+        """
+        return partial_hash_file(a_filename, size, self.hash_algorithm, self.partial_hash_size)
+
+    def hash_entry(self, output_name, file_name, file_info_list):
+        """
+        Fill in file_info_list[2] (the hash) and file_info_list[3] (the partial hash) as far as
+        hash_policy asks for. Files ignored based on their name aren't hashed unless hash_ignored.
+        """
+        if output_name == EXIF_IGNORE_BASED_ON_NAME_DICT and not self.hash_ignored:
+            return
+        if self.hash_policy == HASH_FULL:
+            if not file_info_list[2]:
+                with self.stats.timer(scan_stats.HASH):
+                    file_info_list[2] = self.get_hash(file_name)
+        elif self.hash_policy == HASH_PARTIAL:
+            if not file_info_list[2] and not file_info_list[3]:
+                with self.stats.timer(scan_stats.HASH):
+                    file_info_list[3], file_info_list[2] = self.get_partial_hash(file_name,
+                                                                                 file_info_list[0].st_size)
+
+    def file_hash(self, file_name):
+        """
+        The full hash of a file in the catalog. If it hasn't been hashed yet (see hash_policy)
+        it's hashed now, and the catalog is updated.
+        """
+        file_info_list = self._index.by_path[file_name]
+        if not file_info_list[2]:
+            file_info_list[2] = self.get_hash(file_name)
+            if self._writer is not None:
+                self._writer.update_hashes(file_name, file_info_list[2], None)
+            else:
+                store = CatalogStore(self.catalog_file)
+                store.update_hashes(file_name, file_info_list[2], None)
+                store.close()
+        return file_info_list[2]
+
+    def fill_hashes(self):
+        """
+        Bring the hashes of files skipped by an incremental scan up to hash_policy (it may have
+        changed since they were stored). With HASH_PARTIAL, files whose fingerprints collide get
+        their full hash.
+        """
+        for file_name in self._index.by_path:
+            file_info_list = self._index.by_path[file_name]
+            output_name = file_info_list.category
+            before = (file_info_list[2], file_info_list[3])
+            try:
+                self.hash_entry(output_name, file_name, file_info_list)
+            except (IOError, OSError) as e:
+                log.error("can't hash %s %s", file_name, e)
+                continue
+            if (file_info_list[2], file_info_list[3]) != before:
+                self._writer.update_hashes(file_name, file_info_list[2], file_info_list[3])
+        if self.hash_policy == HASH_PARTIAL:
+            self._writer.flush()
+            for (file_name,) in self._store.partial_hash_collisions():
+                self.file_hash(file_name)
 
 
     def str_hash(self, a_string):
@@ -191,22 +1089,24 @@ class Rummage:
 
 
     def derive_date_from_path(self, filename):
-        # Try to get date from the path...
-        # 1. Filename: (2[01]|19)[0-9]2[0-2]
-
-        # According to the docs (python3.4):
-        # "The compiled versions of the most recent patterns passed to re.compile() and
-        # the module-level matching functions are cached, so programs that use only a few regular
-        # expressions at a time needn't worry about compiling regular expressions."
-        regexp_to_check = [r'((19)|(20)|(21))[0-9][0-9][0-1][0-9][0-3][0-9]',
-                           r'((19)|(20)|(21))[0-9][0-9]\W[0-1][0-9]\W[0-3][0-9]']
-        basename = path.basename(filename)
-        for regexp in regexp_to_check:
-            pattern = re.compile(regexp)
-            match = pattern.search(basename)
-            if match:
-                return match.group(1)
-        return None
+        """
+        :return: the PathDate (see path_dates.py) from the file's name or its directories, or None
+        """
+        return self._path_date_finder.find(os.path.abspath(filename))
+
+    def fall_back_to_path_date(self, output_name, return_code, file_path, file_info_list):
+        """
+        Files that didn't get a date from their exif data get one from their path, if it has one.
+        :return: (output_name, return_code), changed to EXIF_PATH_DATE_DICT's if the path had a date
+        """
+        if not self.path_dates or output_name not in PATH_DATE_FALLBACK:
+            return output_name, return_code
+        path_date = self.derive_date_from_path(file_path)
+        if path_date is None:
+            return output_name, return_code
+        file_info_list[1] = NON_EXIF_PATH_DATE + " " + path_date.confidence + " " + str(path_date)
+        log.debug("PATH DATE: %s %s", file_path, file_info_list[1])
+        return EXIF_PATH_DATE_DICT, EXIF_PATH_DATE
 
     def compare_stats(self, stat0, stat1):
         """
@@ -228,7 +1128,17 @@ class Rummage:
         return True
 
     def check_existing_stats(self, exif_dates_dict, filename, stat_of_file):
+        """
+        :param exif_dates_dict: a PathIndex, or a dictionary like exif_dates_dict
+        :return: the return code of the file's existing entry if its stat hasn't changed,
+                 otherwise RETURN_CODE_MISSING
+        """
         global output_code_dict
+        if isinstance(exif_dates_dict, PathIndex):
+            found = exif_dates_dict.get(filename)
+            if found is not None and self.compare_stats(found[1].stat, stat_of_file):
+                return output_code_dict[found[0]]
+            return RETURN_CODE_MISSING
         for output_name in exif_dates_dict:
             file_dict = exif_dates_dict[output_name]
             try:
@@ -242,39 +1152,124 @@ class Rummage:
 
     def get_exif_from_tool(self, file_path, file_info_list):
         try:
-            # -CreateDate may work well here, too.
-            args=["/usr/bin/exiftool", "-n", "-S", "-j",
-                 file_path, "-MIMEType", "-MediaCreateDate",
-                 "-DateTime", "-DateTimeOriginal", "-DateTimeDigitized"]
-            # exiftool_output = subprocess.check_output(args=args)
-            process = subprocess.Popen(args=args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            exiftool_output, exiftool_error = process.communicate()
-            exiftool_output = exiftool_output.decode("utf-8")
+            args = EXIFTOOL_ARGS + [file_path] + EXIFTOOL_TAGS
+            with self.stats.timer(scan_stats.EXIFTOOL):
+                exiftool_output, exiftool_error = self.exiftool_pool.execute(args, self.exiftool_timeout,
+                                                                             self.exiftool_max_output)
             if exiftool_error:
-                exiftool_error = exiftool_error.decode("utf-8")
                 exiftool_error = exiftool_error.replace("\n", " ")
-                print ("ERROR:", exiftool_error)
+                log.error("%s", exiftool_error)
             exiftool_output = exiftool_output.replace("\n", " ")
             # this returns a list
             exiftool_output = json.loads(exiftool_output)
             exiftool_output = exiftool_output[0]
-            # if you have MIMEType, you're a media file.
-            if "MIMEType" not in exiftool_output:
-                return 0
-            if "MediaCreateDate" in exiftool_output:
-                print("***EXIFTOOL: found MediaCreateDate", file_path)
-            elif "DateTimeOriginal" in exiftool_output:
-                print("***EXIFTOOL: found DateTimeOriginal", file_path)
-            elif "DateTimeDigitized" in exiftool_output:
-                print ("***EXIFTOOL: found DateTimeDigitized", file_path)
-            elif "DateTime" in exiftool_output:
-                print ("***EXIFTOOL: found DateTime", file_path)
+            return self.check_exiftool_entry(file_path, exiftool_output)
+        except ExiftoolArgumentError as e:
+            # It names the file, escaped
+            log.warning("%s", e)
+            return FileLimitError(str(e))
+        except ExiftoolLimitError as e:
+            log.warning("exiftool call on %s: %s", file_path, e)
+            return FileLimitError(str(e))
+        except (ExiftoolError, FileNotFoundError, ValueError, IndexError) as e:
+            log.error("exiftool call on %s", file_path)
+            return None
+
+    def get_exif_from_tool_batch(self, file_paths):
+        """
+        Ask exiftool about many files in one call.
+        :param file_paths: list of absolute paths
+        :return: dictionary of file path to what get_exif_from_tool would have returned for it:
+                 the exiftool entry, 0 if it's not a media file, None if exiftool had nothing to say,
+                 or a FileLimitError.
+        """
+        results = {}
+        batched = []
+        for file_path in file_paths:
+            try:
+                check_argument(file_path)
+            except ExiftoolArgumentError as e:
+                log.warning("%s", e)
+                results[file_path] = FileLimitError(str(e))
+                continue
+            try:
+                file_path.encode("utf-8")
+            except UnicodeEncodeError:
+                # exiftool's SourceFile for it can't be matched up with it; on its own, it needn't be
+                results[file_path] = self.get_exif_from_tool(file_path, None)
+                continue
+            batched.append(file_path)
+        file_paths = batched
+        if not file_paths:
+            return results
+        try:
+            args = EXIFTOOL_ARGS + list(file_paths) + EXIFTOOL_TAGS
+            # The limits are per file
+            timeout = None if self.exiftool_timeout is None else self.exiftool_timeout * len(file_paths)
+            max_output = None if self.exiftool_max_output is None else self.exiftool_max_output * len(file_paths)
+            with self.stats.timer(scan_stats.EXIFTOOL):
+                exiftool_output, exiftool_error = self.exiftool_pool.execute(args, timeout, max_output)
+            if exiftool_error:
+                exiftool_error = exiftool_error.replace("\n", " ")
+                log.error("%s", exiftool_error)
+            entries = json.loads(exiftool_output) if exiftool_output.strip() else []
+            by_source = {}
+            for entry in entries:
+                by_source[entry.get("SourceFile")] = entry
+        except (ExiftoolError, FileNotFoundError, ValueError, AttributeError) as e:
+            # Don't let one bad file spoil the chunk: fall back to one call per file.
+            log.error("exiftool batch call on %d files, retrying one at a time", len(file_paths))
+            for file_path in file_paths:
+                results[file_path] = self.get_exif_from_tool(file_path, None)
+            return results
+        for file_path in file_paths:
+            entry = by_source.get(file_path, None)
+            if entry is None:
+                # exiftool reports unreadable files on stderr and leaves them out of the array
+                log.error("exiftool call on %s", file_path)
+                results[file_path] = None
             else:
-                print ("***EXIFTOOL: checked, but no proper Date", file_path)
+                results[file_path] = self.check_exiftool_entry(file_path, entry)
+        return results
+
+    def check_exiftool_entry(self, file_path, exiftool_output):
+        # if you have MIMEType, you're a media file.
+        if "MIMEType" not in exiftool_output:
+            return 0
+        if not log.isEnabledFor(logging.DEBUG):
             return exiftool_output
-        except (subprocess.CalledProcessError, FileNotFoundError) as e:
-            print ("ERROR: exiftool call on", file_path)
-            return None
+        if "MediaCreateDate" in exiftool_output:
+            log.debug("***EXIFTOOL: found MediaCreateDate %s", file_path)
+        elif "DateTimeOriginal" in exiftool_output:
+            log.debug("***EXIFTOOL: found DateTimeOriginal %s", file_path)
+        elif "DateTimeDigitized" in exiftool_output:
+            log.debug("***EXIFTOOL: found DateTimeDigitized %s", file_path)
+        elif "DateTime" in exiftool_output:
+            log.debug("***EXIFTOOL: found DateTime %s", file_path)
+        else:
+            log.debug("***EXIFTOOL: checked, but no proper Date %s", file_path)
+        return exiftool_output
+
+    def queue_for_exiftool(self, exif_dates_dict, file_path, file_info_list, cache_keys=None):
+        """
+        Hold a file that Pillow couldn't read until we have exiftool_batch_size of them.
+        """
+        self._exiftool_queue.append((file_path, file_info_list, cache_keys))
+        if len(self._exiftool_queue) >= self.exiftool_batch_size:
+            self.flush_exiftool_queue(exif_dates_dict)
+
+    def flush_exiftool_queue(self, exif_dates_dict):
+        """
+        Send the queued files to exiftool and classify each one as do_exif would have.
+        """
+        if not self._exiftool_queue:
+            return
+        queued = self._exiftool_queue
+        self._exiftool_queue = []
+        results = self.get_exif_from_tool_batch([file_path for file_path, file_info_list, cache_keys in queued])
+        for file_path, file_info_list, cache_keys in queued:
+            with self.stats.timer(scan_stats.CLASSIFY):
+                self.store_exif(results[file_path], exif_dates_dict, file_path, file_info_list, cache_keys)
 
 
     # exif_found_files["exif_data"]=file_dict[hash]
@@ -311,9 +1306,13 @@ class Rummage:
         # except KeyError:
         #     need_file_rehash = True
         # if need_file_rehash:
-        file_hash = self.get_hash(file_name)
-        file_dict[file_name] = [stat, output_string, file_hash]
-        print("ADDED:", output_name, "FILE:", file_name, file_dict[file_name])
+        file_info_list = FileRecord.from_list(file_info_list, output_name)
+        try:
+            self.hash_entry(output_name, file_name, file_info_list)
+        except (IOError, OSError) as e:
+            log.error("can't hash %s %s", file_name, e)
+        file_dict[file_name] = file_info_list
+        log.debug("ADDED: %s FILE: %s %s", output_name, file_name, file_info_list)
         # file_dict[(filename, stat)].append((file_hash, output_string))
 
         # print ("Type:", output_name, "entry:", file_hash, "list:", filename, output_string)
@@ -339,9 +1338,27 @@ class Rummage:
         # write_output(output_name, file_object_dict, exif_dates_dict, filename, file_hash, output_string)
 
 
+    def get_exif_from_header(self, img_file, file_type=None):
+        """
+        :return: a dictionary of the date tags read from the file's header, or None
+                 if the header reader is off or can't tell; then it's Pillow's turn.
+        """
+        if not self.header_reader:
+            return None
+        with self.stats.timer(scan_stats.HEADER):
+            return read_header_dates(img_file, self.header_read_limit, file_type)
+
     def get_exif(self, img_file):
+        with self.stats.timer(scan_stats.PILLOW):
+            return self.get_exif_from_pillow(img_file)
+
+    def get_exif_from_pillow(self, img_file):
+        Image, ExifTags = load_pillow()
         try:
             img = Image.open(img_file)
+        except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            log.warning("decompression bomb %s: %s", img_file, e)
+            return FileLimitError("decompression bomb: " + str(e))
         except IOError:
             return 0
         # exif_data = img._getexif()
@@ -354,7 +1371,12 @@ class Rummage:
         except AttributeError:
             #print ('x ', img_file, ": has no recognizable attributes")
             exif=None
-        img.close()
+        except Exception as e:
+            # Damaged exif data can make Pillow raise just about anything; exiftool may do better
+            log.debug("Pillow can't read the exif data of %s: %s", img_file, e)
+            exif = 0
+        finally:
+            img.close()
         if exif is 0 or exif is None:
             pass
         return exif
@@ -375,8 +1397,10 @@ class Rummage:
             return "Same: " + d1 + " " + tag_date1 + " " + tag_date2
 
 
-    def do_exif(self, filename, exif_dates_dict):
+    def do_exif(self, filename, exif_dates_dict, file_stat=None):
         """
+        file_stat is the file's os.stat_result, if the caller has it already.
+
         returns:
         0 - File was ignored, entry saved to EXIF_IGNORE_BASED_ON_NAME_DICT
         1 - OK, valid Exif date was found.
@@ -385,12 +1409,13 @@ class Rummage:
         4 - Large difference between DateTimeOriginal and DateTimeDigitized, entry is saved
             to EXIF_BIG_DIFF_ORIG_DIGITIZED_DICT
         5 - Error in the Exif data, entry saved to EXIF_UNRECOGNIZED_ENTRY_DICT
+        6 - No dates in the Exif data, entry saved to EXIF_NO_DATES_DICT
+        8 - No date in the Exif data (2, 5 or 6), but there's one in the path. Entry saved to EXIF_PATH_DATE_DICT
+        9 - The file was too big, too slow or too strange to read. Entry saved to EXIF_ERROR_DICT, with the reason
+        7 - Neither the header reader nor Pillow could read it, so it's queued for the next exiftool batch. It's
+            stored by flush_exiftool_queue().
         Based on the exif data, this file may be manifested more than once.
         """
-        global NOT_STARTSWITH
-        global NOT_CONTAINS
-        global NOT_ENDSWITH
-
         global EXIF_UNRECOGNIZED_DICT
         global EXIF_NO_DATES_DICT
         global EXIF_IGNORE_BASED_ON_NAME_DICT
@@ -418,38 +1443,123 @@ class Rummage:
         base=os.path.basename(filename)
         file_path = os.path.abspath(filename)
 
-        # This will have 3 elements: the stat, the date/info string (appended below), and the hash
-        file_info_list = [stat(filename), "", 0]
+        # This will have 4 elements: the stat, the date/info string (appended below), the hash
+        # and the partial hash. Which hashes are filled in depends on hash_policy.
+        if file_stat is None:
+            with self.stats.timer(scan_stats.STAT):
+                file_stat = stat(filename)
+        file_info_list = FileRecord(file_stat)
 
         # Don't redo files that already are in a dictionary
         code =  self.check_existing_stats(exif_dates_dict, file_path, file_info_list[0])
         if code != RETURN_CODE_MISSING:
-            print ("File already there:", filename, "Full Path:", file_path)
+            log.debug("File already there: %s Full Path: %s", filename, file_path)
             return code
+        self.stats.count(scan_stats.FILES_EXAMINED)
+        self.stats.count(scan_stats.BYTES_EXAMINED, file_stat.st_size)
 
-        if base.startswith(".") or base.endswith((".db", ".info", ".docx", ".exe", ".pdf", ".url")):
+        with self.stats.timer(scan_stats.NAME_FILTER):
+            rule = file_types.match_name_rules(base, self.name_rules)
+        if rule == EXCLUDE:
             file_info_list[1] = NON_EXIF_IGNORED
-            self.perform_storage(EXIF_IGNORE_BASED_ON_NAME_DICT, exif_dates_dict, file_path, file_info_list)
-            return EXIF_IGNORE_BASED_ON_NAME
-
-        for contain_str in NOT_CONTAINS:
-            if contain_str in base:
-                file_info_list[1] = NON_EXIF_IGNORED
+            with self.stats.timer(scan_stats.CLASSIFY):
                 self.perform_storage(EXIF_IGNORE_BASED_ON_NAME_DICT, exif_dates_dict, file_path, file_info_list)
-                return EXIF_IGNORE_BASED_ON_NAME
+            return EXIF_IGNORE_BASED_ON_NAME
 
-        exif = self.get_exif(file_path)
+        file_type = None
+        if self.sniff:
+            try:
+                with self.stats.timer(scan_stats.SNIFF):
+                    file_type = file_types.sniff(file_path)
+            except (IOError, OSError) as e:
+                log.error("can't read %s %s", file_path, e)
+            if file_type is None and rule != INCLUDE and not file_types.has_media_extension(base):
+                # Nothing we know of, no point asking Pillow or exiftool
+                with self.stats.timer(scan_stats.CLASSIFY):
+                    return self.store_exif(0, exif_dates_dict, file_path, file_info_list)
+
+        cache_keys = None
+        if self.metadata_cache is not None:
+            with self.stats.timer(scan_stats.CACHE):
+                cache_keys, found, exif = self.get_cached_exif(file_path, file_stat, file_info_list)
+            if found:
+                log.debug("Cached: %s", file_path)
+                self.stats.count(scan_stats.CACHE_HITS)
+                with self.stats.timer(scan_stats.CLASSIFY):
+                    return self.store_exif(exif, exif_dates_dict, file_path, file_info_list)
+
+        exif = None
+        if file_type is None or file_type in file_types.HEADER_TYPES:
+            exif = self.get_exif_from_header(file_path, file_type)
+        if exif is None and self.max_file_size is not None and file_stat.st_size > self.max_file_size:
+            exif = FileLimitError(str(file_stat.st_size) + " bytes, more than the " + str(self.max_file_size) +
+                                  " Pillow and exiftool may read")
+        if exif is None and (file_type is None or file_type in file_types.PILLOW_TYPES):
+            exif = self.get_exif(file_path)
         if exif is 0 or exif is None:
+            if self.exiftool_batch_size > 1:
+                self.queue_for_exiftool(exif_dates_dict, file_path, file_info_list, cache_keys)
+                return EXIF_QUEUED
             exif = self.get_exif_from_tool(file_path, file_info_list)
+        with self.stats.timer(scan_stats.CLASSIFY):
+            return self.store_exif(exif, exif_dates_dict, file_path, file_info_list, cache_keys)
+
+    def get_cached_exif(self, file_path, file_stat, file_info_list):
+        """
+        Look a file up in the metadata cache, by its inode and then, with hash_policy partial or
+        full, by its content. Finding it by its content means reading its fingerprint, which those
+        policies would read anyway; the hashes are kept, so they aren't worked out again. With
+        hash_policy none or lazy only the inode is used, so a miss costs no reading.
+        :return: (the keys to cache what's extracted from the file under, True if it was found,
+                  what was found - see MetadataCache.get())
+        """
+        cache_keys = [inode_key(file_stat)]
+        found, exif = self.metadata_cache.get(cache_keys[0])
+        if found or self.hash_policy not in (HASH_PARTIAL, HASH_FULL):
+            return cache_keys, found, exif
+        try:
+            fingerprint, full_hash = self.get_partial_hash(file_path, file_stat.st_size)
+        except (IOError, OSError) as e:
+            log.error("can't read %s %s", file_path, e)
+            return cache_keys, False, None
+        if self.hash_policy == HASH_PARTIAL:
+            file_info_list[3], file_info_list[2] = fingerprint, full_hash
+        elif self.hash_policy == HASH_FULL and full_hash is not None:
+            file_info_list[2] = full_hash
+        cache_keys.append(content_key(self.hash_algorithm, self.partial_hash_size, fingerprint))
+        found, exif = self.metadata_cache.get(cache_keys[1])
+        if found:
+            # So it's found by its inode from now on
+            self.metadata_cache.put(cache_keys[:1], exif)
+        return cache_keys, found, exif
+
+    def store_exif(self, exif, exif_dates_dict, file_path, file_info_list, cache_keys=None):
+        """
+        Classify a file by the exif data found for it, and store it in the matching dictionary.
+        exif is a dictionary of tags, 0 if the file was unrecognized, None if it had no attributes,
+        or a FileLimitError if it couldn't be read.
+        With cache_keys, what was extracted is put in the metadata cache under them.
+        Returns the same codes as do_exif.
+        """
+        if cache_keys:
+            self.metadata_cache.put(cache_keys, exif)
+        if isinstance(exif, FileLimitError):
+            file_info_list[1] = NON_EXIF_ERROR + " " + str(exif)
+            self.perform_storage(EXIF_ERROR_DICT, exif_dates_dict, file_path, file_info_list)
+            log.debug("Error for %s: %s", file_path, exif)
+            return EXIF_ERROR
         if exif is 0:
             file_info_list[1] = NON_EXIF_UNRECOGNIZED
             self.perform_storage(EXIF_UNRECOGNIZED_DICT, exif_dates_dict, file_path, file_info_list)
-            print ("Exif unrecognized for", file_path)
+            log.debug("Exif unrecognized for %s", file_path)
             return EXIF_UNRECOGNIZED
         if exif is None:
             file_info_list[1] = NO_ATTRIBUTES
-            self.perform_storage(EXIF_NO_ATTRIBUTES_DICT, exif_dates_dict, file_path, file_info_list)
-            return EXIF_NO_ATTRIBUTES
+            output_name, return_code = self.fall_back_to_path_date(EXIF_NO_ATTRIBUTES_DICT, EXIF_NO_ATTRIBUTES,
+                                                                   file_path, file_info_list)
+            self.perform_storage(output_name, exif_dates_dict, file_path, file_info_list)
+            return return_code
+        file_info_list.tags = tuple(None if exif.get(tag) is None else str(exif.get(tag)) for tag in DATE_TAGS)
         # Get 3 values:
         # date_time, date_time_digitized, date_time_original
 
@@ -464,16 +1574,16 @@ class Rummage:
         try:
             date_time = exif.get('DateTime', None)
             if date_time is not None:
-                date_time = datetime.datetime.strptime(date_time, "%Y:%m:%d %H:%M:%S")
+                date_time = datetime.datetime.strptime(date_time, EXIF_DATE_FORMAT)
             date_time_digitized = exif.get('DateTimeDigitized', None)
             if date_time_digitized is not None:
-                date_time_digitized = datetime.datetime.strptime(date_time_digitized, "%Y:%m:%d %H:%M:%S")
+                date_time_digitized = datetime.datetime.strptime(date_time_digitized, EXIF_DATE_FORMAT)
             date_time_original = exif.get('DateTimeOriginal', None)
             if date_time_original is not None:
-                date_time_original = datetime.datetime.strptime(date_time_original, "%Y:%m:%d %H:%M:%S")
+                date_time_original = datetime.datetime.strptime(date_time_original, EXIF_DATE_FORMAT)
             media_create_date = exif.get('MediaCreateDate', None)
             if media_create_date is not None:
-                media_create_date = datetime.datetime.strptime(media_create_date, "%Y:%m:%d %H:%M:%S")
+                media_create_date = datetime.datetime.strptime(media_create_date, EXIF_DATE_FORMAT)
 
             # we assume we'll return OK. Let's see...
             return_code = RETURN_CODE_MISSING
@@ -554,23 +1664,21 @@ class Rummage:
                 return_code = EXIF_OK
             elif media_create_date is not None:
                 file_info_list[1] = str(media_create_date)
-                print("MEDIA CREATE DATE:", file_info_list[1])
+                log.debug("MEDIA CREATE DATE: %s", file_info_list[1])
                 output_name = EXIF_DATE_OK_DICT
                 return_code = EXIF_OK
         except ValueError:
             # eg, date values of 0000:00:00 00-00-00 will throw this exception
             # We see that in MediaCreateDate, at least.
-
-            # TODO: Add functionality to get the date value from the filename,
-            # TODO: and add it to another dictionary, appropriately named.
             file_info_list[1] = (NON_EXIF_UNRECOGNIZED_VALUE + " DateTime: " + str(date_time) +
                                  " DateTimeDigitized: " + str(date_time_digitized) +
                                  " DateTimeOriginal: " + str(date_time_original) +
                                  " MediaCreateDate: " + str(media_create_date)
                                  )
-            print ("VALUE ERROR:", file_info_list[1])
+            log.debug("VALUE ERROR: %s", file_info_list[1])
             output_name = EXIF_UNRECOGNIZED_ENTRY_DICT
             return_code = EXIF_UNRECOGNIZED_ENTRY
+        output_name, return_code = self.fall_back_to_path_date(output_name, return_code, file_path, file_info_list)
         self.perform_storage(output_name, exif_dates_dict, file_path, file_info_list)
         return return_code
 
@@ -582,6 +1690,37 @@ class Rummage:
         # print (compare_dates(exif, 'DateTimeDigitized',  'DateTimeOriginal') + " " + filename)
 
 
+# The Rummage used by each worker process of Rummage.examine_chunks()
+_scan_worker = None
+
+
+def _init_scan_worker(options, log_level):
+    import multiprocessing
+    import multiprocessing.util
+    global _scan_worker
+    # Spawned workers start with logging unconfigured
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    _scan_worker = Rummage.for_worker(options)
+    # Worker processes don't run atexit handlers, but they do run these.
+    multiprocessing.util.Finalize(None, _scan_worker.close, exitpriority=10)
+    # If the scan is killed outright (eg. out of memory), nothing tells the workers.
+    watcher = threading.Thread(target=_exit_with_parent, args=(multiprocessing.parent_process().sentinel,))
+    watcher.daemon = True
+    watcher.start()
+
+
+def _exit_with_parent(parent_sentinel):
+    import multiprocessing.connection
+    multiprocessing.connection.wait([parent_sentinel])
+    _scan_worker.close()
+    os._exit(1)
+
+
+def _examine_chunk_in_worker(files):
+    chunk_dict = _scan_worker.examine_chunk(files)
+    return chunk_dict, _scan_worker.stats.take()
+
+
 # ##########################################################################################
 #
 # ################ MAIN ####################################################################
@@ -598,13 +1737,213 @@ class Rummage:
     #print (str(str_hash(output_name)))
     #print (exif_dates_dict[output_name])
 
-if __name__=="__main__":
-    directory = sys.argv[1]
-    print(directory)
+# The subcommands of main(). Anything else as the first argument is a directory to scan, as before there were any.
+COMMANDS = ["scan", "rescan", "report", "dedupe"]
 
-    rummage = Rummage(directory)
-    for output_name in rummage.exif_dates_dict:
-        print("----------------------------", output_name, "---------------------------")
-        print("OUTPUT DICT:", output_name)
 
-    pass
+def scan_options(args):
+    """
+    :return: Rummage's options, from the arguments main() parsed
+    """
+    return dict(exiftool=args.exiftool, exiftool_workers=args.exiftool_workers,
+                exiftool_batch_size=args.exiftool_batch_size, workers=args.workers,
+                chunk_size=args.chunk_size, incremental=not getattr(args, "full", False), hash_policy=args.hash,
+                hash_algorithm=args.hash_algorithm, partial_hash_size=args.partial_hash_kb * 1024,
+                hash_ignored=args.hash_ignored, checkpoint_files=args.checkpoint_files,
+                checkpoint_seconds=args.checkpoint_seconds, header_reader=not args.no_header_reader,
+                header_read_limit=args.header_read_kb * 1024, sniff=not args.no_sniff,
+                name_rules=(args.name_rules or []) + NAME_RULES, follow_symlinks=args.follow_symlinks,
+                prune_directories=args.prune_unchanged_dirs, concurrency=args.concurrency,
+                progress_seconds=args.progress, stats_file=args.stats, path_dates=not args.no_path_dates,
+                skip_directories=args.skip_directories,
+                metadata_cache=None if args.no_metadata_cache else METADATA_CACHE,
+                metadata_cache_size=args.metadata_cache_size, exiftool_timeout=args.exiftool_timeout,
+                exiftool_max_output=args.exiftool_max_output_kb * 1024,
+                max_file_size=None if args.max_file_mb is None else args.max_file_mb * 1024 * 1024)
+
+
+def rescan_directories(directories):
+    """
+    :param directories: the directories to rescan, or none for every one in the manifest
+    :return: those of them that have a catalog to rescan against
+    """
+    if not directories:
+        return [directory for directory, catalog_file in read_manifest() or []
+                if catalog_file.endswith(".db") and os.path.exists(catalog_file)]
+    found = []
+    for directory in directories:
+        if os.path.exists(directory_hash(directory) + ".db"):
+            found.append(directory)
+        else:
+            log.error("%s has no catalog here, scan it first", directory)
+    return found
+
+
+def main(argv=None):
+    """
+    The command line: rummage.py scan|rescan|report|dedupe ...; see rummage.py --help.
+    rummage.py DIRECTORY, with no subcommand, scans DIRECTORY as it always has.
+    :return: the exit status
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] not in COMMANDS and argv[0] not in ("-h", "--help"):
+        argv = ["scan"] + list(argv)
+
+    logging_options = argparse.ArgumentParser(add_help=False)
+    logging_options.add_argument("-v", "--verbose", action="store_true", help="log what happens to each file")
+    logging_options.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    hashing_options = argparse.ArgumentParser(add_help=False)
+    hashing_options.add_argument("--hash-algorithm", default=HASH_ALGORITHM,
+                                 help="any algorithm hashlib knows, eg. blake2b (default: %(default)s)")
+    hashing_options.add_argument("--partial-hash-kb", type=int, default=PARTIAL_HASH_SIZE // 1024,
+                                 help="KB read from each end of a file for a partial hash (default: %(default)s)")
+    scanning = argparse.ArgumentParser(add_help=False, parents=[logging_options, hashing_options])
+    scanning.add_argument("--workers", type=int, default=1,
+                          help="processes to examine files with (default: 1, everything in this process)")
+    scanning.add_argument("--chunk-size", type=int, default=SCAN_CHUNK_SIZE,
+                          help="files handed to a worker at a time (default: %(default)s)")
+    scanning.add_argument("--exiftool", default=EXIFTOOL, help="exiftool executable (default: %(default)s)")
+    scanning.add_argument("--exiftool-workers", type=int, default=1,
+                          help="exiftool processes per scan process (default: %(default)s)")
+    scanning.add_argument("--exiftool-batch-size", type=int, default=EXIFTOOL_BATCH_SIZE,
+                          help="files per exiftool call (default: %(default)s)")
+    scanning.add_argument("--hash", choices=HASH_POLICIES, default=HASH_FULL,
+                          help="how much of each file to hash (default: %(default)s)")
+    scanning.add_argument("--hash-ignored", action="store_true",
+                          help="hash files that are ignored based on their name, too")
+    scanning.add_argument("--checkpoint-files", type=int, default=CHECKPOINT_FILES,
+                          help="checkpoint after this many examined files (default: %(default)s)")
+    scanning.add_argument("--checkpoint-seconds", type=int, default=CHECKPOINT_SECONDS,
+                          help="checkpoint after this many seconds (default: %(default)s)")
+    scanning.add_argument("--no-header-reader", action="store_true",
+                          help="read every file with Pillow, not just the ones the header reader can't")
+    scanning.add_argument("--header-read-kb", type=int, default=HEADER_READ_LIMIT // 1024,
+                          help="KB the header reader may read from a file (default: %(default)s)")
+    scanning.add_argument("--no-sniff", action="store_true",
+                          help="don't look at the first bytes of files, try every extractor on everything")
+    scanning.add_argument("--include", dest="name_rules", action="append", metavar="PATTERN",
+                          type=lambda pattern: (INCLUDE, pattern),
+                          help="examine files whose name matches, even if they're not recognized. May be repeated.")
+    scanning.add_argument("--exclude", dest="name_rules", action="append", metavar="PATTERN",
+                          type=lambda pattern: (EXCLUDE, pattern),
+                          help="ignore files whose name matches. May be repeated; the first "
+                               "--include or --exclude that matches wins, then the defaults.")
+    scanning.add_argument("--follow-symlinks", action="store_true",
+                          help="follow symbolic links to files and directories")
+    scanning.add_argument("--skip", dest="skip_directories", action="append", metavar="DIRECTORY",
+                          help="don't walk DIRECTORY or anything under it. May be repeated.")
+    scanning.add_argument("--prune-unchanged-dirs", action="store_true",
+                          help="don't list directories whose mtime hasn't changed since the last scan "
+                               "(files rewritten in place are missed)")
+    scanning.add_argument("--concurrency", type=int, default=0,
+                          help="examine this many files at once with asyncio and threads, "
+                               "for network filesystems (default: off)")
+    scanning.add_argument("--progress", type=int, default=0, metavar="SECONDS",
+                          help="log a progress line every this many seconds (default: off)")
+    scanning.add_argument("--stats", metavar="FILE",
+                          help="write the time spent in each stage, and throughput, to FILE as JSON")
+    scanning.add_argument("--no-path-dates", action="store_true",
+                          help="don't date files without exif dates by their names and directories")
+    scanning.add_argument("--no-metadata-cache", action="store_true",
+                          help="read every examined file, even if one with the same content has been read before")
+    scanning.add_argument("--metadata-cache-size", type=int, default=METADATA_CACHE_SIZE,
+                          help="entries kept in the metadata cache (default: %(default)s)")
+    scanning.add_argument("--exiftool-timeout", type=float, default=EXIFTOOL_TIMEOUT,
+                          help="seconds exiftool may take over a file (default: %(default)s)")
+    scanning.add_argument("--exiftool-max-output-kb", type=int, default=EXIFTOOL_MAX_OUTPUT // 1024,
+                          help="KB of output exiftool may write for a file (default: %(default)s)")
+    scanning.add_argument("--max-file-mb", type=int,
+                          help="don't give files bigger than this to Pillow or exiftool (default: no limit)")
+
+    parser = argparse.ArgumentParser(description="Rummage through directories, sorting files by their exif dates.")
+    commands = parser.add_subparsers(dest="command")
+    scan = commands.add_parser("scan", parents=[scanning], help="rummage through a directory")
+    scan.add_argument("directory")
+    scan.add_argument("--full", action="store_true",
+                      help="ignore the results of the last run and examine every file again")
+    scan.add_argument("--watch", action="store_true",
+                      help="after the scan, keep the catalog up to date as files change, until stopped")
+    scan.add_argument("--debounce-seconds", type=float, default=DEBOUNCE_SECONDS,
+                      help="with --watch, examine a file once it's been left alone this long (default: %(default)s)")
+    scan.add_argument("--poll", action="store_true",
+                      help="with --watch, walk the tree every --poll-seconds rather than use inotify")
+    scan.add_argument("--poll-seconds", type=float, default=POLL_SECONDS,
+                      help="with --watch, how often to walk the tree without inotify (default: %(default)s)")
+    rescan = commands.add_parser("rescan", parents=[scanning],
+                                 help="rummage through directories again, only looking at what's changed")
+    rescan.add_argument("directories", nargs="*",
+                        help="which ones; each must have been scanned here before (default: all in the manifest)")
+    report = commands.add_parser("report", parents=[logging_options],
+                                 help="count the files in each category of a directory's catalog")
+    report.add_argument("directory")
+    report.add_argument("--category", help="list the files in this category (eg. exif_error), with their dates")
+    dedupe = commands.add_parser("dedupe", parents=[logging_options, hashing_options],
+                                 help="find duplicate files in rummage catalogs")
+    dedupe.add_argument("catalogs", nargs="*", help="catalog files (default: everything in the manifest)")
+    dedupe.add_argument("--min-size", type=int, default=1,
+                        help="ignore files smaller than this many bytes (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO,
+                        format=LOG_FORMAT)
+
+    if args.command == "scan":
+        directory = args.directory
+        log.info("%s", directory)
+        options = scan_options(args)
+        if args.watch:
+            import signal
+            from watch import RummageWatch
+            watch = RummageWatch(directory, debounce_seconds=args.debounce_seconds, poll_seconds=args.poll_seconds,
+                                 polling=args.poll, **options)
+            signal.signal(signal.SIGTERM, lambda signum, frame: watch.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: watch.stop())
+            watch.run()
+            return 0
+        rummage = Rummage(directory, **options)
+        for output_name in rummage.exif_dates_dict:
+            print("----------------------------", output_name, "---------------------------")
+            print("OUTPUT DICT:", output_name)
+    elif args.command == "rescan":
+        directories = rescan_directories(args.directories)
+        if not directories:
+            log.error("nothing to rescan")
+            return 1
+        options = scan_options(args)
+        for directory in directories:
+            log.info("%s", directory)
+            rummage = Rummage(directory, **options)
+            rummage.close()
+        if len(directories) < len(args.directories):
+            return 1
+    elif args.command == "report":
+        catalog_file = directory_hash(args.directory) + ".db"
+        if not os.path.exists(catalog_file):
+            log.error("%s has no catalog here, scan it first", args.directory)
+            return 1
+        store = CatalogStore(catalog_file)
+        try:
+            if args.category:
+                for file_path, date in store.query("SELECT path, date FROM files WHERE category = ? ORDER BY path",
+                                                   (args.category,)):
+                    print(date, path_from_db(file_path))
+            else:
+                for category, count in sorted(store.count_by_category().items()):
+                    print(category, count)
+        finally:
+            store.close()
+    elif args.command == "dedupe":
+        from dedupe import DuplicateFinder, manifest_catalogs, print_duplicates
+        catalogs = args.catalogs or manifest_catalogs()
+        with DuplicateFinder(catalogs, hash_algorithm=args.hash_algorithm,
+                             partial_hash_size=args.partial_hash_kb * 1024, min_size=args.min_size) as finder:
+            count, wasted = print_duplicates(finder.duplicates())
+        print("SETS:", count, "EXTRA BYTES:", wasted)
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
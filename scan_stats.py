@@ -0,0 +1,160 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+# The stages of a scan, in the order a file goes through them
+WALK = "walk"
+STAT = "stat"
+NAME_FILTER = "name_filter"
+SNIFF = "sniff"
+CACHE = "cache"
+HEADER = "header"
+PILLOW = "pillow"
+EXIFTOOL = "exiftool"
+CLASSIFY = "classify"
+HASH = "hash"
+PERSIST = "persist"
+STAGES = [WALK, STAT, NAME_FILTER, SNIFF, CACHE, HEADER, PILLOW, EXIFTOOL, CLASSIFY, HASH, PERSIST]
+
+# Counters
+FILES_WALKED = "files_walked"
+FILES_EXAMINED = "files_examined"
+BYTES_EXAMINED = "bytes_examined"
+DIRECTORIES = "directories"
+DIRECTORIES_PRUNED = "directories_pruned"
+CACHE_HITS = "cache_hits"
+
+
+class StageTimer:
+    """
+    What ScanStats.timer() returns. A timer started while another one is running in
+    the same thread pauses it, so each stage only gets its own time.
+    """
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.nested = 0.0
+        self.stats._stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        stack = self.stats._stack()
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.stats.add_time(self.stage, elapsed - self.nested)
+
+
+class ScanStats:
+    """
+    Time spent in each stage of a scan, how often each was entered, and counters,
+    safe to update from several threads.
+
+        with stats.timer(PILLOW):
+            exif = ...
+        stats.count(FILES_EXAMINED)
+
+    Stage times are added up over all the threads and worker processes, so they
+    can come to more than the elapsed time. Worker processes send theirs back with
+    take(), and they're added in with merge().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.seconds = dict((stage, 0.0) for stage in STAGES)
+            self.calls = dict((stage, 0) for stage in STAGES)
+            self.counters = {}
+            self._last_progress = self.started
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def add_time(self, stage, seconds, calls=1):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def take(self):
+        """
+        :return: the stage times, calls and counters so far, which are then zeroed
+        """
+        with self._lock:
+            taken = {"seconds": self.seconds, "calls": self.calls, "counters": self.counters}
+            self.seconds = dict((stage, 0.0) for stage in STAGES)
+            self.calls = dict((stage, 0) for stage in STAGES)
+            self.counters = {}
+        return taken
+
+    def merge(self, taken):
+        for stage in taken["seconds"]:
+            self.add_time(stage, taken["seconds"][stage], taken["calls"].get(stage, 0))
+        for counter in taken["counters"]:
+            self.count(counter, taken["counters"][counter])
+
+    def summary(self):
+        """
+        :return: a dictionary that json.dumps() can write
+        """
+        with self._lock:
+            elapsed = time.time() - self.started
+            files = self.counters.get(FILES_EXAMINED, 0)
+            byte_count = self.counters.get(BYTES_EXAMINED, 0)
+            return {
+                "elapsed_seconds": round(elapsed, 3),
+                "files_per_second": round(files / elapsed, 1) if elapsed > 0 else None,
+                "bytes_per_second": round(byte_count / elapsed) if elapsed > 0 else None,
+                "counters": dict(self.counters),
+                "stages": dict((stage, {"seconds": round(self.seconds.get(stage, 0.0), 6),
+                                        "calls": self.calls.get(stage, 0)})
+                               for stage in STAGES),
+            }
+
+    def write_json(self, filename, extra=None):
+        summary = self.summary()
+        if extra:
+            summary.update(extra)
+        with open(filename, "w") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def progress_line(self):
+        """
+        :return: eg. "1234 files examined (5678 walked), 56.7 files/s, 12.3 MB/s"
+        """
+        summary = self.summary()
+        return "%d files examined (%d walked), %s files/s, %.1f MB/s" % (
+            summary["counters"].get(FILES_EXAMINED, 0), summary["counters"].get(FILES_WALKED, 0),
+            summary["files_per_second"], (summary["bytes_per_second"] or 0) / 1e6)
+
+    def progress_due(self, interval):
+        """
+        :return: True once every interval seconds
+        """
+        now = time.time()
+        if not interval or now - self._last_progress < interval:
+            return False
+        self._last_progress = now
+        return True
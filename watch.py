@@ -0,0 +1,357 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from catalog_store import MANIFEST
+from rummage import Rummage, DEBOUNCE_SECONDS, POLL_SECONDS
+
+log = logging.getLogger("rummage")
+
+# The longest RummageWatch.run() goes without checking whether it's been stopped
+WAKE_SECONDS = 1.0
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_EXCL_UNLINK)
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+def load_inotify():
+    """
+    :return: libc, with the inotify functions set up for ctypes
+    :raises OSError: if there's no inotify here
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    try:
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except AttributeError:
+        raise OSError(errno.ENOSYS, "no inotify in this C library")
+    return libc
+
+
+def walk_tree(directory, follow_symlinks, skip_directories):
+    """
+    Yield every directory under directory, and directory, as Rummage.walk_directories() would get
+    to them, and the os.DirEntry's of the files in each: (dirname, entries).
+    """
+    walked = set()
+    stack = [directory]
+    while stack:
+        dirname = stack.pop()
+        if dirname in skip_directories and dirname != directory:
+            continue
+        entries = []
+        try:
+            if follow_symlinks:
+                dir_stat = os.stat(dirname)
+                if (dir_stat.st_dev, dir_stat.st_ino) in walked:
+                    continue
+                walked.add((dir_stat.st_dev, dir_stat.st_ino))
+            with os.scandir(dirname) as scan:
+                for entry in scan:
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=follow_symlinks):
+                            entries.append(entry)
+                    except OSError:
+                        pass
+        except OSError as e:
+            log.error("can't list %s %s", dirname, e)
+            continue
+        yield dirname, entries
+
+
+class InotifyWatcher:
+    """
+    What changes under a directory, as Linux's inotify tells it, through ctypes.
+
+    Every directory in the tree has a watch. A directory that's created or moved
+    in gets watches as soon as it's reported; one that's deleted or moved out
+    loses them. changes() reports paths, not what happened to them: whatever is
+    there now is what counts.
+
+    The kernel only queues so many events. If they overflow, changes() says so,
+    and everything has to be looked at again. Running out of watches (see
+    /proc/sys/fs/inotify/max_user_watches) raises OSError.
+    """
+    def __init__(self, directory, follow_symlinks=False, skip_directories=()):
+        self.directory = os.path.abspath(directory)
+        self.follow_symlinks = follow_symlinks
+        self.skip_directories = set(skip_directories)
+        self.libc = load_inotify()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, "inotify_init1: " + os.strerror(code))
+        # watch descriptor: directory, and back
+        self.paths = {}
+        self.watches = {}
+        try:
+            self.add_tree(self.directory)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, dirname):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirname), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                raise OSError(code, "out of inotify watches, see /proc/sys/fs/inotify/max_user_watches")
+            # Gone already, or not ours to read; whoever made it will say if it comes back
+            log.debug("can't watch %s %s", dirname, os.strerror(code))
+            return
+        old_dirname = self.paths.get(wd, None)
+        if old_dirname is not None:
+            self.watches.pop(old_dirname, None)
+        self.paths[wd] = dirname
+        self.watches[dirname] = wd
+
+    def add_tree(self, directory):
+        """
+        Watch directory and everything under it. Whatever was made in a directory before
+        it was watched is for the caller to find; Rummage.update() walks a new directory
+        after this.
+        """
+        if directory in self.skip_directories and directory != self.directory:
+            return
+        for dirname, entries in walk_tree(directory, self.follow_symlinks, self.skip_directories):
+            self.add_watch(dirname)
+
+    def remove_tree(self, directory):
+        prefix = directory + os.sep
+        for dirname in [dirname for dirname in self.watches if dirname == directory or dirname.startswith(prefix)]:
+            wd = self.watches.pop(dirname)
+            del self.paths[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds for something to change.
+        :return: the set of paths (files or directories) that have changed or gone, maybe empty,
+                 or None if events were lost and everything has to be looked at again
+        """
+        readable, writable, failed = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                dirname = self.paths.get(wd, None)
+                if dirname is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory's gone, its parent has said so
+                    del self.paths[wd]
+                    self.watches.pop(dirname, None)
+                    continue
+                path = os.path.join(dirname, os.fsdecode(name)) if name else dirname
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_tree(path)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.remove_tree(path)
+                changed.add(path)
+        if overflow:
+            log.warning("inotify queue overflowed")
+            return None
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    """
+    Where inotify can't be used (not Linux, or out of watches), the tree is walked
+    every poll_seconds, and each file's mtime and size compared with the walk
+    before. It costs a walk of the tree each time, so keep poll_seconds long for
+    big trees.
+    """
+    def __init__(self, directory, poll_seconds=POLL_SECONDS, follow_symlinks=False, skip_directories=()):
+        self.directory = os.path.abspath(directory)
+        self.poll_seconds = poll_seconds
+        self.follow_symlinks = follow_symlinks
+        self.skip_directories = set(skip_directories)
+        self.snapshot = self.walk()
+        self.next_poll = time.time() + poll_seconds
+
+    def walk(self):
+        """
+        :return: dictionary of each file's path to its (mtime_ns, size)
+        """
+        snapshot = {}
+        for dirname, entries in walk_tree(self.directory, self.follow_symlinks, self.skip_directories):
+            for entry in entries:
+                try:
+                    file_stat = entry.stat(follow_symlinks=self.follow_symlinks)
+                except OSError:
+                    continue
+                snapshot[entry.path] = (file_stat.st_mtime_ns, file_stat.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        """
+        Like InotifyWatcher.changes(); the changes are only found every poll_seconds.
+        """
+        wait = self.next_poll - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        snapshot = self.walk()
+        self.next_poll = time.time() + self.poll_seconds
+        changed = set(path for path in snapshot if self.snapshot.get(path, None) != snapshot[path])
+        changed.update(path for path in self.snapshot if path not in snapshot)
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class RummageWatch:
+    """
+    Keeps a directory's catalog up to date as files are added, changed, moved
+    and deleted, for as long as it runs.
+
+    run() starts watching, then reconciles the catalog with a scan (incremental,
+    unless options say otherwise). From then on only what changes is looked at:
+    a path is handed to Rummage.update() once it's had no events for
+    debounce_seconds, along with everything else that's due. Changes are found
+    with inotify (see InotifyWatcher), or by walking the tree every poll_seconds
+    with polling, or where inotify can't be had. If inotify loses events, the
+    catalog is reconciled with a scan again. If it fails while running (eg. a
+    new directory takes it past max_user_watches), the tree is polled from then
+    on, starting with a reconciling scan.
+
+    options are Rummage's. The files Rummage writes itself (the catalog, the
+    metadata cache and the like) are left out, in case they're in the tree.
+    stop() makes run() return, from a signal handler or another thread.
+    """
+    def __init__(self, directory, debounce_seconds=DEBOUNCE_SECONDS, poll_seconds=POLL_SECONDS,
+                 polling=False, **options):
+        self.rummage = Rummage(directory, autoscan=False, **options)
+        self.debounce_seconds = debounce_seconds
+        self.poll_seconds = poll_seconds
+        self.polling = polling
+        self.watcher = None
+        self._stopped = threading.Event()
+        own_files = [self.rummage.catalog_file, self.rummage.checkpoint_file, MANIFEST,
+                     self.rummage.metadata_cache_file, self.rummage.stats_file]
+        self.own_files = tuple(os.path.abspath(own_file) for own_file in own_files if own_file)
+
+    def start_watcher(self):
+        directory = os.path.abspath(self.rummage.directory)
+        if not self.polling:
+            try:
+                return InotifyWatcher(directory, self.rummage.follow_symlinks, self.rummage.skip_directories)
+            except OSError as e:
+                log.warning("can't use inotify (%s), walking the tree every %s seconds instead", e,
+                            self.poll_seconds)
+        return PollingWatcher(directory, self.poll_seconds, self.rummage.follow_symlinks,
+                              self.rummage.skip_directories)
+
+    def reconcile(self):
+        # The writer and the rest that update() leaves open are scan()'s to open
+        self.rummage.close()
+        for record in self.rummage.scan():
+            pass
+        self.rummage.incremental = True
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        """
+        Watch until stop() is called.
+        """
+        self.watcher = self.start_watcher()
+        try:
+            self.reconcile()
+            log.info("WATCHING: %s", self.rummage.directory)
+            # path: when its last event came
+            pending = {}
+            while not self._stopped.is_set():
+                timeout = WAKE_SECONDS
+                if pending:
+                    timeout = max(0, min(min(pending.values()) + self.debounce_seconds - time.time(), timeout))
+                try:
+                    changed = self.watcher.changes(timeout)
+                except OSError as e:
+                    if self.polling:
+                        raise
+                    # Out of watches for a directory that's just appeared, most likely
+                    log.warning("inotify failed (%s), walking the tree every %s seconds instead", e,
+                                self.poll_seconds)
+                    self.watcher.close()
+                    self.polling = True
+                    self.watcher = self.start_watcher()
+                    # Events may have been lost with the watcher
+                    pending = {}
+                    self.reconcile()
+                    continue
+                now = time.time()
+                if changed is None:
+                    log.warning("too much changed at once, reconciling with a scan")
+                    pending = {}
+                    self.reconcile()
+                    continue
+                for path in changed:
+                    if not path.startswith(self.own_files):
+                        pending[path] = now
+                due = [path for path in pending if now - pending[path] >= self.debounce_seconds]
+                if due:
+                    for path in due:
+                        del pending[path]
+                    for record in self.rummage.update(due):
+                        log.debug("UPDATED: %s %s", record.output_name, record.path)
+        finally:
+            self.watcher.close()
+            self.watcher = None
+            self.rummage.close()